@@ -1,11 +1,16 @@
 import operator
 import sys
+import threading
+from collections import Counter
 from collections.abc import Callable as AbcCallable
 from datetime import datetime, timedelta
 from enum import Enum, unique
 from random import randint
 from time import sleep
-from typing import Callable, ByteString, Dict, List, Text, Tuple, SupportsFloat
+from typing import (
+    Callable, ByteString, Dict, Iterable, List, Optional, Set, Text, Tuple,
+    SupportsFloat
+)
 
 import psutil
 import pytz
@@ -21,6 +26,8 @@ from .gql import util, queries
 
 from tasks import tasks
 from tasks.common import TaskException
+from tasks.topologies import TopologyRegistry
+from tasks.upload_queue import POST_STATUS_QUEUED, STATE_DONE
 
 API_CHECK_TRIES = 5
 API_CHECK_SLEEP = 7
@@ -28,6 +35,7 @@ GITHUB_DESCRIPTION_LIMIT = 139
 RACE_TIMEOUT = 17
 RERUN_PENDING = "pending for rerun"
 TASK_TAKEN_FMT = "Taken by {runner_id} on {date}"
+UPLOADING_FMT = "Uploading by {runner_id} since {date}"
 SENTRY_URL = (
     "https://d24d8d622cbb4e2ea447c9a64f19b81a:"
     "4db0ce47706f435bb3f8a02a0a1f2e22@sentry.io/193222"
@@ -37,6 +45,9 @@ SENTRY_URL = (
 # until the reset time will come.
 EPHEMERAL_LIMIT = 60
 STALE_TASK_EXTRA_TIME = 60
+UPLOAD_FAILED_DESCRIPTION = "Failed to publish artifacts"
+# Uploads are retried with a backoff, give them time before re-running
+UPLOAD_STALE_TIME = 3 * 60 * 60
 
 
 def sentry_report_exception(context: Dict):
@@ -149,8 +160,37 @@ class World(object):
         self.runner_id = runner_id
         self.tasks_path = tasks_path
         self.whitelist = whitelist
+        self.upload_queue = None
+        self.storage = None
+        self.disk_gc = None
+        self.mirror = None
+        self.package_proxy_url = None
+        self.vm_pool = None
+        self.overlay_store = None
+        self.box_prefetcher = None
+        self.teardown_queue = None
+        self.topologies = None
+        # The templates of the jobs of the pull requests being scanned and
+        # of the last complete scan, by the number of jobs
+        self.templates = Counter()
+        self.scanned_templates = None
         self.instance = self
 
+    def add_templates(self, templates: Iterable[Tuple[Text, Text]]) -> None:
+        """Counts the (name, version) templates of the jobs of a PR"""
+        self.templates.update(templates)
+
+    def finish_scan(self) -> None:
+        """All open pull requests were scanned"""
+        self.scanned_templates, self.templates = self.templates, Counter()
+
+    def referenced_templates(self) -> Optional[Set[Tuple[Text, Text]]]:
+        """The templates jobs of open pull requests need, None until all
+        pull requests were scanned once"""
+        if self.scanned_templates is None:
+            return None
+        return set(self.scanned_templates) | set(self.templates)
+
     def get_rate_limit(self, resource: Text=None) -> RateLimit:
         """Calls GitHub API and returns RateLimit instance"""
         if resource not in RateLimit.valid_resources:
@@ -188,6 +228,19 @@ class World(object):
     ) -> None:
         """Creates commit status on GitHub using REST API
 
+        Raises:
+            github3.exceptions.GitHubError, ValueError
+        """
+        self.create_commit_status(
+            task.commit_sha, task.name, state, description, target_url
+        )
+
+    def create_commit_status(
+        self, commit_sha: Text, context: Text, state: State,
+        description: Text, target_url: Text=""
+    ) -> None:
+        """Creates commit status on GitHub using REST API
+
         Raises:
             github3.exceptions.GitHubError, ValueError
         """
@@ -198,10 +251,30 @@ class World(object):
         self.github_api.repository(
             self.repo_owner, self.repo_name
         ).create_status(
-            task.commit_sha, state.value.lower(),
-            target_url, description, task.name
+            commit_sha, state.value.lower(),
+            target_url, description, context
         )
 
+    def upload_completed(self, entry: Dict) -> None:
+        """Reports a finished background upload of a job's artifacts
+
+        The job's commit status is posted unless it already was when the
+        upload was queued. If the upload failed, the status is replaced
+        by an error.
+        """
+        status = entry["status"]
+        if entry["state"] != STATE_DONE:
+            self.create_commit_status(
+                status["commit_sha"], status["context"], State.ERROR,
+                UPLOAD_FAILED_DESCRIPTION
+            )
+        elif not status["posted"]:
+            self.create_commit_status(
+                status["commit_sha"], status["context"],
+                State.from_str(status["state"]), status["description"],
+                status["url"]
+            )
+
     def __check_limit(self, resource: Text=None) -> None:
         error = None
         for _i in range(API_CHECK_TRIES):
@@ -261,21 +334,40 @@ class AvailableResources(object):
     def __init__(self) -> None:
         self.cpu = AvailableResources.initial_cpu
         self.memory = AvailableResources.initial_memory
+        # Taken by the idle VMs of the VM pool
+        self.reserved = 0.0
+        # Given back by the teardown queue too
+        self.lock = threading.Lock()
 
     def __str__(self) -> Text:
-        return "{cpu} CPU, {memory}MB".format(
-            cpu=self.cpu, memory=self.memory
+        return "{cpu} CPU, {memory}MB ({reserved}MB reserved)".format(
+            cpu=self.cpu, memory=self.memory - self.reserved,
+            reserved=self.reserved
         )
 
-    def check(self, task: "Task") -> bool:
-        return all([
-            self.cpu >= task.topology.cpu,
-            self.memory >= task.topology.memory
-        ])
+    def check(self, task: "Task", reserved: bool=True) -> bool:
+        """Whether the task fits, in the memory reserved too if not
+        reserved"""
+        with self.lock:
+            memory = self.memory - self.reserved if reserved else self.memory
+            return all([
+                self.cpu >= task.topology.cpu,
+                memory >= task.topology.memory
+            ])
+
+    def missing_memory(self, task: "Task") -> float:
+        with self.lock:
+            return task.topology.memory - (self.memory - self.reserved)
+
+    def reserve(self, memory: SupportsFloat) -> None:
+        """Memory (MB) taken by VMs of no task, given back if negative"""
+        with self.lock:
+            self.reserved += float(memory)
 
     def __operate(self, task: "Task", op: Callable) -> None:
-        self.cpu = op(self.cpu, task.topology.cpu)
-        self.memory = op(self.memory, task.topology.memory)
+        with self.lock:
+            self.cpu = op(self.cpu, task.topology.cpu)
+            self.memory = op(self.memory, task.topology.memory)
 
     def take(self, task: "Task") -> None:
         self.__operate(task, operator.sub)
@@ -322,6 +414,10 @@ class Status(Stateful):
     def taken(self) -> bool:
         return "taken" in self.description.lower()
 
+    @property
+    def uploading(self) -> bool:
+        return bool(parse.parse(UPLOADING_FMT, self.description))
+
     @property
     def unassigned(self) -> bool:
         return "unassigned" in self.description.lower()
@@ -333,16 +429,25 @@ class Status(Stateful):
     @property
     def processing(self) -> bool:
         return any((
-            self.pending, self.rerun_pending, self.taken, self.unassigned
+            self.pending, self.rerun_pending, self.taken, self.unassigned,
+            self.uploading
         ))
 
     def stalled(self, task: "Task") -> bool:
-        """Checks if commit status is timed out"""
+        """Checks if commit status is timed out
+
+        A task whose artifacts are being uploaded in the background is
+        stalled only once UPLOAD_STALE_TIME has passed since the job ended.
+        """
         now = datetime.now(pytz.UTC)
-        timeout = timedelta(seconds=task.timeout)
+        parsed = parse.parse(UPLOADING_FMT, self.description)
+        if parsed:
+            timeout = timedelta(seconds=UPLOAD_STALE_TIME)
+        else:
+            timeout = timedelta(seconds=task.timeout)
+            parsed = parse.parse(TASK_TAKEN_FMT, self.description)
         if not timeout:
             return False
-        parsed = parse.parse(TASK_TAKEN_FMT, self.description)
         if not parsed:
             return False
 
@@ -517,9 +622,16 @@ class Task(object):
     """Represents a task defined in a task file"""
     def __init__(
         self, name: Text, pr_number: int, commit_sha: Text,
-        repo_url: Text, task_data: Dict, job_handler: Callable
+        repo_url: Text, task_data: Dict, job_handler: Callable,
+        topologies: TopologyRegistry=None
     ) -> None:
-        """Constructs the instance of a Task to be processed by the handler"""
+        """Constructs the instance of a Task to be processed by the handler
+
+        The resources of the task's topology are computed from its
+        Vagrantfile template, or from its spec if it's generated, if a
+        topology registry is given and knows it. Otherwise they're the
+        ones declared in the task definition.
+        """
         self.name = name
         self.pr_number = pr_number
         self.commit_sha = commit_sha
@@ -550,7 +662,38 @@ class Task(object):
             self.topology = Topology()
         else:
             self.topology = Topology.from_dict(topology_data)
+        if topologies is not None:
+            self.resolve_topology(topologies, topology_data or {})
         self.description = ""
+        # The UUID of the job whose VMs are being destroyed
+        self.teardown = None
+
+    def resolve_topology(
+        self, topologies: TopologyRegistry, topology_data: Dict
+    ) -> None:
+        """Sizes the topology by the Vagrantfile its job boots"""
+        task_class = getattr(self.job, "task_class", None)
+        if task_class is None:
+            return
+        name = task_class.vagrantfile_name(topology_data.get("name"))
+        spec = None
+        if getattr(task_class, "generates_topology", False):
+            try:
+                spec = topologies.spec(name, topology_data)
+            except (TypeError, ValueError):
+                # The job fails on it, with the declared resources
+                return
+        if spec is not None:
+            name = spec.name
+            resources = topologies.spec_resources(spec)
+        else:
+            resources = topologies.resources(name)
+        if resources is None:
+            return
+        cpu, memory = resources
+        self.topology = Topology(
+            name=topology_data.get("name", name), memory=memory, cpu=cpu
+        )
 
     def check_dependencies(self, statuses: Dict=None) -> bool:
         """Checks if the dependent tasks are done
@@ -593,7 +736,7 @@ class Task(object):
                 )
             )
 
-        if status.pending and status.taken:
+        if status.pending and (status.taken or status.uploading):
             raise EnvironmentError(
                 "Task '{}' PR#{} is already locked.".format(
                     self.name, self.pr_number
@@ -675,8 +818,49 @@ class Task(object):
                 status.state, status.description, status.target_url
             )
 
-        result = self.job(dependencies_results)
+        result = self.job(dependencies_results, world)
+        self.teardown = result.teardown
+
+        try:
+            self.__check_owner(world)
+        except EnvironmentError:
+            if result.upload is not None:
+                # Nobody to report the upload to
+                world.upload_queue.set_status(result.upload, {})
+            raise
+
+        if result.upload is None:
+            world.create_status(
+                self, result.state, result.description, result.url
+            )
+            return
+
+        # The upload queue posts the final status once the upload is done,
+        # unless it was posted here. The status is attached to the queued
+        # upload even if posting fails, so the upload is never left behind.
+        upload_status = dict(
+            commit_sha=self.commit_sha, context=self.name,
+            state=result.state.value, description=result.description,
+            url=result.url, posted=False
+        )
+        try:
+            if result.wait_for_upload:
+                # Keep the task locked, but not stalled, while uploading
+                time_now = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
+                world.create_status(
+                    self, State.PENDING, UPLOADING_FMT.format(
+                        runner_id=world.runner_id, date=time_now
+                    )
+                )
+            else:
+                world.create_status(
+                    self, result.state, result.description, result.url
+                )
+                upload_status["posted"] = True
+        finally:
+            world.upload_queue.set_status(result.upload, upload_status)
 
+    def __check_owner(self, world: World) -> None:
         status = world.poll_status(self.pr_number, self.name)
         if status.description != self.description:
             raise EnvironmentError(
@@ -684,7 +868,6 @@ class Task(object):
                     self.name, self.pr_number
                 )
             )
-        world.create_status(self, result.state, result.description, result.url)
 
 
 class ExitHandler(object):
@@ -717,14 +900,21 @@ class ExitHandler(object):
 
 class JobResult(Stateful):
     def __init__(
-        self, state: State, description: Text="", url: Text=""
+        self, state: State, description: Text="", url: Text="",
+        upload: Text=None, wait_for_upload: bool=False, teardown: Text=None
     ) -> None:
+        """upload is the UUID of the job if its artifacts are still being
+        uploaded in the background, teardown if its VMs are still being
+        destroyed in the background"""
         if state not in self.valid_states:
             raise ValueError('invalid state: {}'.format(state))
 
         self.state = state
         self.description = description[:GITHUB_DESCRIPTION_LIMIT]
         self.url = url
+        self.upload = upload
+        self.wait_for_upload = wait_for_upload
+        self.teardown = teardown
 
 
 class JobDispatcher(AbcCallable):
@@ -757,8 +947,24 @@ class JobDispatcher(AbcCallable):
     def timeout(self) -> int:
         return self.kwargs.get('timeout') or 0
 
-    def __call__(self, dependencies_results: Dict=None) -> JobResult:
-        """Calls the constructed job and waits for its result"""
+    def __call__(
+        self, dependencies_results: Dict=None, world: World=None
+    ) -> JobResult:
+        """Calls the constructed job and waits for its result
+
+        The job uses the services of the runner in world, if given:
+
+        If there's an upload queue, the job's artifacts are uploaded in
+        the background and the job returns once they are queued. The
+        artifacts are published to storage, fedorapeople.org by default.
+        The VMs of the job install builds from the mirror and distribution
+        packages through the package proxy, if any. Its VMs come from
+        the VM pool, if any and it has VMs for the job. Otherwise they
+        boot from the disks provisioned by a previous job of the same build
+        in the overlay store, if any. The job returns before its VMs are
+        destroyed if there's a teardown queue. Its topology is generated
+        by the topology registry, if any and it generates one.
+        """
 
         # As we can have dependencies, obviously, we will need theirs results
         # For example, URL with RPM packages
@@ -776,6 +982,17 @@ class JobDispatcher(AbcCallable):
             kwargs[key] = value
 
         job = self.task_class(**kwargs)
+        job.source_ref = self.kwarg_lookup['git_refspec']
+        if world is not None:
+            job.upload_queue = world.upload_queue
+            if world.storage is not None:
+                job.storage = world.storage
+            job.mirror = world.mirror
+            job.package_proxy_url = world.package_proxy_url
+            job.vm_pool = world.vm_pool
+            job.overlay_store = world.overlay_store
+            job.teardown_queue = world.teardown_queue
+            job.topologies = world.topologies
         try:
             job()
         except TaskException as e:
@@ -789,4 +1006,17 @@ class JobDispatcher(AbcCallable):
             else:
                 state = State.FAILURE
 
-        return JobResult(state, description, job.remote_url)
+        teardown = job.uuid if job.teardown_queued else None
+        if not job.upload_queued:
+            return JobResult(
+                state, description, job.remote_url, teardown=teardown
+            )
+
+        return JobResult(
+            state, description, job.remote_url, upload=job.uuid,
+            wait_for_upload=(
+                job.wait_for_upload
+                or upload_queue.post_status != POST_STATUS_QUEUED
+            ),
+            teardown=teardown
+        )
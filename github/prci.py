@@ -7,7 +7,7 @@ import signal
 import sys
 from functools import partial
 from time import sleep
-from typing import Dict, Iterator, Optional, Text
+from typing import Dict, Iterator, List, Optional, Text, Tuple
 
 import github3
 import yaml
@@ -18,6 +18,17 @@ from internals.entities import (
     sentry_report_exception
 )
 from internals.gql import util, queries
+from tasks.box_inventory import BoxInventory
+from tasks.box_prefetch import BoxPrefetcher
+from tasks.constants import UPLOAD_QUEUE_DIR
+from tasks.disk_gc import DiskGarbageCollector
+from tasks.mirror import ArtifactMirror
+from tasks.overlays import OverlayStore
+from tasks.remote_storage import storage_from_config
+from tasks.teardown import TeardownQueue
+from tasks.topologies import TopologyRegistry
+from tasks.upload_queue import UploadQueue
+from tasks.vm_pool import VMPool
 
 
 logger = logging.getLogger(__name__)
@@ -68,6 +79,17 @@ def create_parser():
         else:
             config['whitelist'] = load_yaml(whitelist_file)
 
+        config.setdefault('upload_queue', None)
+        config.setdefault('storage', None)
+        config.setdefault('disk_gc', None)
+        config.setdefault('mirror', None)
+        config.setdefault('package_proxy', None)
+        config.setdefault('vm_pool', None)
+        config.setdefault('overlays', None)
+        config.setdefault('box_prefetch', None)
+        config.setdefault('teardown', None)
+        config.setdefault('topologies', {})
+
         return config
 
     parser = argparse.ArgumentParser()
@@ -83,6 +105,18 @@ def create_parser():
     return parser
 
 
+def job_templates(tasks_data: Dict) -> List[Tuple[Text, Text]]:
+    """The (name, version) of the template box of every job of a tasks file"""
+    templates = []
+    for task_data in tasks_data.values():
+        try:
+            template = task_data["job"]["args"]["template"]
+            templates.append((template["name"], str(template["version"])))
+        except (KeyError, TypeError):
+            continue
+    return templates
+
+
 def process_pull_request(
     world: World, pull_request: PullRequest, repository_url: Text
 ) -> Optional[Iterator[Task]]:
@@ -103,6 +137,8 @@ def process_pull_request(
         logger.error(e)
         return None
 
+    world.add_templates(job_templates(tasks_data))
+
     if pull_request.needs_rerun:
         # If all statuses are not failed (not in state ERROR or FAILURE) and
         # re-run label was set previously, remove the re-run label
@@ -119,7 +155,7 @@ def process_pull_request(
     for name, task_data in tasks_data.items():
         task = Task(
             name, pull_request.number, pull_request.commit.sha,
-            repository_url, task_data, JobDispatcher
+            repository_url, task_data, JobDispatcher, world.topologies
         )
         if task.name not in pull_request.commit.statuses:
             if (
@@ -193,7 +229,9 @@ def process_task(
         skipping_task("GitHub status doesn't exist", task)
         return None
 
-    if not world.available_resources.check(task):
+    if not world.available_resources.check(task) and not make_room(
+        world, task
+    ):
         skipping_task("not enough resources", task)
         return None
 
@@ -201,6 +239,11 @@ def process_task(
         skipping_task("waiting for dependencies", task)
         return None
 
+    # The disk usage is measured once per scan, for runnable tasks only
+    if world.disk_gc is not None and not world.disk_gc.admit():
+        skipping_task("not enough disk space", task)
+        return None
+
     logger.info(
         "Attempting to lock a task %s for PR#%s.",
         task.name, task.pr_number
@@ -219,6 +262,22 @@ def process_task(
     return task
 
 
+def make_room(world: World, task: Task) -> bool:
+    """Destroys idle pooled VMs if the task only misses their memory"""
+    if (
+        world.vm_pool is None or
+        not world.available_resources.check(task, reserved=False)
+    ):
+        return False
+    world.vm_pool.shrink(world.available_resources.missing_memory(task))
+    return world.available_resources.check(task)
+
+
+def give_resources(world: World, task: Task) -> None:
+    world.available_resources.give(task)
+    logger.info("Available resources: %s", world.available_resources)
+
+
 def main():
     parser = create_parser()
     args = parser.parse_args()
@@ -253,6 +312,63 @@ def main():
         whitelist=whitelist
     )
 
+    upload_config = config["upload_queue"]
+    world.storage = storage_from_config(
+        config["storage"],
+        bwlimit=upload_config.get("bwlimit") if upload_config else None
+    )
+    if upload_config is not None:
+        # Artifacts are uploaded in the background and the task's
+        # resources are given back as soon as its VMs are destroyed
+        world.upload_queue = UploadQueue(
+            UPLOAD_QUEUE_DIR,
+            world.storage,
+            concurrency=upload_config.get("concurrency", 2),
+            retries=upload_config.get("retries", 5),
+            backoff=upload_config.get("backoff", 60),
+            post_status=upload_config.get("post_status", "uploaded"),
+            on_complete=world.upload_completed
+        )
+        world.upload_queue.start()
+
+    # The resources of the topologies come from their Vagrantfiles
+    world.topologies = TopologyRegistry.from_config(config["topologies"])
+
+    if config["disk_gc"] is not None:
+        world.disk_gc = DiskGarbageCollector.from_config(
+            config["disk_gc"], world.upload_queue,
+            boxes=BoxInventory(world.referenced_templates)
+        )
+
+    if config["mirror"] is not None:
+        # Served to the VMs by the prci-mirror service
+        world.mirror = ArtifactMirror(config["mirror"]["url"])
+
+    if config["package_proxy"] is not None:
+        # Run by the prci-package-proxy service
+        world.package_proxy_url = config["package_proxy"]["url"]
+
+    if config["vm_pool"] is not None:
+        world.vm_pool = VMPool.from_config(config["vm_pool"])
+        # The idle VMs of the pool aren't available to the tasks
+        world.vm_pool.account(world.available_resources.reserve)
+
+    if config["overlays"] is not None:
+        world.overlay_store = OverlayStore.from_config(config["overlays"])
+
+    if config["teardown"] is not None:
+        # The resources of a task are given back once its VMs are destroyed
+        world.teardown_queue = TeardownQueue(
+            workers=config["teardown"].get("workers", 2),
+            retries=config["teardown"].get("retries", 3)
+        )
+        world.teardown_queue.start()
+
+    if config["box_prefetch"] is not None:
+        world.box_prefetcher = BoxPrefetcher.from_config(
+            config["box_prefetch"]
+        )
+
     while not exit_handler.done:
         world.check_graphql_limit()
 
@@ -278,8 +394,12 @@ def main():
             ),
             key=lambda pr: not pr.prioritized
         )
+        idle = True
+        if world.disk_gc is not None:
+            world.disk_gc.reset()
         for pull_request in pull_requests:
             for task in process_pull_request(world, pull_request, repo_url):
+                idle = False
                 exit_handler.register_task(task)
                 world.available_resources.take(task)
                 logger.info(
@@ -293,13 +413,43 @@ def main():
                     sleep(ERROR_BACKOFF_TIME)
                 finally:
                     exit_handler.unregister_task()
-                    world.available_resources.give(task)
-                    logger.info(
-                        "Available resources: %s", world.available_resources
-                    )
+                    if world.disk_gc is not None:
+                        # The job wrote to the disk
+                        world.disk_gc.reset()
+                    if task.teardown is not None:
+                        world.teardown_queue.when_done(
+                            task.teardown, partial(give_resources, world, task)
+                        )
+                    else:
+                        give_resources(world, task)
+
+        world.finish_scan()
+
+        if world.vm_pool is not None and idle and not exit_handler.done:
+            # Boot VMs for the next tasks while there's nothing to run,
+            # without blocking the scheduling
+            world.vm_pool.refill_in_background()
+
+        if world.box_prefetcher is not None and not exit_handler.done:
+            # Download the boxes the next tasks need in the background
+            world.box_prefetcher.prefetch(world.scanned_templates)
 
         sleep(no_task_backoff_time)
 
+    if world.upload_queue is not None:
+        logger.info(
+            "Waiting for running uploads, %s queued",
+            len(world.upload_queue)
+        )
+        world.upload_queue.stop()
+
+    if world.teardown_queue is not None:
+        logger.info(
+            "Waiting for VMs being destroyed, %s jobs",
+            len(world.teardown_queue)
+        )
+        world.teardown_queue.stop()
+
 
 if __name__ == "__main__":
     main()
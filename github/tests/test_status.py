@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import pytest
 
@@ -79,3 +79,34 @@ class TestStatus(object):
     ])
     def test_unassigned(self, test_input, expected):
         assert test_input.unassigned == expected
+
+    @pytest.mark.parametrize("test_input,expected", [
+        (create_with_description(""), False),
+        (create_with_description("Taken by r on 2017-01-01 10:00 UTC"), False),
+        (
+            create_with_description(
+                "Uploading by r since 2017-01-01 10:00 UTC"
+            ),
+            True
+        ),
+    ])
+    def test_uploading(self, test_input, expected):
+        assert test_input.uploading == expected
+        assert test_input.processing == (expected or test_input.pending)
+
+    def test_uploading_stalled(self):
+        class Task(object):
+            timeout = 60
+
+        now = datetime.utcnow()
+        recent = create_with_description(e.UPLOADING_FMT.format(
+            runner_id="r", date=now.strftime("%Y-%m-%d %H:%M UTC")
+        ))
+        # The task timeout doesn't apply while uploading
+        assert not recent.stalled(Task())
+
+        old = now - timedelta(seconds=e.UPLOAD_STALE_TIME + 3600)
+        old = create_with_description(e.UPLOADING_FMT.format(
+            runner_id="r", date=old.strftime("%Y-%m-%d %H:%M UTC")
+        ))
+        assert old.stalled(Task())
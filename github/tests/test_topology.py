@@ -1,6 +1,7 @@
 import pytest
 
-from github.internals.entities import Topology
+from github.internals.entities import JobDispatcher, Task, Topology
+from tasks.topologies import TopologyRegistry
 
 
 class TestTopology(object):
@@ -13,3 +14,47 @@ class TestTopology(object):
     ])
     def test_from_dict(self, test_input, expected):
         assert Topology.from_dict(test_input) == expected
+
+    @pytest.mark.parametrize("job_class,declared,expected", [
+        ("RunPytest", {"name": "master_1repl", "cpu": 1, "memory": 1},
+         Topology(name="master_1repl", memory=5750, cpu=4)),
+        ("Build", {"name": "build"},
+         Topology(name="build", memory=3800, cpu=2)),
+        ("RunPytest", {"name": "unknown", "cpu": 1, "memory": 1},
+         Topology(name="unknown", memory=1, cpu=1)),
+        ("RunPytest", {"name": "small", "replicas": 1, "clients": 1,
+                       "client": {"memory": 750}},
+         Topology(name="small", memory=6500, cpu=4)),
+        ("RunWebuiTests", {"name": "small", "replicas": 1},
+         Topology(name="small", memory=2400, cpu=2)),
+    ])
+    def test_from_vagrantfile(self, job_class, declared, expected):
+        task_data = {
+            "requires": [],
+            "job": {
+                "class": job_class,
+                "args": {"topology": declared}
+            }
+        }
+        task = Task(
+            "fedora/test", 1, "sha", "repo_url", task_data, JobDispatcher,
+            TopologyRegistry()
+        )
+        assert task.topology == expected
+
+    def test_provision_from_runner(self):
+        task_data = {
+            "requires": [],
+            "job": {
+                "class": "RunPytest",
+                "args": {"topology": {"name": "master_1repl_1client"}}
+            }
+        }
+        task = Task(
+            "fedora/test", 1, "sha", "repo_url", task_data, JobDispatcher,
+            TopologyRegistry(provision_from_runner=True)
+        )
+        # Without the controller
+        assert task.topology == Topology(
+            name="master_1repl_1client", memory=5750, cpu=3
+        )
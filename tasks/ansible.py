@@ -1,10 +1,12 @@
 import os
 
+from . import constants
 from .common import PopenTask, FallibleTask, TaskException
 
 
 class AnsibleFixKeysPermissions(FallibleTask):
-    def __init__(self, directory='../keys', **kwargs):
+    def __init__(self, directory=os.path.join(constants.BASE_DIR, 'keys'),
+                 **kwargs):
         super(AnsibleFixKeysPermissions, self).__init__(**kwargs)
         self.directory = directory
 
@@ -19,7 +21,13 @@ class AnsibleFixKeysPermissions(FallibleTask):
 
 class AnsiblePlaybook(PopenTask):
     def __init__(self, playbook=None, extra_vars=None,
-                 verbosity=None, **kwargs):
+                 verbosity=None, inventory=None, vars_file=None,
+                 limit=None, tags=None, **kwargs):
+        """
+        vars_file: file of extra variables
+        limit: hosts (comma separated) the playbook runs on
+        tags: only run the tasks with these tags (comma separated)
+        """
         self.extra_vars = extra_vars
         self.playbook = playbook
         self.extra_vars = extra_vars
@@ -36,10 +44,17 @@ class AnsiblePlaybook(PopenTask):
             for name, value in self.extra_vars.items():
                 if value is None:
                     continue
-                cmd[2:2] = ['-e', '{name}={value}'.format(
+                cmd[1:1] = ['-e', '{name}={value}'.format(
                     name=name,
                     value=value)]
 
+        if vars_file is not None:
+            cmd[1:1] = ['-e', '@{path}'.format(path=vars_file)]
+        for option, value in (('--tags', tags), ('--limit', limit),
+                              ('-i', inventory)):
+            if value is not None:
+                cmd[1:1] = [option, value]
+
         if self.verbosity is not None:
             cmd.append('-{verbosity}'.format(verbosity=self.verbosity))
 
@@ -0,0 +1,138 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+
+from .common import FallibleTask, TaskException
+from . import constants
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_key(digest):
+    return constants.ARTIFACT_BLOB_KEY.format(
+        digest_prefix=digest[:2], digest=digest)
+
+
+class Manifest(object):
+    """
+    Content digests of all the files of a job directory
+
+    files maps paths relative to the job directory to dicts with the
+    sha256 digest and size of the file.
+    """
+    def __init__(self, uuid, files):
+        self.uuid = uuid
+        self.files = files
+
+    @staticmethod
+    def from_directory(directory, uuid, workers=None):
+        paths = []
+        for root, _dirs, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                rel_path = os.path.relpath(path, directory)
+                # rsync -r skipped symlinks too
+                if (rel_path in (constants.MANIFEST_FILE,
+                                 constants.UPLOADED_FILE) or
+                        not os.path.isfile(path) or os.path.islink(path)):
+                    continue
+                paths.append(rel_path)
+
+        def entry(rel_path):
+            path = os.path.join(directory, rel_path)
+            return dict(sha256=file_digest(path),
+                        size=os.path.getsize(path))
+
+        # hashlib releases the GIL, files are hashed in parallel threads
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            entries = executor.map(entry, paths)
+            return Manifest(uuid, dict(zip(paths, entries)))
+
+    @staticmethod
+    def load(path):
+        with open(path) as manifest_f:
+            data = json.load(manifest_f)
+        return Manifest(data['uuid'], data['files'])
+
+    def write(self, path):
+        with open(path, 'w') as manifest_f:
+            json.dump(dict(uuid=self.uuid, files=self.files), manifest_f,
+                      indent=1, sort_keys=True)
+
+    def job_key(self, path):
+        return constants.ARTIFACT_JOB_KEY.format(uuid=self.uuid, path=path)
+
+    @property
+    def digests(self):
+        return {entry['sha256'] for entry in self.files.values()}
+
+
+class ArtifactUpload(FallibleTask):
+    """
+    Upload a job directory to a content-addressed storage
+
+    Every distinct file content is stored once as a blob keyed by its
+    sha256 digest, only blobs the storage doesn't have yet are transferred.
+    The job tree is then materialized in the storage as hard links to the
+    blobs, next to a manifest.json listing the digest of every file.
+
+    Blobs are never removed by uploads. Once old job trees are deleted,
+    the storage's prune_blobs() removes the blobs without any link left.
+    """
+    def __init__(self, directory, uuid, storage, workers=None, **kwargs):
+        super(ArtifactUpload, self).__init__(**kwargs)
+        if not re.match(constants.UUID_RE, uuid):
+            raise TaskException(self, "Invalid job UUID")
+        self.directory = directory
+        self.uuid = uuid
+        self.storage = storage
+        self.workers = workers
+        self.manifest = None
+        self.uploaded_blobs = 0
+        self.uploaded_bytes = 0
+
+    def _run(self):
+        self.manifest = Manifest.from_directory(
+            self.directory, self.uuid, self.workers)
+        manifest_path = os.path.join(self.directory, constants.MANIFEST_FILE)
+        self.manifest.write(manifest_path)
+
+        missing = self.storage.missing_keys(
+            self, {blob_key(digest) for digest in self.manifest.digests})
+        blobs = {}
+        links = []
+        for path, entry in sorted(self.manifest.files.items()):
+            key = blob_key(entry['sha256'])
+            if key in missing and key not in blobs:
+                blobs[key] = os.path.join(self.directory, path)
+                self.uploaded_bytes += entry['size']
+            links.append((self.manifest.job_key(path), key))
+        self.uploaded_blobs = len(blobs)
+
+        self.storage.put_files(self, sorted(blobs.items()))
+        self.storage.link_files(self, links)
+        self.storage.put_files(
+            self, [(self.manifest.job_key(constants.MANIFEST_FILE),
+                    manifest_path)])
+
+        # Tells the disk garbage collector the job may be removed
+        with open(os.path.join(self.directory, constants.UPLOADED_FILE), 'w'):
+            pass
+
+        self.logger.info(
+            'Uploaded {blobs} new blobs ({size} bytes) for {files} files, '
+            '{digests} distinct'.format(
+                blobs=self.uploaded_blobs, size=self.uploaded_bytes,
+                files=len(self.manifest.files),
+                digests=len(self.manifest.digests)))
@@ -0,0 +1,192 @@
+import logging
+import os
+import re
+import shutil
+import struct
+import time
+
+from .box_store import BoxStore
+from .common import PopenTask
+from . import constants
+from .vagrant import VagrantBox
+
+QCOW2_MAGIC = b'QFI\xfb'
+# magic, version, backing file offset, backing file size
+QCOW2_HEADER = struct.Struct('>4sIQI')
+LIBVIRT_IMAGE_RE = r'(?P<name>.+)_vagrant_box_image_(?P<version>.+)\.img$'
+
+
+def qcow2_backing_file(path):
+    """Absolute path of the backing file of a qcow2 image, None if none"""
+    try:
+        with open(path, 'rb') as image_f:
+            header = image_f.read(QCOW2_HEADER.size)
+            if len(header) < QCOW2_HEADER.size:
+                return None
+            magic, _version, offset, size = QCOW2_HEADER.unpack(header)
+            if magic != QCOW2_MAGIC or not offset:
+                return None
+            image_f.seek(offset)
+            backing_file = image_f.read(size).decode('utf-8')
+    except (OSError, IOError, UnicodeDecodeError):
+        return None
+    return os.path.realpath(
+        os.path.join(os.path.dirname(path), backing_file))
+
+
+def unescape_name(escaped_name):
+    return escaped_name.replace('-VAGRANTSLASH-', '/')
+
+
+class BoxEntry(object):
+    """
+    A box version on the disk: the box directory of vagrant and the image
+    vagrant-libvirt uploaded (or linked) to the libvirt images directory
+    """
+    def __init__(self, box, box_store, last_used):
+        self.box = box
+        self.directory = box_store.directory(box)
+        self.paths = []
+        if os.path.isdir(self.directory):
+            for root, _dirs, names in os.walk(self.directory):
+                self.paths.extend(os.path.join(root, name) for name in names)
+        if os.path.exists(box.libvirt_path):
+            self.paths.append(box.libvirt_path)
+        self.size = 0
+        self.mtime = 0
+        inodes = set()
+        for path in self.paths:
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            self.mtime = max(self.mtime, stat.st_mtime)
+            if (stat.st_dev, stat.st_ino) in inodes:
+                # The image hard linked to libvirt
+                continue
+            inodes.add((stat.st_dev, stat.st_ino))
+            self.size += stat.st_blocks * 512
+        self.last_used = last_used.get(box_store.name(box), self.mtime)
+
+    @property
+    def template(self):
+        return (self.box.name, self.box.version)
+
+
+class BoxInventory(object):
+    """
+    The box versions of the runner, by their last use
+
+    Jobs record the use of their box in the box store. Boxes are evicted
+    only to make room when the disk usage misses its target, the least
+    recently used first, and never when:
+
+    - a job of the pull requests scanned needs them (referenced, a callable
+      returning the (name, version) templates of the jobs, None until the
+      first scan of the pull requests completes)
+    - a qcow2 image in the libvirt images directory is backed by them: the
+      disks of running VMs, of the VM pool and of the overlay store
+    - they were used in the last min_idle seconds
+    - they're being downloaded
+    """
+    def __init__(self, referenced, box_store=None,
+                 images_dir=constants.LIBVIRT_IMAGES_DIR,
+                 min_idle=constants.BOX_GC_MIN_IDLE):
+        self.referenced = referenced
+        self.box_store = box_store if box_store is not None else BoxStore()
+        self.images_dir = images_dir
+        self.min_idle = min_idle
+        self.logger = logging.getLogger(__name__)
+
+    def boxes(self):
+        """The boxes in the vagrant boxes and the libvirt images directory"""
+        last_used = self.box_store.last_used()
+        boxes = {}
+        boxes_dir = self.box_store.boxes_dir
+        for escaped_name in self.listdir(boxes_dir):
+            for version in self.listdir(os.path.join(boxes_dir,
+                                                     escaped_name)):
+                for provider in self.listdir(
+                        os.path.join(boxes_dir, escaped_name, version)):
+                    box = VagrantBox(unescape_name(escaped_name), version,
+                                     provider)
+                    boxes[box.name, version, provider] = box
+        for name in self.listdir(self.images_dir, dirs=False):
+            match = re.match(LIBVIRT_IMAGE_RE, name)
+            if match is None:
+                continue
+            # Left behind by vagrant box remove if not in the boxes directory
+            box = VagrantBox(unescape_name(match.group('name')),
+                             match.group('version'))
+            boxes.setdefault((box.name, box.version, box.provider), box)
+        return [BoxEntry(box, self.box_store, last_used)
+                for _key, box in sorted(boxes.items())]
+
+    @staticmethod
+    def listdir(path, dirs=True):
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return []
+        return sorted(name for name in names if not name.endswith('.tmp') and
+                      os.path.isdir(os.path.join(path, name)) == dirs)
+
+    def backing_files(self):
+        """The images backing the qcow2 images of the libvirt directory"""
+        backing_files = set()
+        for root, _dirs, names in os.walk(self.images_dir):
+            for name in names:
+                backing_file = qcow2_backing_file(os.path.join(root, name))
+                if backing_file is not None:
+                    backing_files.add(backing_file)
+        return backing_files
+
+    def evictable(self):
+        """Unused boxes in the order they're evicted"""
+        referenced = self.referenced()
+        if referenced is None:
+            return []
+        backing_files = self.backing_files()
+        now = time.time()
+        entries = []
+        for entry in self.boxes():
+            if (entry.template in referenced or
+                    os.path.realpath(entry.box.libvirt_path) in
+                    backing_files or
+                    now - entry.last_used < self.min_idle):
+                continue
+            entries.append(entry)
+        return sorted(entries, key=lambda entry: entry.last_used)
+
+    def evict(self, size):
+        """Remove unused boxes until size bytes are freed, the bytes freed"""
+        freed = 0
+        for entry in self.evictable():
+            if freed >= size:
+                break
+            with self.box_store.lock(entry.box, blocking=False) as locked:
+                if not locked:
+                    continue
+                self.remove(entry)
+            freed += entry.size
+        if freed:
+            PopenTask(['virsh', 'pool-refresh', 'default'],
+                      raise_on_err=False)()
+        return freed
+
+    def remove(self, entry):
+        self.logger.info('Removing box %s %s %s (%d MiB, %s)',
+                         entry.box.name, entry.box.version,
+                         entry.box.provider, entry.size // 1024 ** 2,
+                         time.ctime(entry.last_used))
+        if os.path.exists(entry.box.libvirt_path):
+            os.remove(entry.box.libvirt_path)
+        shutil.rmtree(entry.directory, ignore_errors=True)
+        # The versions left of the box, vagrant keeps its metadata_url
+        name_dir = os.path.dirname(os.path.dirname(entry.directory))
+        version_dir = os.path.dirname(entry.directory)
+        if not self.listdir(version_dir):
+            shutil.rmtree(version_dir, ignore_errors=True)
+        if not self.listdir(name_dir):
+            shutil.rmtree(name_dir, ignore_errors=True)
+        self.box_store.forget(entry.box)
@@ -0,0 +1,91 @@
+import logging
+import os
+import shutil
+import threading
+
+from .box_store import BoxStore
+from .common import TaskException
+from .disk_gc import directory_size
+from .vagrant import VagrantBox, VagrantBoxDownload
+
+
+class BoxPrefetcher(object):
+    """
+    Downloads the template boxes the jobs of open pull requests need,
+    before the runner takes the jobs
+
+    prefetch(), called while the runner is idle with the templates of the
+    jobs of the pull requests it scanned, downloads the missing box wanted
+    by the most jobs in the background, one box at a time. Jobs needing
+    the box meanwhile wait for its download. Nothing is downloaded once
+    the vagrant boxes take max_size bytes or less than min_free bytes are
+    left on their disk.
+    """
+    def __init__(self, box_store=None, max_size=None, min_free=0):
+        self.box_store = box_store if box_store is not None else BoxStore()
+        self.max_size = max_size
+        self.min_free = min_free
+        self.lock = threading.Lock()
+        self.worker = None
+        self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def from_config(config):
+        """
+        Create the prefetcher from the box_prefetch section of the runner
+        configuration, sizes are in GiB
+        """
+        max_size = config.get('max_size')
+        return BoxPrefetcher(
+            max_size=int(max_size * 1024 ** 3) if max_size else None,
+            min_free=int(config.get('min_free', 0) * 1024 ** 3))
+
+    def fits(self):
+        boxes_dir = self.box_store.boxes_dir
+        if not os.path.isdir(boxes_dir):
+            return True
+        if shutil.disk_usage(boxes_dir).free < self.min_free:
+            return False
+        return self.max_size is None or \
+            directory_size(boxes_dir) < self.max_size
+
+    @staticmethod
+    def missing(wanted):
+        """The missing boxes wanted, by the most jobs first"""
+        boxes = [VagrantBox(name, version) for (name, version), _count in
+                 sorted(wanted.items(), key=lambda item: (-item[1], item[0]))]
+        return [box for box in boxes if not box.exists()]
+
+    def prefetch(self, wanted):
+        """
+        Download the next missing box of wanted, the number of jobs by
+        (name, version) template, unless a download is running
+        """
+        with self.lock:
+            if self.worker is not None and self.worker.is_alive():
+                return
+        stats = self.box_store.statistics()
+        self.logger.info(
+            'Box prefetch: %d hits, %d misses (hit rate %.0f%%), '
+            '%d prefetched boxes unused', stats['hits'], stats['misses'],
+            stats['hit_rate'] * 100, stats['unused'])
+        missing = self.missing(wanted)
+        if not missing:
+            return
+        if not self.fits():
+            self.logger.info('No disk space to prefetch box %s %s',
+                             missing[0].name, missing[0].version)
+            return
+        with self.lock:
+            self.worker = threading.Thread(
+                target=self.download, args=(missing[0],), daemon=True)
+            self.worker.start()
+
+    def download(self, box):
+        self.logger.info('Prefetching box %s %s', box.name, box.version)
+        try:
+            VagrantBoxDownload(box.name, box.version,
+                               box_store=self.box_store, prefetch=True)()
+        except TaskException as exc:
+            self.logger.warning('Failed to prefetch box %s %s: %s',
+                                box.name, box.version, exc)
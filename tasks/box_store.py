@@ -0,0 +1,233 @@
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from .common import TaskException, file_lock
+from . import constants
+
+PART_SUFFIX = '.part'
+PREFETCH_FILE = 'prefetch.json'
+INVENTORY_FILE = 'inventory.json'
+
+
+class BoxStore(object):
+    """
+    Vagrant boxes downloaded from the box catalog once per runner
+
+    Jobs needing the same box version wait for a single download, even
+    across processes. An interrupted download is resumed from where it
+    stopped (HTTP range requests). The box is verified against the
+    checksum of the catalog, extracted aside and moved into the vagrant
+    boxes directory at once, so vagrant never sees a partial box.
+    """
+    PROVIDER_PATH = 'api/v1/box/{name}/version/{version}/provider/{provider}'
+    DOWNLOAD_PATH = '{name}/version/{version}/providers/{provider}.box'
+
+    def __init__(self, base_url=constants.BOX_STORE_URL, root=None,
+                 boxes_dir=None, timeout=constants.BOX_STORE_TIMEOUT,
+                 chunk_size=constants.BOX_STORE_CHUNK_SIZE):
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.root = root if root is not None else constants.BOX_STORE_DIR
+        self.boxes_dir = boxes_dir if boxes_dir is not None \
+            else constants.VAGRANT_BOXES_DIR
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+    def name(self, box):
+        return '{name}_{version}_{provider}'.format(
+            name=box.escaped_name, version=box.version,
+            provider=box.provider)
+
+    def lock(self, box, blocking=True):
+        """Lock of a box version, held while it's downloaded or linked"""
+        os.makedirs(self.root, exist_ok=True)
+        return file_lock(os.path.join(self.root, self.name(box) + '.lock'),
+                         blocking)
+
+    def state_lock(self, state_file):
+        os.makedirs(self.root, exist_ok=True)
+        return file_lock(os.path.join(self.root, state_file + '.lock'))
+
+    def read_state(self, state_file):
+        try:
+            with open(os.path.join(self.root, state_file)) as state_f:
+                return json.load(state_f)
+        except (OSError, IOError, ValueError):
+            return None
+
+    def write_state(self, state_file, state):
+        path = os.path.join(self.root, state_file)
+        with open(path + '.tmp', 'w') as state_f:
+            json.dump(state, state_f)
+        os.rename(path + '.tmp', path)
+
+    def touch(self, box):
+        """Record the use of a box by a job, or its download"""
+        with self.state_lock(INVENTORY_FILE):
+            inventory = self.read_state(INVENTORY_FILE) or {}
+            inventory[self.name(box)] = time.time()
+            self.write_state(INVENTORY_FILE, inventory)
+
+    def last_used(self):
+        """The time of the last use of the boxes, by name (see name())"""
+        with self.state_lock(INVENTORY_FILE):
+            return self.read_state(INVENTORY_FILE) or {}
+
+    def forget(self, box):
+        with self.state_lock(INVENTORY_FILE):
+            inventory = self.read_state(INVENTORY_FILE) or {}
+            if inventory.pop(self.name(box), None) is not None:
+                self.write_state(INVENTORY_FILE, inventory)
+
+    def read_stats(self):
+        return self.read_state(PREFETCH_FILE) or dict(
+            prefetched=[], hits=0, misses=0)
+
+    def prefetched(self, box):
+        """Record a box downloaded ahead of the jobs needing it"""
+        with self.state_lock(PREFETCH_FILE):
+            stats = self.read_stats()
+            if self.name(box) not in stats['prefetched']:
+                stats['prefetched'].append(self.name(box))
+                self.write_state(PREFETCH_FILE, stats)
+
+    def record_use(self, box, present):
+        """
+        Record a job needing a box: a prefetch hit if it was prefetched,
+        a miss if the job has to download it
+        """
+        with self.state_lock(PREFETCH_FILE):
+            stats = self.read_stats()
+            if not present:
+                stats['misses'] += 1
+            elif self.name(box) in stats['prefetched']:
+                stats['prefetched'].remove(self.name(box))
+                stats['hits'] += 1
+            else:
+                return
+            self.write_state(PREFETCH_FILE, stats)
+
+    def statistics(self):
+        with self.state_lock(PREFETCH_FILE):
+            stats = self.read_stats()
+        uses = stats['hits'] + stats['misses']
+        return dict(hits=stats['hits'], misses=stats['misses'],
+                    hit_rate=stats['hits'] / uses if uses else 0.0,
+                    unused=len(stats['prefetched']))
+
+    def directory(self, box):
+        """Directory of the box in the vagrant boxes directory"""
+        return os.path.join(self.boxes_dir, box.escaped_name, box.version,
+                            box.provider)
+
+    def source(self, box):
+        """The download URL and the (checksum type, checksum) of a box"""
+        keys = dict(name=box.name, version=box.version, provider=box.provider)
+        with urllib.request.urlopen(
+                urllib.parse.urljoin(
+                    self.base_url, self.PROVIDER_PATH.format(**keys)),
+                timeout=self.timeout) as response:
+            provider = json.loads(response.read().decode('utf-8'))
+        url = provider.get('download_url') or provider.get('url') or \
+            urllib.parse.urljoin(self.base_url,
+                                 self.DOWNLOAD_PATH.format(**keys))
+        return url, (provider.get('checksum_type'), provider.get('checksum'))
+
+    def download(self, task, url, path):
+        """Download url to path, resuming the part already there"""
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes={offset}-'.format(
+                offset=offset))
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as exc:
+            if exc.code == 416:
+                # Nothing left to download
+                return
+            raise
+        with response:
+            if offset and response.status == 206:
+                task.logger.info('Resuming download of {url} at {size} MiB'
+                                 .format(url=url, size=offset // 1024 ** 2))
+                mode = 'ab'
+            else:
+                offset = 0
+                mode = 'wb'
+            length = response.headers.get('Content-Length')
+            with open(path, mode) as box_f:
+                shutil.copyfileobj(response, box_f, self.chunk_size)
+        if length is not None and \
+                os.path.getsize(path) < offset + int(length):
+            # The next download resumes from there
+            raise TaskException(task, 'Incomplete download of {url}'.format(
+                url=url))
+
+    @staticmethod
+    def verify(task, path, checksum):
+        checksum_type, expected = checksum
+        if not checksum_type or not expected:
+            task.logger.warning('No checksum of {path} to verify'.format(
+                path=os.path.basename(path)))
+            return
+        digest = hashlib.new(checksum_type)
+        with open(path, 'rb') as box_f:
+            for chunk in iter(lambda: box_f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        if digest.hexdigest() != expected.lower():
+            os.remove(path)
+            raise TaskException(task, 'Checksum mismatch of {path}'.format(
+                path=os.path.basename(path)))
+
+    def extract(self, task, path, directory):
+        """Extract the box archive at path into directory, atomically"""
+        tmp_path = directory + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        try:
+            with tarfile.open(path, 'r:*') as box_tar:
+                for member in box_tar.getmembers():
+                    member_path = os.path.normpath(member.name)
+                    if member_path.startswith(('..', '/')) or not (
+                            member.isfile() or member.isdir()):
+                        raise TaskException(
+                            task, 'Invalid box member {name}'.format(
+                                name=member.name))
+                box_tar.extractall(tmp_path)
+            os.rename(tmp_path, directory)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    def fetch(self, task, box):
+        """
+        Download, verify and install a box into the vagrant boxes
+        directory, the caller holds the lock of the box
+        """
+        directory = self.directory(box)
+        if os.path.isdir(directory):
+            return
+        start = time.time()
+        url, checksum = self.source(box)
+        part = os.path.join(self.root, self.name(box) + PART_SUFFIX)
+        self.download(task, url, part)
+        self.verify(task, part, checksum)
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        self.extract(task, part, directory)
+        with open(os.path.join(self.boxes_dir, box.escaped_name,
+                               'metadata_url'), 'w') as metadata_f:
+            metadata_f.write(urllib.parse.urljoin(self.base_url, box.name))
+        size = os.path.getsize(part)
+        os.remove(part)
+        task.logger.info(
+            'Downloaded box {name} {version} ({size} MiB) in {time:.1f}s'
+            .format(name=box.name, version=box.version,
+                    size=size // 1024 ** 2, time=time.time() - start))
+
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from .common import FallibleTask, PopenTask, TaskException
+from . import constants
+
+
+def playbook_version():
+    """Digest of the playbooks and roles that make a build"""
+    digest = hashlib.sha256()
+    paths = list(constants.BUILD_PLAYBOOK_FILES)
+    for root in constants.BUILD_PLAYBOOK_DIRS:
+        for dirpath, dirs, files in os.walk(root):
+            dirs.sort()
+            paths.extend(os.path.join(dirpath, name) for name in sorted(files))
+    for path in paths:
+        digest.update(os.path.relpath(path, constants.BASE_DIR).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def cache_key(tree, template, playbook):
+    key = json.dumps(dict(
+        tree=tree, template=template['name'],
+        template_version=template['version'], playbook=playbook),
+        sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class GitTree(FallibleTask):
+    """
+    Resolve the git tree SHA of a ref of a remote repository
+
+    The commit is fetched (shallow) into a bare repository kept in
+    cache_dir, so consecutive fetches of the same repository are cheap.
+    """
+    def __init__(self, repo, ref, cache_dir=constants.GIT_CACHE_DIR,
+                 **kwargs):
+        super(GitTree, self).__init__(**kwargs)
+        self.repo = repo
+        self.ref = ref
+        self.cache_dir = cache_dir
+        self.tree = None
+
+    def git(self, *args, **kwargs):
+        return PopenTask(['git', '--git-dir', self.cache_dir] + list(args),
+                         **kwargs)
+
+    def _run(self):
+        if not os.path.isdir(self.cache_dir):
+            self.execute_subtask(
+                PopenTask(['git', 'init', '--bare', '-q', self.cache_dir]))
+        self.execute_subtask(
+            self.git('fetch', '-q', '--depth=1', self.repo, self.ref,
+                     timeout=None))
+        rev_parse = self.git('rev-parse', 'FETCH_HEAD^{tree}',
+                             capture_output=True)
+        self.execute_subtask(rev_parse)
+        self.tree = rev_parse.output[0]
+
+
+class BuildCache(object):
+    """
+    Index of successful builds in the artifact storage
+
+    Entries are keyed by cache_key() and point to the published job of the
+    build. An entry is invalid once it's older than max_age (seconds), or
+    when the repository of its job is gone from the storage.
+    """
+    def __init__(self, storage, max_age=constants.BUILD_CACHE_MAX_AGE):
+        self.storage = storage
+        self.max_age = max_age
+
+    @staticmethod
+    def entry_key(key):
+        return constants.BUILD_CACHE_KEY.format(key=key)
+
+    def lookup(self, task, key):
+        """The entry of a valid cached build, None if there's none"""
+        data = self.storage.read_key(task, self.entry_key(key))
+        if data is None:
+            return None
+        try:
+            entry = json.loads(data.decode('utf-8'))
+        except ValueError:
+            task.logger.warning('Invalid build cache entry %s', key)
+            return None
+        if time.time() - entry['time'] > self.max_age:
+            task.logger.info('Cached build %s expired', entry['uuid'])
+            return None
+        repomd = constants.ARTIFACT_JOB_KEY.format(
+            uuid=entry['uuid'], path='rpms/repodata/repomd.xml')
+        if self.storage.missing_keys(task, [repomd]):
+            task.logger.info('Cached build %s was removed', entry['uuid'])
+            return None
+        return entry
+
+    def record(self, task, key, uuid, url, description):
+        entry = dict(uuid=uuid, url=url, description=description,
+                     time=time.time())
+        with tempfile.NamedTemporaryFile('w', dir=constants.JOBS_DIR,
+                                         suffix='.json') as entry_f:
+            json.dump(entry, entry_f)
+            entry_f.flush()
+            self.storage.put_files(task, [(self.entry_key(key), entry_f.name)])
+        return entry
+
+
+def resolve_cache_key(task, template, repo, ref):
+    """The build cache key of a build of ref, None if it can't be resolved"""
+    tree = GitTree(repo, ref)
+    try:
+        task.execute_subtask(tree)
+    except TaskException as exc:
+        task.logger.warning('Failed to resolve the source tree: %s', exc)
+        return None
+    return cache_key(tree.tree, template, playbook_version())
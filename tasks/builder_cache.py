@@ -0,0 +1,113 @@
+import collections
+import fnmatch
+import os
+
+from . import constants
+
+# Indexes of the ccache statistics counters (same in ccache 3 and 4)
+CCACHE_MISS = 4
+CCACHE_PREPROCESSED_HIT = 8
+CCACHE_DIRECT_HIT = 22
+
+CacheSnapshot = collections.namedtuple(
+    'CacheSnapshot', 'ccache root_caches packages')
+
+
+def find_files(root, pattern):
+    for dirpath, _dirs, files in os.walk(root):
+        for name in fnmatch.filter(files, pattern):
+            yield os.path.join(dirpath, name)
+
+
+def read_ccache_stats(path):
+    try:
+        with open(path) as stats_f:
+            return [int(value) for value in stats_f.read().split()]
+    except (OSError, IOError, ValueError):
+        return []
+
+
+class BuilderCache(object):
+    """
+    Mock caches of the builder VM, kept on the runner host.
+
+    The directory is mounted in the builder VM and used as the mock
+    cache_topdir, it holds the root cache (tarball of the buildroot), the
+    dnf package cache and the ccache of every mock root. ccache evicts
+    files beyond ccache_size on its own, packages beyond dnf_cache_size
+    (bytes) are removed by trim(), least recently used first.
+    """
+    def __init__(self, path=constants.BUILDER_CACHE_DIR,
+                 ccache_size=constants.BUILDER_CCACHE_SIZE,
+                 dnf_cache_size=constants.BUILDER_DNF_CACHE_SIZE):
+        self.path = path
+        self.ccache_size = ccache_size
+        self.dnf_cache_size = dnf_cache_size
+
+    def prepare(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def packages(self):
+        packages = {}
+        for path in find_files(self.path, '*.rpm'):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            packages[path] = stat
+        return packages
+
+    def trim(self, logger):
+        packages = self.packages()
+        size = sum(stat.st_size for stat in packages.values())
+        removed = 0
+        for path, stat in sorted(
+                packages.items(),
+                key=lambda item: max(item[1].st_atime, item[1].st_mtime)):
+            if size <= self.dnf_cache_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= stat.st_size
+            removed += 1
+        if removed:
+            logger.info('Removed {n} packages from the dnf cache'.format(
+                n=removed))
+
+    def snapshot(self):
+        ccache = collections.Counter()
+        for path in find_files(self.path, 'stats'):
+            if '{sep}ccache{sep}'.format(sep=os.sep) not in path:
+                continue
+            for index, value in enumerate(read_ccache_stats(path)):
+                ccache[index] += value
+        root_caches = {
+            path: os.stat(path).st_mtime
+            for path in find_files(self.path, 'cache.tar*')}
+        return CacheSnapshot(ccache, root_caches, self.packages())
+
+    def report(self, before, after, logger):
+        """Log the hit rates of the caches between two snapshots"""
+        ccache = after.ccache - before.ccache
+        hits = (ccache[CCACHE_DIRECT_HIT] +
+                ccache[CCACHE_PREPROCESSED_HIT])
+        calls = hits + ccache[CCACHE_MISS]
+        if calls:
+            logger.info('ccache: {hits}/{calls} hits ({rate:.0%})'.format(
+                hits=hits, calls=calls, rate=hits / calls))
+
+        reused = [path for path, mtime in after.root_caches.items()
+                  if before.root_caches.get(path) == mtime]
+        logger.info('mock root cache: {result}'.format(
+            result='hit' if reused else 'miss'))
+
+        downloaded = set(after.packages) - set(before.packages)
+        logger.info(
+            'dnf cache: {new} packages ({size} MiB) downloaded, '
+            '{cached} cached'.format(
+                new=len(downloaded),
+                size=sum(after.packages[path].st_size
+                         for path in downloaded) // 1024 ** 2,
+                cached=len(before.packages)))
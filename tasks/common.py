@@ -1,17 +1,21 @@
 import abc
 import collections
+import contextlib
 import errno
+import fcntl
+import gzip
 import jinja2
 import logging
 import os
 import psutil
 import subprocess
 import threading
+import time
 
 from . import constants
+from .tracing import OUTCOME_ERROR, OUTCOME_OK, OUTCOME_TIMEOUT
 
 
-LOG_FILE_HANDLER = None
 LOG_FORMAT = '%(asctime)-15s %(levelname)8s  %(message)s'
 
 
@@ -46,8 +50,13 @@ class PopenException(TaskException):
 class Task(collections.Callable):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, timeout=120):
+    def __init__(self, timeout=120, cwd=None, logger=None):
         self.timeout = timeout
+        self.cwd = cwd
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.tracer = None
+        self.span = None
+        self.parent_span = None
         self.tasks = []
         self.exc = None
 
@@ -58,7 +67,16 @@ class Task(collections.Callable):
         This is needed to make sure the timeout works properly. If you run
         the task directly and the timeout mechanic is triggered, it won't be
         able to kill the child process and the timeout won't work properly.
+
+        The child task also inherits the job context (working directory,
+        logger and tracer) of its parent, unless it has its own working
+        directory.
         """
+        if task.cwd is None:
+            task.cwd = self.cwd
+        task.logger = self.logger
+        task.tracer = self.tracer
+        task.parent_span = self.span
         self.tasks.append(task)
         task()
 
@@ -91,8 +109,7 @@ class Task(collections.Callable):
         except Exception as exc:
             self.exc = exc
 
-    def __call__(self):
-        logging.info('Executing: {task}'.format(task=self))
+    def __execute(self):
         thread = threading.Thread(target=self.__target)
         thread.start()
         thread.join(self.timeout)
@@ -104,6 +121,24 @@ class Task(collections.Callable):
             # Re-raise exception from other thread
             raise self.exc
 
+    def __call__(self):
+        self.logger.info('Executing: {task}'.format(task=self))
+        if self.tracer is None:
+            self.__execute()
+            return
+
+        self.span = self.tracer.start(self, self.parent_span)
+        try:
+            self.__execute()
+        except Exception as exc:
+            if isinstance(exc, TimeoutException) and exc.task is self:
+                self.span.finish(OUTCOME_TIMEOUT, exc)
+            else:
+                self.span.finish(OUTCOME_ERROR, exc)
+            raise exc
+        else:
+            self.span.finish(OUTCOME_OK)
+
     def __str__(self):
         return type(self).__name__
 
@@ -118,18 +153,25 @@ class FallibleTask(Task):
             super(FallibleTask, self).__call__()
         except Exception as exc:
             if self.raise_on_err:
-                logging.debug(exc, exc_info=True)
+                self.logger.debug(exc, exc_info=True)
                 raise exc
             else:
-                logging.warning(exc, exc_info=True)
+                self.logger.warning(exc, exc_info=True)
 
 
 class PopenTask(FallibleTask):
-    def __init__(self, cmd, shell=False, env=None, **kwargs):
+    def __init__(self, cmd, shell=False, env=None, capture_output=False,
+                 **kwargs):
+        """
+        capture_output: if True, the output lines are collected in
+                        self.output instead of being logged
+        """
         super(PopenTask, self).__init__(**kwargs)
         self.cmd = cmd
         self.shell = shell
         self.env = env
+        self.capture_output = capture_output
+        self.output = []
         self.process = None
         self.returncode = None
         if self.env is not None:
@@ -141,11 +183,16 @@ class PopenTask(FallibleTask):
             self.cmd,
             shell=self.shell,
             env=self.env,
+            cwd=self.cwd,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT)
 
         for line in iter(self.process.stdout.readline, b''):
-            logging.debug(line.decode('utf-8').rstrip('\n'))
+            line = line.decode('utf-8').rstrip('\n')
+            if self.capture_output:
+                self.output.append(line)
+            else:
+                self.logger.debug(line)
 
         self.process.wait()
         self.returncode = self.process.returncode
@@ -182,6 +229,75 @@ class PopenTask(FallibleTask):
         return 'Process "{cmd}"'.format(cmd=cmd)
 
 
+class GzipFileHandler(logging.Handler):
+    """
+    Handler writing log records into a gzip compressed file.
+
+    The compressed stream is sync flushed at most every flush_interval
+    seconds, by a background thread once the log goes quiet, and on sync().
+    Until the handler is closed the file has no gzip trailer: it can't be
+    read by gzip -t, zcat or gzip.open(), only by a raw zlib decompressor
+    (zlib.decompressobj(16 + zlib.MAX_WBITS)), up to the last flush.
+    """
+    terminator = '\n'
+
+    def __init__(self, path, compresslevel=constants.GZIP_LEVEL,
+                 flush_interval=constants.LOG_FLUSH_INTERVAL):
+        super(GzipFileHandler, self).__init__()
+        self.gzip_file = gzip.open(path, 'wb', compresslevel=compresslevel)
+        self.flush_interval = flush_interval
+        self.last_sync = time.time()
+        self.dirty = False
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target=self.sync_periodically,
+                                      daemon=True)
+        self.timer.start()
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + self.terminator
+            self.acquire()
+            try:
+                self.gzip_file.write(msg.encode('utf-8'))
+                self.dirty = True
+            finally:
+                self.release()
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        if time.time() - self.last_sync >= self.flush_interval:
+            self.sync()
+
+    def sync(self):
+        self.acquire()
+        try:
+            if self.gzip_file is not None and self.dirty:
+                self.gzip_file.flush()
+                self.dirty = False
+            self.last_sync = time.time()
+        finally:
+            self.release()
+
+    def sync_periodically(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.closed.set()
+        if self.timer is not threading.current_thread():
+            self.timer.join()
+        self.acquire()
+        try:
+            if self.gzip_file is not None:
+                self.gzip_file.close()
+                self.gzip_file = None
+        finally:
+            self.release()
+        super(GzipFileHandler, self).close()
+
+
 def logging_init_stream_handler(noout=False):
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
@@ -194,16 +310,34 @@ def logging_init_stream_handler(noout=False):
     logger.addHandler(ch)
 
 
-def logging_init_file_handler():
-    global LOG_FILE_HANDLER
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    fh = logging.FileHandler(constants.RUNNER_LOG, mode='w')
+def logging_init_job_logger(name, path, compress=False):
+    """
+    Create a logger for a single job, writing into the file at path.
+
+    The logger propagates to the root logger, so stream handlers still see
+    the job output, but it isn't registered in the logging module. Once
+    closed by logging_close_job_logger() nothing of it is kept around.
+
+    compress: if True, the log is written through a GzipFileHandler to
+              path with a .gz suffix
+    """
+    logger = logging.Logger(name, level=logging.DEBUG)
+    logger.parent = logging.getLogger()
+    if compress:
+        fh = GzipFileHandler(path + '.gz')
+    else:
+        fh = logging.FileHandler(path, mode='w')
     fh.setLevel(logging.DEBUG)
     formatter = logging.Formatter(LOG_FORMAT)
     fh.setFormatter(formatter)
     logger.addHandler(fh)
-    LOG_FILE_HANDLER = fh
+    return logger
+
+
+def logging_close_job_logger(logger):
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
 
 
 def create_file_from_template(template_path, dest, data):
@@ -214,3 +348,22 @@ def create_file_from_template(template_path, dest, data):
 
     with open(dest, "w") as fh:
         fh.write(rendered_template)
+
+
+@contextlib.contextmanager
+def file_lock(path, blocking=True):
+    """
+    Hold an exclusive lock on path, shared by the threads and processes
+    of the host. Yields False if blocking is False and the lock is taken.
+    """
+    with open(path, 'a') as lock_f:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_f, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
@@ -6,7 +6,9 @@ TEMPLATES_DIR = os.path.join(BASE_DIR, 'templates')
 JOBS_DIR = os.path.join(BASE_DIR, 'jobs')
 
 FEDORAPEOPLE_KEY_PATH = '/root/.ssh/freeipa_pr_ci'
-FEDORAPEOPLE_DIR = 'ipa-maint@fedorapeople.org:/srv/groups/freeipa/prci/{path}'
+FEDORAPEOPLE_HOST = 'ipa-maint@fedorapeople.org'
+FEDORAPEOPLE_ROOT = '/srv/groups/freeipa/prci'
+FEDORAPEOPLE_DIR = FEDORAPEOPLE_HOST + ':' + FEDORAPEOPLE_ROOT + '/{path}'
 FEDORAPEOPLE_BASE_URL = 'https://fedorapeople.org/groups/freeipa/prci/'
 FEDORAPEOPLE_JOBS_URL = urllib.parse.urljoin(FEDORAPEOPLE_BASE_URL, 'jobs/')
 
@@ -16,23 +18,127 @@ BUILD_FAILED_DESCRIPTION = "(✖╭╮✖)"
 UUID_RE = '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
 
 RUNNER_LOG = 'runner.log'
+TRACE_FILE = 'trace.json'
+TRACE_SUMMARY_FILE = 'trace_summary.json'
+TRACE_URL_FRAGMENT = '#trace={trace_id}'
+RESOURCES_FILE = 'resources.csv'
+MANIFEST_FILE = 'manifest.json'
+UPLOADED_FILE = '.uploaded'
 FREEIPA_PRCI_REPOFILE = 'freeipa-prci.repo'
 ANSIBLE_VARS_TEMPLATE = '{action_name}.vars.yml'
 VAGRANTFILE_TEMPLATE = os.path.join('vagrantfiles', 'Vagrantfile.{vagrantfile_name}')
-VAGRANT_IMAGE_PATH = '/root/.vagrant.d/boxes/{name}/{version}/{provider}/box.img'
-LIBVIRT_IMAGE_PATH = '/var/lib/libvirt/images/{libvirt_name}_{version}.img'
+VAGRANT_BOXES_DIR = '/root/.vagrant.d/boxes'
+VAGRANT_IMAGE_PATH = VAGRANT_BOXES_DIR + '/{name}/{version}/{provider}/box.img'
+LIBVIRT_IMAGES_DIR = '/var/lib/libvirt/images'
+LIBVIRT_IMAGE_PATH = LIBVIRT_IMAGES_DIR + '/{libvirt_name}_{version}.img'
 
 ANSIBLE_CFG_FILE = os.path.join(TEMPLATES_DIR, 'ansible.cfg')
 
 POPEN_TERM_TIMEOUT = 10
 BUILD_TIMEOUT = 30*60
 RUN_PYTEST_TIMEOUT = 90*60
+RESOURCE_SAMPLE_INTERVAL = 10
+
+# Log compression
+GZIP_LEVEL = 6
+GZIP_MIN_SIZE = 512
+GZIP_CHUNK_SIZE = 1024 * 1024
+LOG_FLUSH_INTERVAL = 5
+
+# Artifact storage, blobs are stored by their sha256 digest
+ARTIFACT_BLOBS_DIR = 'blobs'
+ARTIFACT_BLOB_KEY = ARTIFACT_BLOBS_DIR + '/{digest_prefix}/{digest}'
+ARTIFACT_JOB_KEY = 'jobs/{uuid}/{path}'
+ARTIFACT_UPLOAD_TIMEOUT = 5*60
+S3_CONCURRENCY = 8
+S3_PART_SIZE = 8 * 1024 * 1024
+S3_REQUEST_TIMEOUT = 60
+S3_PRUNE_MIN_AGE = 24*60*60
+UPLOAD_QUEUE_DIR = os.path.join(BASE_DIR, 'upload_queue')
 
 # Topologies
 DEFAULT_TOPOLOGY = 'master_1repl'
+# Vagrantfile of the topologies generated from a spec
+GENERATED_TOPOLOGY = 'topology'
 
 # Playbooks
 ANSIBLE_PLAYBOOK_DIR = os.path.join(BASE_DIR, 'ansible')
 ANSIBLE_PLAYBOOK_BUILD = os.path.join(ANSIBLE_PLAYBOOK_DIR, 'build.yml')
 ANSIBLE_PLAYBOOK_COLLECT_BUILD = os.path.join(ANSIBLE_PLAYBOOK_DIR,
                                               'collect_build.yml')
+
+# Build cache, builds are looked up by the source tree, template and the
+# version of the files below
+BUILD_PLAYBOOK_FILES = (ANSIBLE_PLAYBOOK_BUILD, ANSIBLE_PLAYBOOK_COLLECT_BUILD)
+BUILD_PLAYBOOK_DIRS = (os.path.join(ANSIBLE_PLAYBOOK_DIR, 'roles', 'builder'),)
+BUILD_CACHE_KEY = 'build-cache/{key}.json'
+BUILD_CACHE_MAX_AGE = 14*24*60*60
+GIT_CACHE_DIR = os.path.join(BASE_DIR, 'git_cache')
+
+# Persistent mock caches of the builder VM
+BUILDER_CACHE_DIR = os.path.join(BASE_DIR, 'builder_cache')
+BUILDER_CACHE_MOUNT = '/var/cache/prci'
+BUILDER_CCACHE_SIZE = '4G'
+BUILDER_DNF_CACHE_SIZE = 4 * 1024 ** 3
+
+# Metadata of the previous yum repositories, reused by createrepo
+CREATEREPO_CACHE_DIR = os.path.join(BASE_DIR, 'createrepo_cache')
+CREATEREPO_CACHE_MAX_AGE = 14*24*60*60
+
+# Runner-local mirror of the build repositories
+MIRROR_DIR = os.path.join(BASE_DIR, 'mirror')
+MIRROR_MAX_AGE = 2*24*60*60
+MIRROR_CONCURRENCY = 4
+MIRROR_REQUEST_TIMEOUT = 60
+
+# Caching proxy of the package repositories for the VMs
+PACKAGE_PROXY_DIR = os.path.join(BASE_DIR, 'package_cache')
+PACKAGE_PROXY_MAX_SIZE = 20 * 1024 ** 3
+PACKAGE_PROXY_PORT = 8182
+PACKAGE_PROXY_TIMEOUT = 60
+
+# Pool of pre-booted VMs
+VM_POOL_DIR = os.path.join(BASE_DIR, 'vm_pool')
+VM_POOL_SNAPSHOT = 'prci-booted'
+VM_POOL_MAX_SLOTS = 2
+VM_POOL_MIN_FREE_MEMORY = 8 * 1024 ** 3
+VM_POOL_MAX_IDLE = 6*60*60
+VM_POOL_DEMAND_WINDOW = 6*60*60
+# VMs with an installed IPA server
+VM_POOL_CHECKPOINT = 'prci-ipa-installed'
+VM_POOL_MAX_CHECKPOINTS = 4
+VM_POOL_CHECKPOINT_MAX_IDLE = 24*60*60
+# Attempts to recreate a machine failing to come up or to be provisioned
+VAGRANT_MACHINE_RETRIES = 1
+# vagrant-libvirt defaults of the VMs
+VAGRANT_DEFAULT_CPUS = 1
+VAGRANT_DEFAULT_MEMORY = 512
+# Relative to the vagrant environment, as in templates/ansible.cfg
+ANSIBLE_RETRY_DIR = os.path.join('.vagrant', 'ansible-retry')
+ANSIBLE_FACT_CACHE_DIR = os.path.join('.vagrant', 'ansible-facts')
+
+# Checks the server of resumed VMs, and that they see the job directory
+IPA_HEALTH_CHECK = ('test -r /vagrant/ipa-test-config.yaml && '
+                    'ipactl status && echo Secret.123 | kinit admin && '
+                    'ipa ping && kdestroy')
+IPA_HEALTH_CHECK_TIMEOUT = 5*60
+
+# Disks of provisioned VMs, readable by qemu
+OVERLAY_DIR = os.path.join(LIBVIRT_IMAGES_DIR, 'prci-overlays')
+OVERLAY_MAX_ENTRIES = 10
+OVERLAY_MAX_AGE = 3*24*60*60
+OVERLAY_HOLD_TIMEOUT = 24*60*60
+
+# Downloads of vagrant boxes
+BOX_STORE_URL = 'https://vagrantcloud.com/'
+BOX_STORE_DIR = os.path.join(BASE_DIR, 'box_downloads')
+BOX_STORE_TIMEOUT = 60
+BOX_STORE_CHUNK_SIZE = 1024 * 1024
+# Boxes used more recently are never removed to make room
+BOX_GC_MIN_IDLE = 24*60*60
+
+# Destruction of the VMs of finished jobs in the background
+TEARDOWN_WORKERS = 2
+TEARDOWN_RETRIES = 3
+TEARDOWN_BACKOFF = 60
+TEARDOWN_TIMEOUT = 10*60
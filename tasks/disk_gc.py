@@ -0,0 +1,170 @@
+import logging
+import os
+import re
+import shutil
+import time
+
+from . import constants
+
+GiB = 1024 ** 3
+
+
+def directory_size(path):
+    """Disk space used by the files in a directory tree"""
+    size = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue  # removed meanwhile
+            size += stat.st_blocks * 512
+    return size
+
+
+class JobDir(object):
+    def __init__(self, path):
+        self.path = path
+        self.uuid = os.path.basename(path)
+        stat = os.stat(path)
+        self.last_used = max(stat.st_atime, stat.st_mtime)
+        self.uploaded = os.path.exists(
+            os.path.join(path, constants.UPLOADED_FILE))
+        self.size = directory_size(path)
+
+
+class DiskGarbageCollector(object):
+    """
+    Keeps the job directories and box images within a disk budget.
+
+    The job directories and the images in the libvirt images directory
+    count towards budget (bytes). Only the job directories whose artifacts
+    are uploaded are removed: the ones older than max_age (seconds) first,
+    then the least recently used ones, until the usage fits the budget and
+    min_free bytes are left free on the disk.
+
+    A task is admitted only if reserve more bytes fit, so no job starts
+    on a nearly full disk. The disk usage is measured once until reset(),
+    i.e. once per scan of the tasks and after every job.
+
+    is_pending: called with the UUID of a job, True if its upload is still
+                pending (e.g. in an upload queue)
+    boxes: the BoxInventory of the unused boxes removed when removing the
+           jobs isn't enough
+    """
+    def __init__(self, budget, min_free=0, reserve=0, max_age=None,
+                 jobs_dir=None, images_dir=constants.LIBVIRT_IMAGES_DIR,
+                 is_pending=None, boxes=None):
+        self.budget = budget
+        self.min_free = min_free
+        self.reserve = reserve
+        self.max_age = max_age
+        self.jobs_dir = jobs_dir if jobs_dir is not None else \
+            constants.JOBS_DIR
+        self.images_dir = images_dir
+        self.is_pending = is_pending
+        self.boxes = boxes
+        self.admitted = None
+        self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def from_config(config, upload_queue=None, boxes=None):
+        """
+        Create the collector from the disk_gc section of the runner
+        configuration, sizes are in GiB and max_age in days
+        """
+        max_age = config.get('max_age')
+        return DiskGarbageCollector(
+            budget=int(config['budget'] * GiB),
+            min_free=int(config.get('min_free', 0) * GiB),
+            reserve=int(config.get('reserve', 0) * GiB),
+            max_age=max_age * 24 * 60 * 60 if max_age else None,
+            images_dir=config.get('images_dir', constants.LIBVIRT_IMAGES_DIR),
+            is_pending=(upload_queue.__contains__
+                        if upload_queue is not None else None),
+            boxes=boxes if config.get('boxes') else None)
+
+    def job_dirs(self):
+        jobs = []
+        try:
+            names = os.listdir(self.jobs_dir)
+        except OSError:
+            return jobs
+        for name in names:
+            path = os.path.join(self.jobs_dir, name)
+            if not re.match(constants.UUID_RE + '$', name):
+                continue
+            try:
+                jobs.append(JobDir(path))
+            except OSError:
+                continue
+        return jobs
+
+    def images_size(self):
+        """The images, the overlay store and the VM pool disks included"""
+        return directory_size(self.images_dir)
+
+    def free_space(self):
+        stat = os.statvfs(self.jobs_dir)
+        return stat.f_bavail * stat.f_frsize
+
+    def evictable(self, jobs):
+        """Uploaded jobs in the order they're evicted"""
+        jobs = [job for job in jobs if job.uploaded and not (
+            self.is_pending is not None and self.is_pending(job.uuid))]
+        now = time.time()
+
+        def expired(job):
+            return (self.max_age is not None and
+                    now - job.last_used > self.max_age)
+
+        return sorted(jobs, key=lambda job: (not expired(job), job.last_used))
+
+    def remove(self, job):
+        self.logger.info('Removing job %s (%d MiB, %s)', job.uuid,
+                         job.size // 1024 ** 2,
+                         time.ctime(job.last_used))
+        shutil.rmtree(job.path, ignore_errors=True)
+
+    def collect(self, reserve=0):
+        """
+        Remove expired jobs, then the least recently used ones until there's
+        room for reserve more bytes. Returns the bytes in excess left.
+        """
+        jobs = self.job_dirs()
+        usage = sum(job.size for job in jobs) + self.images_size()
+        free = self.free_space()
+        now = time.time()
+        for job in self.evictable(jobs):
+            excess = max(usage + reserve - self.budget,
+                         self.min_free + reserve - free)
+            expired = (self.max_age is not None and
+                       now - job.last_used > self.max_age)
+            if excess <= 0 and not expired:
+                break
+            self.remove(job)
+            usage -= job.size
+            free += job.size
+        excess = max(0, usage + reserve - self.budget,
+                     self.min_free + reserve - free)
+        if excess and self.boxes is not None and self.boxes.evict(excess):
+            usage = sum(job.size for job in self.job_dirs()) + \
+                self.images_size()
+            free = self.free_space()
+            excess = max(0, usage + reserve - self.budget,
+                         self.min_free + reserve - free)
+        return excess
+
+    def admit(self):
+        """Make room for a task, False if there isn't enough"""
+        if self.admitted is None:
+            excess = self.collect(self.reserve)
+            if excess:
+                self.logger.warning(
+                    'Disk budget exceeded by %d MiB', excess // 1024 ** 2)
+            self.admitted = not excess
+        return self.admitted
+
+    def reset(self):
+        """Measure the disk usage again on the next admit()"""
+        self.admitted = None
@@ -0,0 +1,128 @@
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+import urllib.parse
+import urllib.request
+
+from .artifacts import HASH_CHUNK_SIZE
+from .common import TaskException, create_file_from_template, file_lock
+from . import constants
+
+
+class ArtifactMirror(object):
+    """
+    Runner-local copy of the yum repositories of published builds
+
+    The RPMs of a build are fetched once, according to the manifest of its
+    job, and verified against their sha256 digest. Jobs of the runner
+    fetching the same build at once wait for a single download, even
+    across processes. The mirror directory is served over HTTP at base_url
+    (see the runner role), the repo file of a mirrored build points there.
+
+    Builds not used for max_age (seconds) are removed.
+    """
+    def __init__(self, base_url, root=constants.MIRROR_DIR,
+                 max_age=constants.MIRROR_MAX_AGE,
+                 concurrency=constants.MIRROR_CONCURRENCY):
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.root = root
+        self.max_age = max_age
+        self.concurrency = concurrency
+
+    @staticmethod
+    def entry_name(build_url):
+        return hashlib.sha256(build_url.encode('utf-8')).hexdigest()[:16]
+
+    def url(self, build_url):
+        return urllib.parse.urljoin(
+            self.base_url, self.entry_name(build_url) + '/')
+
+    def fetch(self, task, build_url):
+        """Mirror the build published at build_url, returns its local URL"""
+        os.makedirs(self.root, exist_ok=True)
+        name = self.entry_name(build_url)
+        path = os.path.join(self.root, name)
+        with file_lock(path + '.lock'):
+            if os.path.isdir(path):
+                task.logger.info('Build {url} is mirrored already'.format(
+                    url=build_url))
+                os.utime(path)
+            else:
+                self.download(task, build_url, path)
+        self.prune(task)
+        return self.url(build_url)
+
+    def download(self, task, build_url, path):
+        start = time.time()
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        with urllib.request.urlopen(
+                urllib.parse.urljoin(build_url, constants.MANIFEST_FILE),
+                timeout=constants.MIRROR_REQUEST_TIMEOUT) as response:
+            files = json.loads(response.read().decode('utf-8'))['files']
+        rpms = {rel_path: entry for rel_path, entry in files.items()
+                if rel_path.startswith('rpms/') and
+                not rel_path.endswith(constants.FREEIPA_PRCI_REPOFILE)}
+        if not rpms:
+            raise TaskException(task, 'No repository in {url}'.format(
+                url=build_url))
+
+        def fetch_file(item):
+            rel_path, entry = item
+            self.fetch_file(task, urllib.parse.urljoin(build_url, rel_path),
+                            os.path.join(tmp_path, rel_path), entry['sha256'])
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    self.concurrency) as executor:
+                list(executor.map(fetch_file, sorted(rpms.items())))
+            create_file_from_template(
+                constants.FREEIPA_PRCI_REPOFILE,
+                os.path.join(tmp_path, 'rpms',
+                             constants.FREEIPA_PRCI_REPOFILE),
+                dict(job_url=self.url(build_url).rstrip('/')))
+            os.rename(tmp_path, path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        task.logger.info(
+            'Mirrored {files} files ({size} MiB) of {url} in {time:.1f}s'
+            .format(files=len(rpms), url=build_url,
+                    size=sum(e['size'] for e in rpms.values()) // 1024 ** 2,
+                    time=time.time() - start))
+
+    def fetch_file(self, task, url, path, sha256):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digest = hashlib.sha256()
+        with urllib.request.urlopen(
+                url, timeout=constants.MIRROR_REQUEST_TIMEOUT) as response:
+            src = response
+            if response.headers.get('Content-Encoding') == 'gzip':
+                # Compressed in the storage
+                src = gzip.GzipFile(fileobj=response)
+            with open(path, 'wb') as dest:
+                for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    dest.write(chunk)
+        if digest.hexdigest() != sha256:
+            raise TaskException(task, 'Digest mismatch of {url}'.format(
+                url=url))
+
+    def prune(self, task):
+        expired = time.time() - self.max_age
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith(('.lock', '.tmp')) or not os.path.isdir(path):
+                continue
+            with file_lock(path + '.lock', blocking=False) as locked:
+                # A locked build is being fetched or checked out
+                if not locked or not os.path.isdir(path) or \
+                        os.stat(path).st_mtime >= expired:
+                    continue
+                task.logger.info('Removing mirrored build {name}'.format(
+                    name=name))
+                shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,276 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from .common import FallibleTask, PopenTask, TaskException, file_lock
+from . import constants
+from .vagrant import libvirt_domains
+
+OVERLAY_FILE = 'overlay.json'
+OVERLAY_IMAGE = '{machine}.qcow2'
+OVERLAY_SSH_KEY = '{machine}.key'
+# The key vagrant inserted into the VM on its first boot
+VAGRANT_SSH_KEY = '.vagrant/machines/{machine}/libvirt/private_key'
+
+
+def overlay_key(template_name, template_version, vagrantfile, build_url,
+                update_packages):
+    """Key of the provisioned disks of the VMs of a Vagrantfile"""
+    key = json.dumps(dict(
+        template=template_name, template_version=template_version,
+        vagrantfile=hashlib.sha256(vagrantfile.encode('utf-8')).hexdigest(),
+        build_url=build_url, update_packages=bool(update_packages)),
+        sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:24]
+
+
+def lineage_key(source_ref, template_name, template_version, vagrantfile,
+                update_packages):
+    """
+    Key of the overlays of successive builds of the same sources, a newer
+    build supersedes the overlays of the previous one
+    """
+    if source_ref is None:
+        return None
+    return overlay_key(template_name, template_version, vagrantfile,
+                       source_ref, update_packages)
+
+
+def domain_disk(task, domain):
+    """Path of the first disk of a domain"""
+    blklist = PopenTask(['virsh', 'domblklist', domain, '--details'],
+                        capture_output=True)
+    task.execute_subtask(blklist)
+    for line in blklist.output:
+        fields = line.split()
+        if len(fields) == 4 and fields[:2] == ['file', 'disk']:
+            return fields[3]
+    raise TaskException(task, 'No disk of {domain}'.format(domain=domain))
+
+
+class SaveOverlays(FallibleTask):
+    """
+    Copy the disks of the VMs in the working directory to path
+
+    vagrant-libvirt disks are qcow2 overlays of the box image, the copy is
+    an overlay of the box with just the changes of the provisioning. The
+    guest file systems are frozen (if the guest agent runs) and the VMs
+    paused while their disks are copied. The SSH keys vagrant inserted into
+    the VMs are saved with them.
+    """
+    def __init__(self, path, **kwargs):
+        super(SaveOverlays, self).__init__(**kwargs)
+        self.path = path
+
+    def _run(self):
+        domains = libvirt_domains(self)
+        if not domains:
+            raise TaskException(self, 'No VMs to save')
+        for machine, domain in sorted(domains.items()):
+            disk = domain_disk(self, domain)
+            image = os.path.join(
+                self.path, OVERLAY_IMAGE.format(machine=machine))
+            self.execute_subtask(PopenTask(
+                ['virsh', 'domfsfreeze', domain], raise_on_err=False))
+            self.execute_subtask(PopenTask(['virsh', 'suspend', domain]))
+            try:
+                self.execute_subtask(PopenTask(
+                    ['cp', '--sparse=always', disk, image], timeout=None))
+            finally:
+                self.execute_subtask(PopenTask(
+                    ['virsh', 'resume', domain], raise_on_err=False))
+                self.execute_subtask(PopenTask(
+                    ['virsh', 'domfsthaw', domain], raise_on_err=False))
+            ssh_key = os.path.join(
+                self.cwd, VAGRANT_SSH_KEY.format(machine=machine))
+            if os.path.exists(ssh_key):
+                shutil.copy(ssh_key, os.path.join(
+                    self.path, OVERLAY_SSH_KEY.format(machine=machine)))
+        self.execute_subtask(PopenTask(['chown', '-R', 'qemu:qemu',
+                                        self.path]))
+
+
+class UseOverlays(FallibleTask):
+    """
+    Replace the disks of the (shut off) VMs in the working directory by
+    new qcow2 images backed by the overlays in path, vagrant then connects
+    with the SSH keys saved with them
+    """
+    def __init__(self, path, **kwargs):
+        super(UseOverlays, self).__init__(**kwargs)
+        self.path = path
+
+    def _run(self):
+        domains = libvirt_domains(self)
+        for machine, domain in sorted(domains.items()):
+            image = os.path.join(
+                self.path, OVERLAY_IMAGE.format(machine=machine))
+            if not os.path.exists(image):
+                raise TaskException(self, 'No overlay of {machine}'.format(
+                    machine=machine))
+            disk = domain_disk(self, domain)
+            self.execute_subtask(PopenTask(
+                ['qemu-img', 'create', '-q', '-f', 'qcow2', '-F', 'qcow2',
+                 '-b', image, disk]))
+            self.execute_subtask(PopenTask(['chown', 'qemu:qemu', disk]))
+            ssh_key = os.path.join(
+                self.path, OVERLAY_SSH_KEY.format(machine=machine))
+            if os.path.exists(ssh_key):
+                shutil.copy(ssh_key, os.path.join(
+                    self.cwd, VAGRANT_SSH_KEY.format(machine=machine)))
+
+
+class OverlayStore(object):
+    """
+    Disks of provisioned VMs, reused by the next jobs testing the same build
+
+    Every entry holds a qcow2 overlay per machine of a topology, created
+    once the packages of a build are installed on it. Jobs booting their
+    VMs from the entry hold a reference to it as long as their disks are
+    backed by its overlays. The store is in the libvirt images directory,
+    so qemu can read the overlays.
+
+    Unreferenced entries are removed once a newer build of the same
+    sources (lineage) has its own entry, when unused for max_age (seconds),
+    or when the store has more than max_entries. References older than
+    hold_timeout (seconds) are from jobs that never released them.
+    """
+    def __init__(self, root=None, max_entries=constants.OVERLAY_MAX_ENTRIES,
+                 max_age=constants.OVERLAY_MAX_AGE,
+                 hold_timeout=constants.OVERLAY_HOLD_TIMEOUT):
+        self.root = root if root is not None else constants.OVERLAY_DIR
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hold_timeout = hold_timeout
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def from_config(config):
+        """
+        Create the store from the overlays section of the runner
+        configuration, max_age is in days
+        """
+        return OverlayStore(
+            max_entries=config.get('max_entries',
+                                   constants.OVERLAY_MAX_ENTRIES),
+            max_age=config.get(
+                'max_age', constants.OVERLAY_MAX_AGE / 86400) * 86400)
+
+    def lock(self):
+        return file_lock(os.path.join(self.root, '.lock'))
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def read(self, key):
+        try:
+            with open(os.path.join(self.path(key), OVERLAY_FILE)) as entry_f:
+                return json.load(entry_f)
+        except (OSError, IOError, ValueError):
+            return None
+
+    def write(self, entry):
+        path = os.path.join(self.path(entry['key']), OVERLAY_FILE)
+        with open(path + '.tmp', 'w') as entry_f:
+            json.dump(entry, entry_f)
+        os.rename(path + '.tmp', path)
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.root):
+            entry = self.read(name)
+            if entry is not None:
+                entries.append(entry)
+        return entries
+
+    def holders(self, entry):
+        now = time.time()
+        return {uuid: since for uuid, since in entry['holders'].items()
+                if now - since < self.hold_timeout}
+
+    def acquire(self, key, uuid):
+        """Reference the overlays of key, their path if they're complete"""
+        with self.lock():
+            entry = self.read(key)
+            if entry is None or not entry['complete']:
+                return None
+            entry['holders'][uuid] = entry['last_used'] = time.time()
+            self.write(entry)
+        return self.path(key)
+
+    def use(self, task, path):
+        """Back the disks of the (shut off) VMs of task by the overlays"""
+        task.execute_subtask(UseOverlays(path))
+
+    def release(self, key, uuid):
+        with self.lock():
+            entry = self.read(key)
+            if entry is not None and uuid in entry['holders']:
+                del entry['holders'][uuid]
+                self.write(entry)
+        self.evict()
+
+    def create(self, task, key, lineage, build_url):
+        """
+        Save the disks of the VMs of task as the overlays of key, False
+        if they exist or are being created
+        """
+        path = self.path(key)
+        now = time.time()
+        entry = dict(key=key, lineage=lineage, build_url=build_url,
+                     complete=False, created=now, last_used=now,
+                     holders={task.uuid: now})
+        with self.lock():
+            if os.path.exists(path):
+                return False
+            os.makedirs(path)
+            self.write(entry)
+        try:
+            task.execute_subtask(SaveOverlays(path))
+        except TaskException:
+            with self.lock():
+                shutil.rmtree(path, ignore_errors=True)
+            raise
+        with self.lock():
+            # The disks of the VMs of task are copies, not backed by it
+            entry['complete'] = True
+            entry['holders'] = {}
+            self.write(entry)
+        self.evict()
+        return True
+
+    def evict(self):
+        with self.lock():
+            now = time.time()
+            entries = sorted(self.entries(), key=lambda e: e['last_used'])
+            latest = {}
+            for entry in entries:
+                if entry['complete'] and entry['lineage'] is not None:
+                    previous = latest.get(entry['lineage'])
+                    if previous is None or \
+                            entry['created'] > previous['created']:
+                        latest[entry['lineage']] = entry
+            count = len(entries)
+            for entry in entries:
+                if self.holders(entry):
+                    continue
+                if not entry['complete']:
+                    # Left behind by a job that never completed it
+                    reason = 'incomplete'
+                elif (entry['lineage'] is not None and
+                      latest[entry['lineage']] is not entry):
+                    reason = 'superseded'
+                elif now - entry['last_used'] > self.max_age:
+                    reason = 'expired'
+                elif count > self.max_entries:
+                    reason = 'least recently used'
+                else:
+                    continue
+                self.logger.info('Removing overlays of %s (%s)',
+                                 entry['build_url'], reason)
+                shutil.rmtree(self.path(entry['key']), ignore_errors=True)
+                count -= 1
@@ -0,0 +1,299 @@
+"""
+Caching proxy of the package repositories used by the test VMs
+
+Run on the runner host by the prci-package-proxy service:
+
+    python3 -m tasks.package_proxy --upstream fedora=https://... --port 8182
+
+A request for /<name>/<path> is served from upstream <name>. Packages and
+repository metadata are immutable once published (the metadata files are
+named by their checksum) and are cached, only repomd.xml and metalinks
+always come from the upstream.
+"""
+import argparse
+import collections
+import contextlib
+import http.server
+import json
+import logging
+import os
+import posixpath
+import shutil
+import signal
+import socketserver
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from . import constants
+
+STATS_PATH = '/_stats'
+UNCACHED_NAMES = ('repomd.xml', 'repomd.xml.asc', 'metalink', 'mirrorlist')
+COPY_CHUNK_SIZE = 1024 * 1024
+
+GiB = 1024 ** 3
+
+logger = logging.getLogger(__name__)
+
+
+class PackageCache(object):
+    """
+    Size-bounded store of the cached files
+
+    Files beyond max_size (bytes) are removed, least recently used first,
+    until the cache is down to trim_ratio of max_size: the cache is only
+    walked once in a while. The modification time of a file is its last
+    use.
+    """
+    def __init__(self, root, max_size, trim_ratio=0.9):
+        self.root = root
+        self.max_size = max_size
+        self.trim_ratio = trim_ratio
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        # Kept up to date by put() and trim()
+        self.current_size = sum(stat.st_size for _path, stat in self.files())
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, tmp_path):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, path)
+        with self.lock:
+            self.current_size += size
+            if self.current_size <= self.max_size:
+                return path
+        self.trim()
+        return path
+
+    def files(self):
+        files = []
+        for root, _dirs, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    files.append((path, os.stat(path)))
+                except OSError:
+                    continue
+        return files
+
+    def trim(self):
+        with self.lock:
+            files = self.files()
+            size = sum(stat.st_size for _path, stat in files)
+            for path, stat in sorted(files, key=lambda f: f[1].st_mtime):
+                if size <= self.max_size * self.trim_ratio:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= stat.st_size
+            self.current_size = size
+
+    def size(self):
+        with self.lock:
+            return self.current_size
+
+
+class PackageProxy(object):
+    """
+    Serves the files of upstreams (names mapped to base URLs, file:// URLs
+    included) through a PackageCache. A file requested by several VMs at
+    once is downloaded once.
+    """
+    def __init__(self, upstreams, cache_dir=constants.PACKAGE_PROXY_DIR,
+                 max_size=constants.PACKAGE_PROXY_MAX_SIZE,
+                 timeout=constants.PACKAGE_PROXY_TIMEOUT):
+        self.upstreams = {
+            name: url if url.endswith('/') else url + '/'
+            for name, url in upstreams.items()}
+        self.cache = PackageCache(cache_dir, max_size)
+        self.timeout = timeout
+        self.stats = collections.Counter()
+        self.stats_lock = threading.Lock()
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def count(self, **counters):
+        with self.stats_lock:
+            self.stats.update(counters)
+
+    def statistics(self):
+        with self.stats_lock:
+            stats = dict(hits=0, misses=0, uncached=0, errors=0,
+                         hit_bytes=0, miss_bytes=0)
+            stats.update(self.stats)
+        requests = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / requests if requests else 0.0
+        stats['cache_size'] = self.cache.size()
+        return stats
+
+    def resolve(self, path):
+        """The (upstream URL, cache key) of a request path, None if invalid"""
+        path = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+        name, _sep, rel_path = path.lstrip('/').partition('/')
+        if (name not in self.upstreams or not rel_path or
+                posixpath.normpath(rel_path) != rel_path or
+                rel_path.startswith('../')):
+            return None
+        return (urllib.parse.urljoin(
+            self.upstreams[name], urllib.parse.quote(rel_path)),
+            posixpath.join(name, rel_path))
+
+    @staticmethod
+    def cacheable(key):
+        return posixpath.basename(key) not in UNCACHED_NAMES
+
+    @contextlib.contextmanager
+    def key_lock(self, key):
+        """Hold the lock of key, dropped once no request waits for it"""
+        with self.locks_lock:
+            lock, users = self.locks.get(key, (threading.Lock(), 0))
+            self.locks[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self.locks_lock:
+                lock, users = self.locks.pop(key)
+                if users > 1:
+                    self.locks[key] = (lock, users - 1)
+
+    def fetch(self, url, key):
+        """Download url into the cache, returns the cached path"""
+        with self.key_lock(key):
+            path = self.cache.get(key)
+            if path is not None:
+                # Downloaded by a concurrent request
+                return path, True
+            with urllib.request.urlopen(url, timeout=self.timeout) as src, \
+                    tempfile.NamedTemporaryFile(
+                        dir=self.cache.root, suffix='.tmp',
+                        delete=False) as dest:
+                try:
+                    shutil.copyfileobj(src, dest, COPY_CHUNK_SIZE)
+                except BaseException:
+                    os.remove(dest.name)
+                    raise
+            return self.cache.put(key, dest.name), False
+
+    def handle(self, handler):
+        if handler.path == STATS_PATH:
+            body = json.dumps(self.statistics()).encode('utf-8')
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'application/json')
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+            return
+
+        resolved = self.resolve(handler.path)
+        if resolved is None:
+            handler.send_error(404)
+            return
+        url, key = resolved
+        try:
+            if not self.cacheable(key):
+                self.count(uncached=1)
+                with urllib.request.urlopen(url, timeout=self.timeout) as src:
+                    self.send(handler, src, src.headers.get('Content-Length'))
+                return
+
+            path = self.cache.get(key)
+            hit = path is not None
+            if not hit:
+                path, hit = self.fetch(url, key)
+            size = os.path.getsize(path)
+            if hit:
+                self.count(hits=1, hit_bytes=size)
+            else:
+                self.count(misses=1, miss_bytes=size)
+            with open(path, 'rb') as src:
+                self.send(handler, src, size)
+        except urllib.error.HTTPError as exc:
+            self.count(errors=1)
+            handler.send_error(exc.code)
+        except urllib.error.URLError as exc:
+            self.count(errors=1)
+            # A missing file of a local upstream
+            handler.send_error(
+                404 if isinstance(exc.reason, FileNotFoundError) else 502)
+        except OSError as exc:
+            logger.warning('Failed to serve %s: %s', handler.path, exc)
+            self.count(errors=1)
+
+    @staticmethod
+    def send(handler, src, size):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/octet-stream')
+        if size is not None:
+            handler.send_header('Content-Length', str(size))
+        handler.end_headers()
+        shutil.copyfileobj(src, handler.wfile, COPY_CHUNK_SIZE)
+
+    def server(self, address='', port=constants.PACKAGE_PROXY_PORT):
+        proxy = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                proxy.handle(self)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        return Server((address, port), Handler)
+
+
+def interrupt(_signum, _frame):
+    raise KeyboardInterrupt
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--address', default='')
+    parser.add_argument('--port', type=int,
+                        default=constants.PACKAGE_PROXY_PORT)
+    parser.add_argument('--cache-dir', default=constants.PACKAGE_PROXY_DIR)
+    parser.add_argument('--max-size', type=float,
+                        default=constants.PACKAGE_PROXY_MAX_SIZE / GiB,
+                        help='cache size in GiB')
+    parser.add_argument('--upstream', action='append', required=True,
+                        metavar='NAME=URL')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    proxy = PackageProxy(
+        dict(upstream.split('=', 1) for upstream in args.upstream),
+        cache_dir=args.cache_dir, max_size=int(args.max_size * GiB))
+    server = proxy.server(args.address, args.port)
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info('Cache statistics: %s', proxy.statistics())
+
+
+if __name__ == '__main__':
+    main()
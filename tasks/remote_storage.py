@@ -1,31 +1,122 @@
+import abc
+import concurrent.futures
+import gzip
 import os
 import re
+import shlex
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
 
-from .common import PopenTask, TaskException
-from .constants import (FEDORAPEOPLE_KEY_PATH, FEDORAPEOPLE_DIR, UUID_RE,
-                        JOBS_DIR)
+from .common import FallibleTask, PopenTask, TaskException
+from .constants import (FEDORAPEOPLE_KEY_PATH, FEDORAPEOPLE_DIR,
+                        FEDORAPEOPLE_HOST, FEDORAPEOPLE_ROOT,
+                        FEDORAPEOPLE_BASE_URL, UUID_RE,
+                        JOBS_DIR, GZIP_LEVEL, GZIP_MIN_SIZE, GZIP_CHUNK_SIZE,
+                        ARTIFACT_BLOBS_DIR)
 
+SSH_OPTIONS = [
+    '-o', 'StrictHostKeyChecking no',
+    '-o', 'UserKnownHostsFile /dev/null',
+    '-o', 'LogLevel ERROR']
 
-class GzipLogFiles(PopenTask):
-    def __init__(self, directory, **kwargs):
-        super(GzipLogFiles, self).__init__(self, **kwargs)
+
+class GzipLogFiles(FallibleTask):
+    """
+    Compress the log files in a directory in place.
+
+    Files are compressed in parallel by a pool of threads (zlib releases the
+    GIL), files smaller than min_size aren't worth compressing and are
+    kept as they are.
+    """
+    EXCLUDE_DIRS = ('.vagrant', 'assets', 'rpms')
+    EXCLUDE_NAMES = ('Vagrantfile', 'ipa-test-config.yaml', 'vars.yml',
+                     'ansible.cfg', 'report.html')
+    EXCLUDE_EXTENSIONS = ('.gz', '.png')
+
+    def __init__(self, directory, level=GZIP_LEVEL, min_size=GZIP_MIN_SIZE,
+                 workers=None, **kwargs):
+        super(GzipLogFiles, self).__init__(**kwargs)
         self.directory = directory
-        self.cmd = (
-            'find {directory} '
-            '-type f '
-            '! -path "*/.vagrant/*" '
-            '-a ! -path "*/assets/*" '
-            '-a ! -path "*/rpms/*" '
-            '-a ! -name "*.gz" '
-            '-a ! -name "*.png" '
-            '-a ! -name "Vagrantfile" '
-            '-a ! -name "ipa-test-config.yaml" '
-            '-a ! -name "vars.yml" '
-            '-a ! -name "ansible.cfg" '
-            '-a ! -name "report.html" '
-            '-exec gzip "{{}}" \;'
-        ).format(directory=directory)
-        self.shell = True
+        self.level = level
+        self.min_size = min_size
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.terminated = threading.Event()
+        self.files = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+
+    def find_files(self):
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if d not in self.EXCLUDE_DIRS]
+            for name in files:
+                if (name in self.EXCLUDE_NAMES or
+                        name.endswith(self.EXCLUDE_EXTENSIONS)):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if (os.path.islink(path) or
+                            os.path.getsize(path) < self.min_size):
+                        continue
+                except OSError:
+                    continue  # removed since listed
+                yield path
+
+    def compress(self, path):
+        if self.terminated.is_set():
+            return
+        gz_path = path + '.gz'
+        # Never leave a truncated .gz behind, it'd be taken for the log
+        tmp_path = gz_path + '.tmp'
+        try:
+            with open(path, 'rb') as src, gzip.open(
+                    tmp_path, 'wb', compresslevel=self.level) as dest:
+                shutil.copyfileobj(src, dest, GZIP_CHUNK_SIZE)
+            shutil.copystat(path, tmp_path)
+            os.rename(tmp_path, gz_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        size_in = os.path.getsize(path)
+        size_out = os.path.getsize(gz_path)
+        os.remove(path)
+        with self.lock:
+            self.files += 1
+            self.bytes_in += size_in
+            self.bytes_out += size_out
+
+    def _run(self):
+        start = time.time()
+        failed = 0
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            futures = {
+                executor.submit(self.compress, path): path
+                for path in self.find_files()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except (OSError, IOError) as exc:
+                    failed += 1
+                    self.logger.debug(
+                        'Failed to compress {path}'.format(
+                            path=futures[future]))
+                    self.logger.debug(exc, exc_info=True)
+
+        self.logger.info(
+            'Compressed {files} files, {bytes_in} -> {bytes_out} bytes '
+            'in {seconds:.1f}s'.format(
+                files=self.files, bytes_in=self.bytes_in,
+                bytes_out=self.bytes_out, seconds=time.time() - start))
+        if failed:
+            raise TaskException(
+                self, 'failed to compress {n} files'.format(n=failed))
+
+    def _terminate(self):
+        self.terminated.set()
 
 
 class RsyncTask(PopenTask):
@@ -89,3 +180,260 @@ class FedoraPeopleDownload(SshRsyncTask):
             ssh_private_key_path=FEDORAPEOPLE_KEY_PATH,
             **kwargs
         )
+
+
+class Storage(object):
+    """
+    Artifact storage backend
+
+    Storages map keys (relative paths) to files, which are publicly
+    accessible under base_url. All their methods take the task on whose
+    behalf they run, so that any subprocess is executed as its subtask.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def url(self, key):
+        return urllib.parse.urljoin(self.base_url, key)
+
+    @abc.abstractmethod
+    def missing_keys(self, task, keys):
+        """The keys which aren't stored yet"""
+
+    @abc.abstractmethod
+    def read_key(self, task, key):
+        """The content of a stored file, None if there's no such key"""
+
+    @abc.abstractmethod
+    def put_files(self, task, files):
+        """Store local files, files is a list of (key, path) pairs"""
+
+    @abc.abstractmethod
+    def link_files(self, task, links):
+        """
+        Make stored files available under other keys, links is a list
+        of (key, src_key) pairs
+        """
+
+    @abc.abstractmethod
+    def prune_blobs(self, task):
+        """Remove the blobs no longer used by any job"""
+
+
+class LocalStorage(Storage):
+    """Artifact storage in a local directory"""
+    def __init__(self, root, base_url=None):
+        if base_url is None:
+            base_url = 'file://' + os.path.abspath(root) + '/'
+        super(LocalStorage, self).__init__(base_url)
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def missing_keys(self, task, keys):
+        return {key for key in keys if not os.path.exists(self.path(key))}
+
+    def read_key(self, task, key):
+        try:
+            with open(self.path(key), 'rb') as key_f:
+                return key_f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_files(self, task, files):
+        for key, path in files:
+            dest = self.path(key)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            # Copy under a temporary name, so a key never points to
+            # a partially written file
+            tmp_dest = '{dest}.{pid}.tmp'.format(dest=dest, pid=os.getpid())
+            shutil.copyfile(path, tmp_dest)
+            os.rename(tmp_dest, dest)
+
+    def link_files(self, task, links):
+        # Hard links, the job files share the storage of the blobs
+        for key, src_key in links:
+            dest = self.path(key)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if os.path.lexists(dest):
+                os.remove(dest)
+            os.link(self.path(src_key), dest)
+
+    def prune_blobs(self, task):
+        for root, _dirs, files in os.walk(self.path(ARTIFACT_BLOBS_DIR)):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+
+
+class SshStorage(Storage):
+    """
+    Artifact storage in a directory on a remote host accessed by SSH
+
+    Files are split by size among concurrency rsync processes running in
+    parallel, rsync verifies the checksum of every transferred file.
+
+    bwlimit: maximum transfer rate in KiB/s of each rsync
+    compress: compress the data in flight (rsync -z)
+    """
+    KEYS_PER_COMMAND = 500  # keeps the remote command line short enough
+
+    def __init__(self, host, root, base_url=None, ssh_private_key_path=None,
+                 bwlimit=None, concurrency=1, compress=False):
+        super(SshStorage, self).__init__(base_url)
+        self.host = host
+        self.root = root
+        self.ssh_private_key_path = ssh_private_key_path
+        self.bwlimit = bwlimit
+        self.concurrency = concurrency
+        self.compress = compress
+
+    def ssh_task(self, command, **kwargs):
+        cmd = ['ssh'] + SSH_OPTIONS
+        if self.ssh_private_key_path is not None:
+            cmd.extend(['-i', self.ssh_private_key_path])
+        cmd.extend([self.host, command])
+        return PopenTask(cmd, timeout=None, **kwargs)
+
+    def rsync_task(self, src):
+        extra_args = []
+        if self.bwlimit:
+            extra_args.append('--bwlimit={}'.format(self.bwlimit))
+        if self.compress:
+            extra_args.append('--compress')
+        return SshRsyncTask(
+            src, '{host}:{root}/'.format(host=self.host, root=self.root),
+            extra_args=extra_args,
+            ssh_private_key_path=self.ssh_private_key_path, timeout=None)
+
+    def missing_keys(self, task, keys):
+        # Checked in batches by remote shell loops
+        keys = sorted(keys)
+        missing = set()
+        for i in range(0, len(keys), self.KEYS_PER_COMMAND):
+            batch = keys[i:i + self.KEYS_PER_COMMAND]
+            check = self.ssh_task(
+                'cd {root} && for key in {keys}; do '
+                'test -e "$key" || echo "$key"; done'.format(
+                    root=shlex.quote(self.root),
+                    keys=' '.join(shlex.quote(key) for key in batch)),
+                capture_output=True)
+            task.execute_subtask(check)
+            missing.update(set(check.output) & set(batch))
+        return missing
+
+    def read_key(self, task, key):
+        # Only used for small text files, which survive the line splitting
+        cat = self.ssh_task(
+            'cd {root} && test -f {key} && cat {key}; true'.format(
+                root=shlex.quote(self.root), key=shlex.quote(key)),
+            capture_output=True)
+        task.execute_subtask(cat)
+        if not cat.output:
+            return None
+        return '\n'.join(cat.output).encode('utf-8')
+
+    def stage(self, files):
+        """Create a local tree of hard links to files, laid out by key"""
+        staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=JOBS_DIR)
+        for key, path in files:
+            dest = os.path.join(staging_dir, key)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            try:
+                os.link(path, dest)
+            except OSError:
+                shutil.copyfile(path, dest)
+        return staging_dir
+
+    def split_files(self, files):
+        """Split files into at most concurrency groups of similar size"""
+        groups = [(0, [])
+                  for _i in range(min(self.concurrency, len(files)))]
+        sized = sorted(((os.path.getsize(path), key, path)
+                        for key, path in files), reverse=True)
+        for size, key, path in sized:
+            total, group = groups[0]
+            group.append((key, path))
+            groups[0] = (total + size, group)
+            groups.sort(key=lambda g: g[0])
+        return [group for _size, group in groups]
+
+    def put_files(self, task, files):
+        if not files:
+            return
+        staging_dirs = [self.stage(group) for group in self.split_files(files)]
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    len(staging_dirs)) as executor:
+                rsyncs = [
+                    executor.submit(task.execute_subtask,
+                                    self.rsync_task(staging_dir + '/'))
+                    for staging_dir in staging_dirs]
+                for rsync in rsyncs:
+                    rsync.result()
+        finally:
+            for staging_dir in staging_dirs:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def link_files(self, task, links):
+        if not links:
+            return
+        # Links are created by a shell script executed on the remote host,
+        # the number of links doesn't fit on a command line
+        script_key = '.links-{pid}-{time}.sh'.format(
+            pid=os.getpid(), time=int(time.time() * 1000))
+        with tempfile.NamedTemporaryFile('w', dir=JOBS_DIR) as script:
+            script.write('set -e\ncd {root}\n'.format(
+                root=shlex.quote(self.root)))
+            for key, src_key in links:
+                script.write('mkdir -p {dir} && ln -f {src} {key}\n'.format(
+                    dir=shlex.quote(os.path.dirname(key)),
+                    src=shlex.quote(src_key),
+                    key=shlex.quote(key)))
+            script.flush()
+            self.put_files(task, [(script_key, script.name)])
+        script_path = shlex.quote(os.path.join(self.root, script_key))
+        task.execute_subtask(self.ssh_task(
+            'sh {script}; rc=$?; rm -f {script}; exit $rc'.format(
+                script=script_path)))
+
+    def prune_blobs(self, task):
+        task.execute_subtask(self.ssh_task(
+            'find {blobs} -type f -links 1 -delete'.format(
+                blobs=shlex.quote(
+                    os.path.join(self.root, ARTIFACT_BLOBS_DIR)))))
+
+
+def fedorapeople_storage(bwlimit=None, concurrency=1, compress=False):
+    return SshStorage(FEDORAPEOPLE_HOST, FEDORAPEOPLE_ROOT,
+                      base_url=FEDORAPEOPLE_BASE_URL,
+                      ssh_private_key_path=FEDORAPEOPLE_KEY_PATH,
+                      bwlimit=bwlimit, concurrency=concurrency,
+                      compress=compress)
+
+
+def storage_from_config(config, bwlimit=None):
+    """
+    Create the artifact storage described by the storage section of the
+    runner configuration, fedorapeople.org if there is none
+
+    The backend item selects the storage class (local, ssh or s3), the
+    other items are passed to it as keyword arguments.
+    """
+    if not config:
+        return fedorapeople_storage(bwlimit=bwlimit)
+    kwargs = dict(config)
+    backend = kwargs.pop('backend')
+    if backend == 'local':
+        return LocalStorage(**kwargs)
+    if backend == 'ssh':
+        kwargs.setdefault('bwlimit', bwlimit)
+        return SshStorage(**kwargs)
+    if backend == 's3':
+        from .s3_storage import S3Storage
+        return S3Storage(**kwargs)
+    raise ValueError('Unknown storage backend: {}'.format(backend))
@@ -0,0 +1,153 @@
+import csv
+import os
+import threading
+import time
+
+import psutil
+
+
+def tap_interfaces(proc):
+    """Names of the tap devices opened by a (qemu) process"""
+    fd_dir = '/proc/{pid}/fd'.format(pid=proc.pid)
+    interfaces = []
+    try:
+        for fd in os.listdir(fd_dir):
+            if os.readlink(os.path.join(fd_dir, fd)) != '/dev/net/tun':
+                continue
+            fdinfo = '/proc/{pid}/fdinfo/{fd}'.format(pid=proc.pid, fd=fd)
+            with open(fdinfo) as fdinfo_f:
+                for line in fdinfo_f:
+                    if line.startswith('iff:'):
+                        interfaces.append(line.split()[1])
+    except (OSError, IOError):
+        pass  # process ended or we're not allowed to look at it
+    return interfaces
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Periodically samples resource usage of a job's process tree.
+
+    The tree consists of the processes started by the task and its subtasks
+    (and their children), plus qemu processes whose command line contains
+    the job UUID, since those are spawned by libvirtd rather than by us.
+    Each sample is appended as a row to a CSV file. CPU, memory and I/O are
+    summed over the processes alive at the time of the sample, network I/O
+    is counted on the tap devices of the qemu processes.
+    """
+    FIELDS = ('time', 'processes', 'cpu_percent', 'rss', 'read_bytes',
+              'write_bytes', 'net_rx_bytes', 'net_tx_bytes')
+
+    def __init__(self, task, path, interval, match=None):
+        super(ResourceSampler, self).__init__(daemon=True)
+        self.task = task
+        self.path = path
+        self.interval = interval
+        self.match = match
+        self.procs = {}
+        self.stopped = threading.Event()
+        self.samples = 0
+        self.peak_rss = 0
+        self.peak_cpu_percent = 0.0
+
+    def root_pids(self):
+        pids = []
+        tasks = [self.task]
+        while tasks:
+            task = tasks.pop()
+            process = getattr(task, 'process', None)
+            if process is not None:
+                pids.append(process.pid)
+            tasks.extend(list(task.tasks))
+        return pids
+
+    def find_processes(self):
+        found = {}
+        for pid in self.root_pids():
+            try:
+                parent = psutil.Process(pid)
+                found[pid] = parent
+                for child in parent.children(recursive=True):
+                    found[child.pid] = child
+            except psutil.NoSuchProcess:
+                pass  # probably ended already
+
+        if self.match is not None:
+            # Not psutil.process_iter(), it caches every process it has seen
+            # in a module global for the life of the runner
+            for pid in psutil.pids():
+                try:
+                    proc = psutil.Process(pid)
+                    if ('qemu' in proc.name() and
+                            self.match in ' '.join(proc.cmdline())):
+                        found[pid] = proc
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    pass
+
+        # Reuse the already known processes, cpu_percent() measures the
+        # utilization since the previous call on the same object
+        procs = {}
+        for pid, proc in found.items():
+            known = self.procs.get(pid)
+            procs[pid] = known if known == proc else proc
+        self.procs = procs
+        return list(procs.values())
+
+    def sample(self):
+        procs = self.find_processes()
+        cpu_percent = 0.0
+        rss = read_bytes = write_bytes = 0
+        interfaces = []
+        for proc in procs:
+            try:
+                with proc.oneshot():
+                    cpu_percent += proc.cpu_percent(interval=None)
+                    rss += proc.memory_info().rss
+                    io = proc.io_counters()
+                    read_bytes += io.read_bytes
+                    write_bytes += io.write_bytes
+                if self.match is not None and 'qemu' in proc.name():
+                    interfaces.extend(tap_interfaces(proc))
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+
+        net_rx_bytes = net_tx_bytes = 0
+        if interfaces:
+            counters = psutil.net_io_counters(pernic=True)
+            for interface in interfaces:
+                if interface in counters:
+                    net_rx_bytes += counters[interface].bytes_recv
+                    net_tx_bytes += counters[interface].bytes_sent
+
+        self.samples += 1
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_cpu_percent = max(self.peak_cpu_percent, cpu_percent)
+        return (round(time.time(), 1), len(procs), round(cpu_percent, 1),
+                rss, read_bytes, write_bytes, net_rx_bytes, net_tx_bytes)
+
+    def run(self):
+        try:
+            with open(self.path, 'w') as samples_f:
+                writer = csv.writer(samples_f)
+                writer.writerow(self.FIELDS)
+                while True:
+                    writer.writerow(self.sample())
+                    samples_f.flush()
+                    if self.stopped.wait(self.interval):
+                        break
+        except (OSError, IOError) as exc:
+            self.task.logger.warning(
+                'Failed to record resource usage to %s: %s', self.path, exc)
+            self.task.logger.debug(exc, exc_info=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        # Don't keep the process objects alive with the finished job
+        self.procs = {}
+
+    def __str__(self):
+        return '{samples} samples, peak {cpu}% CPU, {rss}MB RSS'.format(
+            samples=self.samples,
+            cpu=self.peak_cpu_percent,
+            rss=self.peak_rss // 1024 ** 2)
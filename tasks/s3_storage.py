@@ -0,0 +1,327 @@
+import base64
+import calendar
+import concurrent.futures
+import datetime
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import tempfile
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+import requests
+
+from .artifacts import blob_key
+from .common import TaskException
+from .constants import (ARTIFACT_BLOBS_DIR, MANIFEST_FILE, GZIP_LEVEL,
+                        GZIP_CHUNK_SIZE, S3_CONCURRENCY, S3_PART_SIZE,
+                        S3_REQUEST_TIMEOUT, S3_PRUNE_MIN_AGE)
+from .remote_storage import Storage
+
+S3_NAMESPACE = {'s3': 'http://s3.amazonaws.com/doc/2006-03-01/'}
+
+
+def quote(value, safe='-_.~'):
+    return urllib.parse.quote(value, safe=safe)
+
+
+def sign_request(method, url, headers, payload_hash, access_key, secret_key,
+                 region, now=None):
+    """
+    Sign a request with AWS signature version 4
+
+    Returns the headers to send, including the signed date, payload hash
+    and the authorization header.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    scope = '{date}/{region}/s3/aws4_request'.format(
+        date=amz_date[:8], region=region)
+    split_url = urllib.parse.urlsplit(url)
+
+    headers = dict(headers)
+    headers['Host'] = split_url.netloc
+    headers['x-amz-date'] = amz_date
+    headers['x-amz-content-sha256'] = payload_hash
+    canonical_headers = sorted(
+        (name.lower(), ' '.join(str(value).split()))
+        for name, value in headers.items())
+    signed_headers = ';'.join(name for name, _value in canonical_headers)
+    query = sorted(
+        urllib.parse.parse_qsl(split_url.query, keep_blank_values=True))
+    canonical_request = '\n'.join([
+        method,
+        split_url.path or '/',
+        '&'.join('{}={}'.format(quote(name), quote(value))
+                 for name, value in query),
+        ''.join('{}:{}\n'.format(name, value)
+                for name, value in canonical_headers),
+        signed_headers,
+        payload_hash])
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256', amz_date, scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+
+    key = ('AWS4' + secret_key).encode('utf-8')
+    for item in (amz_date[:8], region, 's3', 'aws4_request'):
+        key = hmac.new(key, item.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode('utf-8'),
+                         hashlib.sha256).hexdigest()
+    headers['Authorization'] = (
+        'AWS4-HMAC-SHA256 Credential={access_key}/{scope}, '
+        'SignedHeaders={signed_headers}, Signature={signature}'.format(
+            access_key=access_key, scope=scope,
+            signed_headers=signed_headers, signature=signature))
+    return headers
+
+
+class S3Storage(Storage):
+    """
+    Artifact storage in a bucket of an S3 compatible object store
+
+    Requests are signed with AWS signature version 4 and carry the sha256
+    and MD5 digests of their payload, which the store verifies. Files
+    larger than twice part_size are sent as multipart uploads. All the
+    transfers of a put_files() call, whole files and parts alike, share a
+    pool of concurrency threads, so a single large file uses as many
+    connections as a directory of small ones.
+
+    compress: gzip files in flight, unless they are compressed already.
+              They are stored with Content-Encoding: gzip, so HTTP
+              clients still get the original content.
+
+    The object store has no links, link_files() copies the blobs on the
+    server side. Uploads are deduplicated, storage is not.
+    """
+    COMPRESSED_EXTENSIONS = ('.gz', '.xz', '.bz2', '.zip', '.rpm', '.png',
+                             '.jpg', '.img')
+
+    def __init__(self, endpoint, bucket, access_key, secret_key,
+                 region='us-east-1', base_url=None,
+                 concurrency=S3_CONCURRENCY, part_size=S3_PART_SIZE,
+                 compress=False, session=None):
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        if base_url is None:
+            base_url = '{endpoint}/{bucket}/'.format(
+                endpoint=self.endpoint, bucket=bucket)
+        super(S3Storage, self).__init__(base_url)
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.concurrency = concurrency
+        self.part_size = part_size
+        self.compress = compress
+        self.session = session if session is not None else requests.Session()
+
+    def object_url(self, key=''):
+        return '{endpoint}/{bucket}/{key}'.format(
+            endpoint=self.endpoint, bucket=self.bucket,
+            key=quote(key, safe='-_.~/'))
+
+    def request(self, task, method, key='', params=None, data=b'',
+                headers=None, ok=(200,)):
+        url = self.object_url(key)
+        if params:
+            url += '?' + urllib.parse.urlencode(
+                sorted(params.items()), quote_via=urllib.parse.quote)
+        headers = dict(headers or {})
+        if data:
+            headers['Content-MD5'] = base64.b64encode(
+                hashlib.md5(data).digest()).decode('ascii')
+        headers = sign_request(
+            method, url, headers, hashlib.sha256(data).hexdigest(),
+            self.access_key, self.secret_key, self.region)
+        try:
+            response = self.session.request(
+                method, url, headers=headers, data=data,
+                timeout=S3_REQUEST_TIMEOUT)
+        except requests.RequestException as exc:
+            task.logger.debug(exc, exc_info=True)
+            raise TaskException(task, '{method} {key} failed: {exc}'.format(
+                method=method, key=key, exc=exc))
+        if response.status_code not in ok:
+            task.logger.debug(response.text)
+            raise TaskException(
+                task, '{method} {key} failed with HTTP {status}'.format(
+                    method=method, key=key, status=response.status_code))
+        return response
+
+    def map(self, function, items):
+        """Call function on every item in the pool of transfer threads"""
+        with concurrent.futures.ThreadPoolExecutor(
+                self.concurrency) as executor:
+            return list(executor.map(function, items))
+
+    def missing_keys(self, task, keys):
+        def is_missing(key):
+            response = self.request(task, 'HEAD', key, ok=(200, 404))
+            return response.status_code == 404
+
+        keys = sorted(keys)
+        return {key for key, missing in zip(keys, self.map(is_missing, keys))
+                if missing}
+
+    def read_key(self, task, key):
+        response = self.request(task, 'GET', key, ok=(200, 404))
+        if response.status_code == 404:
+            return None
+        return response.content
+
+    def open_source(self, path):
+        """
+        Open the content to upload from path, a compressed temporary copy
+        if it's compressed in flight. Returns (file, content encoding)
+        """
+        if not self.compress or path.endswith(self.COMPRESSED_EXTENSIONS):
+            return open(path, 'rb'), None
+        compressed = tempfile.TemporaryFile()
+        with open(path, 'rb') as src, gzip.GzipFile(
+                fileobj=compressed, mode='wb',
+                compresslevel=GZIP_LEVEL) as dest:
+            shutil.copyfileobj(src, dest, GZIP_CHUNK_SIZE)
+        compressed.flush()  # parts are read from the file descriptor
+        return compressed, 'gzip'
+
+    def put_files(self, task, files):
+        # A source is opened (and compressed) only while it's sent, by at
+        # most concurrency threads. Large files are sent one at a time,
+        # their parts in parallel.
+        large = [item for item in self.map(
+            lambda item: self.put_file(task, *item), files)
+            if item is not None]
+        for key, path in large:
+            self.put_multipart(task, key, path)
+
+    @staticmethod
+    def source_headers(encoding):
+        headers = {'Content-Type': 'application/octet-stream'}
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        return headers
+
+    def put_file(self, task, key, path):
+        """PUT the file at path, returns (key, path) if it's sent in parts"""
+        if os.path.getsize(path) > 2 * self.part_size:
+            return key, path
+        source, encoding = self.open_source(path)
+        with source:
+            data = os.pread(source.fileno(),
+                            os.fstat(source.fileno()).st_size, 0)
+        self.request(task, 'PUT', key, data=data,
+                     headers=self.source_headers(encoding))
+        return None
+
+    def put_multipart(self, task, key, path):
+        source, encoding = self.open_source(path)
+        with source:
+            size = os.fstat(source.fileno()).st_size
+            upload = self.start_multipart(task, key,
+                                          self.source_headers(encoding))
+
+            def transfer(part):
+                number, offset = part
+                data = os.pread(source.fileno(),
+                                min(self.part_size, size - offset), offset)
+                response = self.request(
+                    task, 'PUT', key, data=data,
+                    params=dict(partNumber=str(number),
+                                uploadId=upload['id']))
+                upload['parts'][number] = response.headers['ETag']
+
+            try:
+                self.map(transfer, list(enumerate(
+                    range(0, size, self.part_size), start=1)))
+                self.complete_multipart(task, upload)
+            except BaseException:
+                self.abort_multipart(task, upload)
+                raise
+
+    def start_multipart(self, task, key, headers):
+        response = self.request(task, 'POST', key, params=dict(uploads=''),
+                                headers=headers)
+        upload_id = ET.fromstring(response.content).find(
+            's3:UploadId', S3_NAMESPACE).text
+        return dict(key=key, id=upload_id, parts={})
+
+    def complete_multipart(self, task, upload):
+        parts = ''.join(
+            '<Part><PartNumber>{number}</PartNumber>'
+            '<ETag>{etag}</ETag></Part>'.format(number=number, etag=etag)
+            for number, etag in sorted(upload['parts'].items()))
+        data = ('<CompleteMultipartUpload>{parts}'
+                '</CompleteMultipartUpload>').format(parts=parts)
+        response = self.request(
+            task, 'POST', upload['key'], params=dict(uploadId=upload['id']),
+            data=data.encode('utf-8'))
+        # An error is reported in the body of a successful response
+        if b'<Error>' in response.content:
+            raise TaskException(task, 'Failed to complete upload of {key}'
+                                .format(key=upload['key']))
+
+    def abort_multipart(self, task, upload):
+        try:
+            self.request(task, 'DELETE', upload['key'],
+                         params=dict(uploadId=upload['id']), ok=(204,))
+        except TaskException as exc:
+            task.logger.warning(exc)
+
+    def link_files(self, task, links):
+        def copy(link):
+            key, src_key = link
+            response = self.request(
+                task, 'PUT', key, headers={
+                    'x-amz-copy-source': quote(
+                        '/{bucket}/{key}'.format(
+                            bucket=self.bucket, key=src_key),
+                        safe='-_.~/')})
+            if b'<Error>' in response.content:
+                raise TaskException(task, 'Failed to copy {src} to {key}'
+                                    .format(src=src_key, key=key))
+
+        self.map(copy, links)
+
+    def list_objects(self, task, prefix):
+        """Yield the (key, last modified timestamp) of the objects"""
+        params = {'list-type': '2', 'prefix': prefix}
+        while True:
+            response = self.request(task, 'GET', params=params)
+            result = ET.fromstring(response.content)
+            for item in result.findall('s3:Contents', S3_NAMESPACE):
+                modified = item.find('s3:LastModified', S3_NAMESPACE).text
+                yield (item.find('s3:Key', S3_NAMESPACE).text,
+                       calendar.timegm(time.strptime(
+                           modified[:19], '%Y-%m-%dT%H:%M:%S')))
+            token = result.find('s3:NextContinuationToken', S3_NAMESPACE)
+            if token is None:
+                return
+            params['continuation-token'] = token.text
+
+    def prune_blobs(self, task, min_age=S3_PRUNE_MIN_AGE):
+        """
+        Remove the blobs not listed in any job manifest. Blobs younger
+        than min_age may belong to a job still being uploaded, they
+        are kept.
+        """
+        manifests = [key for key, _modified in self.list_objects(task, 'jobs/')
+                     if key.endswith('/' + MANIFEST_FILE)]
+
+        def digests(key):
+            files = json.loads(
+                self.request(task, 'GET', key).content.decode('utf-8'))
+            return {entry['sha256'] for entry in files['files'].values()}
+
+        used = set()
+        for job_digests in self.map(digests, manifests):
+            used.update(blob_key(digest) for digest in job_digests)
+        unused = [
+            key for key, modified in self.list_objects(
+                task, ARTIFACT_BLOBS_DIR + '/')
+            if key not in used and modified < time.time() - min_age]
+        self.map(
+            lambda key: self.request(task, 'DELETE', key, ok=(204,)), unused)
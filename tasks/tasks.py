@@ -6,16 +6,34 @@ import urllib
 import uuid
 
 from .ansible import AnsiblePlaybook
+from .artifacts import ArtifactUpload
+from .build_cache import BuildCache, resolve_cache_key
+from .builder_cache import BuilderCache
 from .common import (FallibleTask, TaskException, PopenTask,
-                     logging_init_file_handler, create_file_from_template)
+                     logging_init_job_logger, logging_close_job_logger,
+                     create_file_from_template)
 from . import constants
-from .remote_storage import GzipLogFiles, FedoraPeopleUpload
+from .overlays import lineage_key, overlay_key
+from .remote_storage import GzipLogFiles, fedorapeople_storage
+from .resources import ResourceSampler
+from .topologies import TopologyRegistry, TopologySpec
+from .tracing import Tracer
 from .vagrant import with_vagrant
+from .vm_pool import checkpoint_key
+from .yum_repo import CreateRepo
 
 
 class JobTask(FallibleTask):
+    # Whether other jobs depend on the uploaded artifacts, so the job can't
+    # be reported finished until they are uploaded
+    wait_for_upload = False
+
     def __init__(self, template, no_destroy=False, publish_artifacts=True,
-                 link_image=True, topology=None, **kwargs):
+                 link_image=True, topology=None,
+                 sample_interval=constants.RESOURCE_SAMPLE_INTERVAL,
+                 compress_runner_log=True,
+                 gzip_level=constants.GZIP_LEVEL, gzip_workers=None,
+                 storage=None, **kwargs):
         super(JobTask, self).__init__(**kwargs)
         self.template_name = template['name']
         self.template_version = template['version']
@@ -27,29 +45,100 @@ class JobTask(FallibleTask):
         self.no_destroy = no_destroy
         self.description = '<no description>'
         self.link_image = link_image
+        self.cwd = self.data_dir
+        self.job_logger = None
+        self.tracer = Tracer('{task} {uuid}'.format(task=self, uuid=self.uuid))
+        self.sample_interval = sample_interval
+        self.sampler = None
+        self.compress_runner_log = compress_runner_log
+        self.gzip_level = gzip_level
+        self.gzip_workers = gzip_workers
+        if storage is None:
+            storage = fedorapeople_storage()
+        self.storage = storage
+        self.upload_queue = None
+        self.upload_queued = False
+        self.mirror = None
+        self.package_proxy_url = None
+        self.vm_pool = None
+        self.overlay_store = None
+        self.overlay_held = None
+        self.source_ref = None
+        self.teardown_queue = None
+        self.teardown_queued = False
+        self.topologies = None
+
+    @classmethod
+    def vagrantfile_name(cls, topology_name=None):
+        """Name of the Vagrantfile template of the jobs of a topology"""
+        return cls.action_name
 
     @property
     def vagrantfile(self):
         return constants.VAGRANTFILE_TEMPLATE.format(
-            vagrantfile_name=self.action_name)
+            vagrantfile_name=self.vagrantfile_name())
+
+    def overlay_keys(self):
+        """
+        Keys (see OverlayStore.create) of the disks of the provisioned VMs
+        of the job, None if they can't be reused by other jobs
+        """
+        return None
+
+    def skip_package_provisioning(self, skip=True):
+        """
+        Whether the VMs boot from disks with the packages installed, only
+        called for jobs with overlay keys
+        """
+
+    def checkpoint_key(self):
+        """
+        Key of the VM pool checkpoint of the provisioned VMs of the job,
+        None if they aren't resumed from checkpoints
+        """
+        return None
+
+    def check_checkpoint(self):
+        """
+        Raise TaskException if the resumed VMs aren't usable, only called
+        for jobs with a checkpoint key
+        """
+
+    def vagrantfile_vars(self):
+        return dict(vagrant_template_name=self.template_name,
+                    vagrant_template_version=self.template_version)
 
     @property
     def data_dir(self):
         return os.path.join(constants.JOBS_DIR, self.uuid)
 
+    @property
+    def storage_url(self):
+        """URL of the job directory in the artifact storage"""
+        return self.storage.url(
+            constants.ARTIFACT_JOB_KEY.format(uuid=self.uuid, path='')
+        ).rstrip('/')
+
+    @property
+    def job_url(self):
+        return self.storage_url + constants.TRACE_URL_FRAGMENT.format(
+            trace_id=self.tracer.trace_id)
+
     def compress_logs(self):
         self.execute_subtask(
-            GzipLogFiles(self.data_dir, raise_on_err=False))
+            GzipLogFiles(self.data_dir, level=self.gzip_level,
+                         workers=self.gzip_workers, raise_on_err=False))
 
     def write_hostname_to_file(self):
         try:
             hostname = socket.gethostname()
             hostname = hostname.split('.')[0]  # make sure we don't leak fqdn
-            with open('hostname', 'w') as hostname_f:
+            with open(os.path.join(self.data_dir, 'hostname'),
+                      'w') as hostname_f:
                 hostname_f.write(hostname)
         except Exception as exc:
-            logging.warning("Failed to write hostname to file")
-            logging.debug(exc, exc_info=True)
+            self.logger.warning("Failed to write hostname to file")
+            self.logger.debug(exc, exc_info=True)
 
     def _before(self):
         # Create job dir
@@ -57,111 +146,280 @@ class JobTask(FallibleTask):
             os.makedirs(self.data_dir)
         except (OSError, IOError) as exc:
             msg = "Failed to create job directory"
-            logging.critical(msg)
-            logging.debug(exc, exc_info=True)
+            self.logger.critical(msg)
+            self.logger.debug(exc, exc_info=True)
             raise TaskException(self, msg)
 
-        # Change working dir and initialize logging
-        os.chdir(self.data_dir)
-        logging_init_file_handler()
+        # Initialize job logging, the job dir is passed to subprocesses
+        # as their working dir. A compressed runner log is already skipped
+        # by GzipLogFiles.
+        self.job_logger = logging_init_job_logger(
+            'job.{uuid}'.format(uuid=self.uuid),
+            os.path.join(self.data_dir, constants.RUNNER_LOG),
+            compress=self.compress_runner_log)
+        self.logger = self.job_logger
 
-        logging.info("Initializing job {uuid}".format(uuid=self.uuid))
+        self.logger.info("Initializing job {uuid}".format(uuid=self.uuid))
 
         # Create a hostname file for debugging purposes
         self.write_hostname_to_file()
 
+        self.start_sampling()
+
         # Prepare files for vagrant
         try:
             shutil.copy(constants.ANSIBLE_CFG_FILE, self.data_dir)
             create_file_from_template(
                 self.vagrantfile,
                 os.path.join(self.data_dir, 'Vagrantfile'),
-                dict(vagrant_template_name=self.template_name,
-                     vagrant_template_version=self.template_version))
+                self.vagrantfile_vars())
         except (OSError, IOError) as exc:
             msg = "Failed to prepare job"
-            logging.critical(msg)
-            logging.debug(exc, exc_info=True)
+            self.logger.critical(msg)
+            self.logger.debug(exc, exc_info=True)
             raise TaskException(self, msg)
 
+    def start_sampling(self):
+        if not self.sample_interval:
+            return
+        self.sampler = ResourceSampler(
+            self, os.path.join(self.data_dir, constants.RESOURCES_FILE),
+            self.sample_interval, match=self.uuid)
+        self.sampler.start()
+
+    def stop_sampling(self):
+        if self.sampler is None:
+            return
+        self.sampler.stop()
+        self.logger.info('Resource usage: {sampler}'.format(
+            sampler=self.sampler))
+        self.sampler = None
+
+    def write_trace(self):
+        try:
+            self.tracer.write(
+                os.path.join(self.data_dir, constants.TRACE_FILE),
+                os.path.join(self.data_dir, constants.TRACE_SUMMARY_FILE))
+        except (OSError, IOError) as exc:
+            self.logger.warning("Failed to write job trace")
+            self.logger.debug(exc, exc_info=True)
+
     def _after(self):
+        self.stop_sampling()
         self.compress_logs()
-        if self.publish_artifacts:
-            self.upload_artifacts()
 
     def upload_artifacts(self):
+        if self.upload_queue is not None:
+            self.queue_artifacts()
+            return
         try:
             self.execute_subtask(
-                FedoraPeopleUpload(uuid=self.uuid, timeout=5*60))
+                ArtifactUpload(self.data_dir, self.uuid, self.storage,
+                               timeout=constants.ARTIFACT_UPLOAD_TIMEOUT))
         except Exception as exc:
-            logging.debug(exc, exc_info=True)
+            self.logger.debug(exc, exc_info=True)
             raise TaskException(self, "Failed to publish artifacts")
         else:
-            self.remote_url = urllib.parse.urljoin(
-                constants.FEDORAPEOPLE_JOBS_URL, self.uuid)
-            logging.info('Job published at: {remote_url}'.format(
+            self.remote_url = self.job_url
+            self.logger.info('Job published at: {remote_url}'.format(
                 remote_url=self.remote_url))
 
+    def queue_artifacts(self):
+        try:
+            self.upload_queue.put(self.uuid, self.data_dir)
+        except (OSError, IOError) as exc:
+            self.logger.debug(exc, exc_info=True)
+            raise TaskException(self, "Failed to queue artifacts")
+        self.upload_queued = True
+        self.remote_url = self.job_url
+        self.logger.info('Job queued for upload to: {remote_url}'.format(
+            remote_url=self.remote_url))
+
+    def close_job_logger(self):
+        if self.job_logger is not None:
+            logging_close_job_logger(self.job_logger)
+            self.job_logger = None
+            self.logger = logging.getLogger()
+
+    def __call__(self):
+        succeeded = False
+        try:
+            super(JobTask, self).__call__()
+            succeeded = True
+        finally:
+            self.stop_sampling()
+            created = os.path.isdir(self.data_dir)
+            if created:
+                # The job span is finished, so the published trace
+                # has the final outcome of the job
+                self.write_trace()
+            # Complete the compressed runner log before it is hashed and
+            # uploaded, the upload itself is logged by the runner only
+            self.close_job_logger()
+            if created and self.publish_artifacts:
+                self.publish(succeeded)
+
+    def publish(self, succeeded):
+        """
+        Upload the artifacts of the job. A failed upload fails a job that
+        succeeded, it doesn't replace the error of a job that failed.
+        """
+        try:
+            self.upload_artifacts()
+        except TaskException as exc:
+            if succeeded and self.raise_on_err:
+                raise
+            self.logger.error(exc)
+            return
+        if not self.upload_queued:
+            # The local copy also records the upload
+            self.write_trace()
+
     def terminate(self):
-        logging.critical(
+        self.logger.critical(
             "Terminating execution, runtime exceeded {seconds}s".format(
                 seconds=self.timeout))
 
         # Common cause of job timeout: out of disk space
         stat = os.statvfs(self.data_dir)
         if stat.f_bavail == 0:
-            logging.critical('No free disk space')
+            self.logger.critical('No free disk space')
 
         super(JobTask, self).terminate()
 
 
 class Build(JobTask):
     action_name = 'build'
+    wait_for_upload = True
 
     def __init__(self, template, git_refspec=None, git_version=None, git_repo=None,
-                 timeout=constants.BUILD_TIMEOUT, topology=None, **kwargs):
+                 timeout=constants.BUILD_TIMEOUT, topology=None,
+                 build_cache=True, builder_cache=True,
+                 createrepo_workers=None, createrepo_database=True, **kwargs):
+        """
+        build_cache: if True, a previous successful build of the same source
+                     tree, template and build playbooks is reused
+        builder_cache: if True, the mock caches (buildroot, dnf packages and
+                       ccache) persist on the runner across builds
+        createrepo_workers: number of createrepo workers, one per CPU by
+                            default
+        createrepo_database: if False, the sqlite databases of the yum
+                             repository aren't generated
+        """
         super(Build, self).__init__(template, timeout=timeout, **kwargs)
         self.git_refspec = git_refspec
         self.git_version = git_version
         self.git_repo = git_repo
+        self.build_cache = build_cache
+        self.cache_key = None
+        self.cached_build = None
+        self.builder_cache = BuilderCache() if builder_cache else None
+        self.createrepo_workers = createrepo_workers
+        self.createrepo_database = createrepo_database
+
+    def _before(self):
+        super(Build, self)._before()
+        if self.builder_cache is not None:
+            # Before the builder VM mounts the caches
+            self.builder_cache.prepare()
+            self.builder_cache.trim(self.logger)
+
+    def vagrantfile_vars(self):
+        template_vars = super(Build, self).vagrantfile_vars()
+        if self.builder_cache is not None:
+            template_vars.update(
+                builder_cache_dir=self.builder_cache.path,
+                builder_cache_mount=constants.BUILDER_CACHE_MOUNT)
+        return template_vars
 
-    @with_vagrant
     def _run(self):
+        if self.build_cache and self.publish_artifacts:
+            self.lookup_build()
+        if self.cached_build is not None:
+            self.logger.info('Reusing build {uuid}: {url}'.format(
+                **self.cached_build))
+            self.logger.info('>>>>>> BUILD PASSED <<<<<<')
+            self.returncode = 0
+            return
+        self.build_in_vm()
+
+    @with_vagrant
+    def build_in_vm(self):
         try:
             self.build()
-            logging.info('>>>>>> BUILD PASSED <<<<<<')
+            self.logger.info('>>>>>> BUILD PASSED <<<<<<')
             self.returncode = 0
         except TaskException:
-            logging.error('>>>>>> BUILD FAILED <<<<<<')
+            self.logger.error('>>>>>> BUILD FAILED <<<<<<')
             self.returncode = 1
         finally:
             self.collect_build_artifacts()
 
     def _after(self):
+        self.stop_sampling()
         self.compress_logs()
-        if self.publish_artifacts:
+        if self.publish_artifacts and self.cached_build is None:
             try:
                 self.create_yum_repo()
             except TaskException:
-                logging.error('Failed to create repo')
+                self.logger.error('Failed to create repo')
                 self.returncode = 1
-            finally:
-                self.upload_artifacts()
 
         if self.returncode == 0:
             self.description = constants.BUILD_PASSED_DESCRIPTION
         else:
             self.description = constants.BUILD_FAILED_DESCRIPTION
 
+    def lookup_build(self):
+        template = dict(name=self.template_name,
+                        version=self.template_version)
+        self.cache_key = resolve_cache_key(
+            self, template, self.git_repo,
+            self.git_version or self.git_refspec or 'master')
+        if self.cache_key is None:
+            return
+        try:
+            self.cached_build = BuildCache(self.storage).lookup(
+                self, self.cache_key)
+        except TaskException as exc:
+            self.logger.warning('Build cache lookup failed: %s', exc)
+
+    def record_build(self):
+        try:
+            BuildCache(self.storage).record(
+                self, self.cache_key, self.uuid, self.remote_url,
+                self.description)
+        except (TaskException, OSError, IOError) as exc:
+            self.logger.warning('Failed to record the build: %s', exc)
+
+    def __call__(self):
+        super(Build, self).__call__()
+        if self.cached_build is not None:
+            # The packages are in the repository of the cached build
+            self.remote_url = self.cached_build['url']
+        elif self.cache_key is not None and self.returncode == 0:
+            self.record_build()
+
     def build(self):
-        self.execute_subtask(
-            AnsiblePlaybook(
-                playbook=constants.ANSIBLE_PLAYBOOK_BUILD,
-                extra_vars={
-                    'git_refspec': self.git_refspec,
-                    'git_version': self.git_version,
-                    'git_repo': self.git_repo},
-                timeout=None))
+        extra_vars = {
+            'git_refspec': self.git_refspec,
+            'git_version': self.git_version,
+            'git_repo': self.git_repo}
+        if self.builder_cache is not None:
+            extra_vars.update(
+                builder_cache=constants.BUILDER_CACHE_MOUNT,
+                ccache_size=self.builder_cache.ccache_size)
+            before = self.builder_cache.snapshot()
+        try:
+            self.execute_subtask(
+                AnsiblePlaybook(
+                    playbook=constants.ANSIBLE_PLAYBOOK_BUILD,
+                    extra_vars=extra_vars,
+                    timeout=None))
+        finally:
+            if self.builder_cache is not None:
+                self.builder_cache.report(
+                    before, self.builder_cache.snapshot(), self.logger)
 
     def collect_build_artifacts(self):
         self.execute_subtask(
@@ -169,31 +427,36 @@ class Build(JobTask):
                 playbook=constants.ANSIBLE_PLAYBOOK_COLLECT_BUILD,
                 raise_on_err=False))
 
-    def create_yum_repo(self, base_url=constants.FEDORAPEOPLE_JOBS_URL):
+    def create_yum_repo(self):
         repo_path = os.path.join(self.data_dir, 'rpms')
         self.execute_subtask(
-            PopenTask(['createrepo', repo_path]))
+            CreateRepo(repo_path, self.template_name,
+                       workers=self.createrepo_workers,
+                       database=self.createrepo_database, timeout=None))
         try:
             create_file_from_template(
                 constants.FREEIPA_PRCI_REPOFILE,
                 os.path.join(repo_path, constants.FREEIPA_PRCI_REPOFILE),
-                dict(job_url=urllib.parse.urljoin(base_url, self.uuid)))
+                dict(job_url=self.storage_url))
         except (OSError, IOError) as exc:
             msg = 'Failed to create repo file'
-            logging.debug(exc, exc_info=True)
-            logging.error(msg)
+            self.logger.debug(exc, exc_info=True)
+            self.logger.error(msg)
             raise TaskException(self, msg)
 
 
 class RunPytest(JobTask):
     action_name = 'run_pytest'
     run_tests_cmd = 'ipa-run-tests'
+    # Whether the topology can be generated from a spec (see TopologySpec)
+    generates_topology = True
 
     def __init__(self, template, build_url, test_suite, topology=None,
                  timeout=constants.RUN_PYTEST_TIMEOUT, update_packages=False,
                  xmlrpc=False, **kwargs):
         super(RunPytest, self).__init__(template, timeout=timeout, **kwargs)
-        self.build_url = build_url + '/'
+        # Drop the trace fragment of the build job URL
+        self.build_url = urllib.parse.urldefrag(build_url).url + '/'
         self.test_suite = test_suite
         self.update_packages = update_packages
         self.xmlrpc = xmlrpc
@@ -201,12 +464,52 @@ class RunPytest(JobTask):
         if not topology:
             topology = {'name': constants.DEFAULT_TOPOLOGY}
 
-        self.topology_name = topology['name']
+        self.topology = topology
+        if self.generates_topology and TopologySpec.is_spec(topology):
+            self.topology_name = TopologySpec.from_dict(topology).name
+        else:
+            self.topology_name = topology['name']
+
+    @classmethod
+    def vagrantfile_name(cls, topology_name=None):
+        return topology_name or constants.DEFAULT_TOPOLOGY
+
+    @property
+    def topology_spec(self):
+        """
+        The TopologySpec the Vagrantfile is generated from, None if the
+        Vagrantfile of the topology is booted as is
+        """
+        if not self.generates_topology:
+            return None
+        topologies = self.topologies if self.topologies is not None \
+            else TopologyRegistry()
+        return topologies.spec(self.vagrantfile_name(self.topology_name),
+                               self.topology)
+
+    @property
+    def ipa_test_config_path(self):
+        """The test config the runner writes, None if the controller does"""
+        spec = self.topology_spec
+        if spec is None or spec.with_controller:
+            return None
+        return os.path.join(self.data_dir, 'ipa-test-config.yaml')
 
     @property
     def vagrantfile(self):
+        if self.topology_spec is not None:
+            vagrantfile_name = constants.GENERATED_TOPOLOGY
+        else:
+            vagrantfile_name = self.vagrantfile_name(self.topology_name)
         return constants.VAGRANTFILE_TEMPLATE.format(
-            vagrantfile_name=self.topology_name)
+            vagrantfile_name=vagrantfile_name)
+
+    def vagrantfile_vars(self):
+        template_vars = super(RunPytest, self).vagrantfile_vars()
+        spec = self.topology_spec
+        if spec is not None:
+            template_vars.update(spec.vagrantfile_vars())
+        return template_vars
 
     def _before(self):
         super(RunPytest, self)._before()
@@ -218,19 +521,75 @@ class RunPytest(JobTask):
                     action_name=self.action_name),
                 os.path.join(self.data_dir, 'vars.yml'),
                 dict(repofile_url=urllib.parse.urljoin(
-                        self.build_url, 'rpms/freeipa-prci.repo'),
-                     update_packages=self.update_packages))
+                        self.repo_url(), 'rpms/freeipa-prci.repo'),
+                     update_packages=self.update_packages,
+                     package_proxy_url=self.package_proxy_url,
+                     ipa_test_config_path=self.ipa_test_config_path))
         except (OSError, IOError) as exc:
             msg = "Failed to prepare test config files"
-            logging.debug(exc, exc_info=True)
-            logging.critical(msg)
+            self.logger.debug(exc, exc_info=True)
+            self.logger.critical(msg)
             raise exc
 
+    @property
+    def installs_server(self):
+        """Whether the provisioning installs an IPA server"""
+        return self.xmlrpc
+
+    def read_vagrantfile(self):
+        with open(os.path.join(self.data_dir, 'Vagrantfile')) as vagrant_f:
+            return vagrant_f.read()
+
+    def overlay_keys(self):
+        if self.installs_server:
+            # Provisioning the disks again would install another server
+            return None
+        keys = (self.template_name, self.template_version,
+                self.read_vagrantfile())
+        return dict(
+            key=overlay_key(*keys, build_url=self.build_url,
+                            update_packages=self.update_packages),
+            lineage=lineage_key(self.source_ref, *keys,
+                                update_packages=self.update_packages),
+            build_url=self.build_url)
+
+    def skip_package_provisioning(self, skip=True):
+        path = os.path.join(self.data_dir, 'vars.yml')
+        with open(path) as vars_f:
+            lines = [line for line in vars_f
+                     if not line.startswith('provisioned_packages:')]
+        if skip:
+            lines.append('provisioned_packages: true\n')
+        with open(path, 'w') as vars_f:
+            vars_f.writelines(lines)
+
+    def checkpoint_key(self):
+        if not self.installs_server:
+            return None
+        return checkpoint_key(self.template_name, self.read_vagrantfile(),
+                              self.build_url, self.update_packages)
+
+    def check_checkpoint(self):
+        self.execute_subtask(
+            PopenTask(['vagrant', 'ssh', '-c', constants.IPA_HEALTH_CHECK],
+                      timeout=constants.IPA_HEALTH_CHECK_TIMEOUT))
+
+    def repo_url(self):
+        """URL of the build job the VMs install the packages from"""
+        if self.mirror is None:
+            return self.build_url
+        try:
+            return self.mirror.fetch(self, self.build_url)
+        except (TaskException, OSError, IOError, ValueError) as exc:
+            # urllib errors are OSErrors
+            self.logger.warning('Failed to mirror the build: %s', exc)
+            return self.build_url
+
     @with_vagrant
     def _run(self):
         try:
             self.execute_tests()
-            logging.info('>>>>> TESTS PASSED <<<<<<')
+            self.logger.info('>>>>> TESTS PASSED <<<<<<')
             self.returncode = 0
         except TaskException as exc:
             self.returncode = exc.task.returncode
@@ -256,9 +615,9 @@ class RunPytest(JobTask):
 
     def _handle_test_exception(self, exc):
         if self.returncode == 1:
-            logging.error('>>>>>> TESTS FAILED <<<<<<')
+            self.logger.error('>>>>>> TESTS FAILED <<<<<<')
         else:
-            logging.error('>>>>>> PYTEST ERROR ({code}) <<<<<<'.format(
+            self.logger.error('>>>>>> PYTEST ERROR ({code}) <<<<<<'.format(
                 code=self.returncode))
 
 
@@ -272,11 +631,12 @@ class RunPytest3(RunPytest):
 
 class RunWebuiTests(RunPytest):
     action_name = 'webui'
+    installs_server = True
+    generates_topology = False
 
-    @property
-    def vagrantfile(self):
-        return constants.VAGRANTFILE_TEMPLATE.format(
-            vagrantfile_name='ipaserver')
+    @classmethod
+    def vagrantfile_name(cls, topology_name=None):
+        return 'ipaserver'
 
     def execute_tests(self):
         self.execute_subtask(
@@ -288,6 +648,6 @@ class RunWebuiTests(RunPytest):
                 timeout=None))
 
     def _handle_test_exception(self, exc):
-        logging.error(
+        self.logger.error(
             '>>>>>> WEBUI TESTS FAILED (error code: {code}) <<<<<<'.format(
                 code=self.returncode))
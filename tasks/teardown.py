@@ -0,0 +1,133 @@
+import collections
+import logging
+import threading
+import time
+
+from .common import TaskException
+from . import constants
+from .vagrant import DestroyDomains
+
+
+class TeardownQueue(object):
+    """
+    Destroys the VMs of finished jobs in the background
+
+    The VMs of a job are destroyed through libvirt (see DestroyDomains),
+    so the runner takes its next job meanwhile and no other job on the
+    host is disturbed. A failed teardown is retried after backoff seconds,
+    up to retries times.
+
+    when_done(uuid, callback) calls callback() once the VMs of the job
+    are confirmed destroyed, e.g. to give its resources back. It's never
+    called for VMs that couldn't be destroyed, their resources stay taken.
+    Callbacks run in the threads of the queue.
+    """
+    def __init__(self, workers=constants.TEARDOWN_WORKERS,
+                 retries=constants.TEARDOWN_RETRIES,
+                 backoff=constants.TEARDOWN_BACKOFF,
+                 timeout=constants.TEARDOWN_TIMEOUT):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.queue = collections.deque()
+        self.pending = set()
+        self.done = set()
+        self.callbacks = {}
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.threads = []
+        self.logger = logging.getLogger(__name__)
+
+    def start(self):
+        with self.cond:
+            self.stopping = False
+        for _i in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Wait for the queued teardowns and stop the workers"""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def __len__(self):
+        with self.cond:
+            return len(self.pending)
+
+    def put(self, uuid, directory, after=None):
+        """
+        Destroy the VMs of the vagrant environment of job uuid in directory,
+        then call after() if given
+        """
+        with self.cond:
+            self.pending.add(uuid)
+            self.queue.append((uuid, directory, after))
+            self.cond.notify()
+
+    def when_done(self, uuid, callback):
+        with self.cond:
+            if uuid in self.pending:
+                self.callbacks.setdefault(uuid, []).append(callback)
+                return
+            if uuid not in self.done:
+                self.logger.error('VMs of job %s not destroyed', uuid)
+                return
+            self.done.discard(uuid)
+        callback()
+
+    def next_entry(self):
+        """Wait for a queued teardown, None once stopping with none left"""
+        with self.cond:
+            while not self.queue:
+                if self.stopping:
+                    return None
+                self.cond.wait()
+            return self.queue.popleft()
+
+    def work(self):
+        while True:
+            entry = self.next_entry()
+            if entry is None:
+                return
+            uuid, directory, after = entry
+            destroyed = self.destroy(uuid, directory)
+            if destroyed and after is not None:
+                try:
+                    after()
+                except Exception as exc:
+                    self.logger.warning('Failed to complete teardown of %s: '
+                                        '%s', uuid, exc)
+                    self.logger.debug(exc, exc_info=True)
+            with self.cond:
+                self.pending.discard(uuid)
+                callbacks = self.callbacks.pop(uuid, [])
+                if destroyed and not callbacks:
+                    self.done.add(uuid)
+            if not destroyed:
+                self.logger.error('VMs of job %s not destroyed, their '
+                                  'resources stay taken', uuid)
+                continue
+            for callback in callbacks:
+                callback()
+
+    def destroy(self, uuid, directory):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff)
+            start = time.time()
+            try:
+                DestroyDomains(cwd=directory, timeout=self.timeout)()
+            except TaskException as exc:
+                self.logger.warning('Teardown of job %s failed: %s',
+                                    uuid, exc)
+                continue
+            self.logger.info('Destroyed the VMs of job %s in %.1fs',
+                             uuid, time.time() - start)
+            return True
+        return False
@@ -0,0 +1,222 @@
+import collections
+import math
+import os
+import re
+
+from . import constants
+
+DEFINE_RE = re.compile(
+    r'^(?P<indent>\s*)config\.vm\.define\s+"(?P<name>[^"]+)"')
+RESOURCE_RE = re.compile(
+    r'^\s*domain\.(?P<key>cpus|memory)\s*=\s*(?P<value>\d+)')
+MACHINE_RE = re.compile(r'^(?P<role>controller|master|replica|client)\d*$')
+# The sizes of the machines of the hand-written Vagrantfiles, by role
+ROLE_DEFAULTS = {
+    'controller': dict(cpus=1, memory=950),
+    'master': dict(cpus=1, memory=2400),
+    'replica': dict(cpus=1, memory=2400),
+    'client': dict(cpus=1, memory=950),
+}
+
+
+def vagrantfile_machines(content):
+    """
+    The cpus and memory (MiB) of every machine of a Vagrantfile (template),
+    from the libvirt provider defaults and the overrides of the machine
+    """
+    defaults = dict(cpus=constants.VAGRANT_DEFAULT_CPUS,
+                    memory=constants.VAGRANT_DEFAULT_MEMORY)
+    machines = {}
+    machine = indent = None
+    for line in content.splitlines():
+        match = DEFINE_RE.match(line)
+        if match is not None:
+            machine, indent = match.group('name'), match.group('indent')
+            machines[machine] = {}
+            continue
+        if machine is not None and line == indent + 'end':
+            machine = None
+            continue
+        match = RESOURCE_RE.match(line)
+        if match is not None:
+            resources = machines[machine] if machine is not None \
+                else defaults
+            resources[match.group('key')] = int(match.group('value'))
+    return {name: dict(defaults, **resources)
+            for name, resources in machines.items()}
+
+
+class TopologySpec(object):
+    """
+    A topology declared by its shape rather than by a Vagrantfile
+
+    A master, replicas replicas and clients clients, plus the controller
+    provisioning them and running the tests unless with_controller is
+    False. The cpus and memory of every role default to the ones of the
+    hand-written Vagrantfiles (ROLE_DEFAULTS). In a tasks file:
+
+    topology:
+        name: master_1repl_1client
+        replicas: 1
+        clients: 1
+        master: {cpus: 2, memory: 2400}
+        client: {memory: 750}
+
+    The Vagrantfile of the topology is rendered from
+    Vagrantfile.{GENERATED_TOPOLOGY}.
+    """
+    KEYS = ('replicas', 'clients') + tuple(ROLE_DEFAULTS)
+
+    def __init__(self, replicas=0, clients=0, name=None,
+                 with_controller=True, **roles):
+        unknown = set(roles) - set(ROLE_DEFAULTS)
+        if unknown:
+            raise ValueError('Unknown topology roles: {roles}'.format(
+                roles=', '.join(sorted(unknown))))
+        self.replicas = int(replicas)
+        self.clients = int(clients)
+        if self.replicas < 0 or self.clients < 0:
+            raise ValueError('Negative number of replicas or clients')
+        self.roles = {role: dict(defaults, **(roles.get(role) or {}))
+                      for role, defaults in ROLE_DEFAULTS.items()}
+        self.name = name if name is not None else \
+            'master_{replicas}repl_{clients}client'.format(
+                replicas=self.replicas, clients=self.clients)
+        self.with_controller = with_controller
+
+    @staticmethod
+    def is_spec(topology):
+        """Whether topology (tasks file data) declares a shape"""
+        return bool(topology) and any(
+            key in topology for key in TopologySpec.KEYS)
+
+    @staticmethod
+    def from_dict(topology, with_controller=True):
+        return TopologySpec(with_controller=with_controller,
+                            **{key: value for key, value in topology.items()
+                               if key not in ('cpu', 'memory')})
+
+    @staticmethod
+    def from_machines(name, machines, with_controller=True):
+        """
+        The spec of the machines of a hand-written Vagrantfile (see
+        vagrantfile_machines), None if they don't fit a spec: machines
+        named after their role, of the same size within a role
+        """
+        roles = {}
+        counts = collections.Counter()
+        for machine, resources in machines.items():
+            match = MACHINE_RE.match(machine)
+            if match is None:
+                return None
+            role = match.group('role')
+            if roles.setdefault(role, resources) != resources:
+                return None
+            counts[role] += 1
+        spec = TopologySpec(counts['replica'], counts['client'], name,
+                            with_controller, **roles)
+        names = {machine['name'] for machine in spec.machines()}
+        if 'master' not in roles or \
+                names - {'controller'} != set(machines) - {'controller'}:
+            return None
+        return spec
+
+    def machines(self):
+        """The machines in the order they're defined, with their role"""
+        machines = [('controller', 'controller')] if self.with_controller \
+            else []
+        machines.append(('master', 'master'))
+        machines.extend(('replica{i}'.format(i=i), 'replica')
+                        for i in range(self.replicas))
+        machines.extend(('client{i}'.format(i=i), 'client')
+                        for i in range(self.clients))
+        # The primary machine runs the tests
+        primary = machines[0][0]
+        return [dict(self.roles[role], name=name, role=role,
+                     primary=name == primary)
+                for name, role in machines]
+
+    def vagrantfile_vars(self):
+        return dict(machines=self.machines())
+
+
+class TopologyRegistry(object):
+    """
+    The resources the VMs of every Vagrantfile template need
+
+    The cpu and memory of a topology are the sums over the machines of
+    its Vagrantfile template, divided by the overcommit ratios.
+
+    With provision_from_runner, the runner provisions the VMs of RunPytest
+    jobs itself and writes their test config, their tests run from the
+    master: their topologies don't boot a controller. Their Vagrantfile
+    is generated (see spec()).
+    """
+    def __init__(self, vagrantfiles_dir=None, cpu_overcommit=1.0,
+                 memory_overcommit=1.0, provision_from_runner=False):
+        self.vagrantfiles_dir = vagrantfiles_dir \
+            if vagrantfiles_dir is not None else os.path.join(
+                constants.TEMPLATES_DIR,
+                os.path.dirname(constants.VAGRANTFILE_TEMPLATE))
+        self.cpu_overcommit = cpu_overcommit
+        self.memory_overcommit = memory_overcommit
+        self.provision_from_runner = provision_from_runner
+        self.cache = {}
+
+    @staticmethod
+    def from_config(config):
+        """Create the registry from the topologies section of the config"""
+        return TopologyRegistry(
+            cpu_overcommit=config.get('cpu_overcommit', 1.0),
+            memory_overcommit=config.get('memory_overcommit', 1.0),
+            provision_from_runner=config.get('provision_from_runner', False))
+
+    def machines(self, vagrantfile_name):
+        """The resources of the machines of a Vagrantfile, None if unknown"""
+        if vagrantfile_name not in self.cache:
+            path = os.path.join(
+                self.vagrantfiles_dir,
+                os.path.basename(constants.VAGRANTFILE_TEMPLATE).format(
+                    vagrantfile_name=vagrantfile_name))
+            try:
+                with open(path) as vagrantfile_f:
+                    machines = vagrantfile_machines(vagrantfile_f.read())
+            except (OSError, IOError):
+                machines = None
+            self.cache[vagrantfile_name] = machines or None
+        return self.cache[vagrantfile_name]
+
+    def resources(self, vagrantfile_name):
+        """The (cpu, memory in MiB) of a Vagrantfile, None if unknown"""
+        machines = self.machines(vagrantfile_name)
+        if machines is None:
+            return None
+        return self.total(machines.values())
+
+    def spec(self, vagrantfile_name, topology=None):
+        """
+        The TopologySpec the Vagrantfile of a topology is generated from,
+        None if its Vagrantfile is booted as is
+
+        topology: the topology of the job in the tasks file
+        """
+        with_controller = not self.provision_from_runner
+        if TopologySpec.is_spec(topology):
+            return TopologySpec.from_dict(topology, with_controller)
+        if with_controller:
+            return None
+        machines = self.machines(vagrantfile_name)
+        if machines is None:
+            return None
+        return TopologySpec.from_machines(vagrantfile_name, machines,
+                                          with_controller)
+
+    def spec_resources(self, spec):
+        """The (cpu, memory in MiB) of a TopologySpec"""
+        return self.total(spec.machines())
+
+    def total(self, machines):
+        cpu = sum(machine['cpus'] for machine in machines)
+        memory = sum(machine['memory'] for machine in machines)
+        return (int(math.ceil(cpu / self.cpu_overcommit)),
+                int(math.ceil(memory / self.memory_overcommit)))
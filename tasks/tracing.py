@@ -0,0 +1,129 @@
+import collections
+import json
+import os
+import threading
+import time
+import uuid
+
+
+OUTCOME_OK = 'ok'
+OUTCOME_ERROR = 'error'
+OUTCOME_TIMEOUT = 'timeout'
+OUTCOME_RUNNING = 'running'
+
+
+class Span(object):
+    """Execution of a single task within a trace"""
+    __slots__ = ('span_id', 'parent', 'name', 'category', 'depth',
+                 'start', 'end', 'outcome', 'error', '_started')
+
+    def __init__(self, span_id, parent, name, category):
+        self.span_id = span_id
+        self.parent = parent
+        self.name = name
+        self.category = category
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.start = time.time()
+        self.end = None
+        self.outcome = OUTCOME_RUNNING
+        self.error = None
+        self._started = time.perf_counter()
+
+    def finish(self, outcome=OUTCOME_OK, error=None):
+        self.end = self.start + time.perf_counter() - self._started
+        self.outcome = outcome
+        if error is not None:
+            self.error = str(error)
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return time.time() - self.start
+        return self.end - self.start
+
+
+class Tracer(object):
+    """
+    Records the execution of a task tree.
+
+    Every task called with a tracer set records a span with its start, end,
+    outcome and parent span. Spans can be exported in Chrome trace event
+    format (loadable by chrome://tracing or Perfetto) and as a compact
+    per-phase summary.
+    """
+    def __init__(self, name, trace_id=None):
+        self.name = name
+        self.trace_id = trace_id if trace_id is not None else uuid.uuid4().hex
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def start(self, task, parent=None):
+        with self.lock:
+            span = Span(len(self.spans) + 1, parent, str(task),
+                        type(task).__name__)
+            self.spans.append(span)
+        return span
+
+    def to_chrome_trace(self):
+        pid = os.getpid()
+        events = [{
+            'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 1,
+            'args': {'name': self.name}}]
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            args = {
+                'span_id': span.span_id,
+                'parent_id': span.parent.span_id if span.parent else None,
+                'outcome': span.outcome}
+            if span.error is not None:
+                args['error'] = span.error
+            # Subtasks are executed synchronously, so all spans of a job
+            # share one track and nest by time
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': int(span.start * 1e6),
+                'dur': int(span.duration * 1e6),
+                'pid': pid,
+                'tid': 1,
+                'args': args})
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'trace_id': self.trace_id, 'name': self.name}}
+
+    def summary(self):
+        """
+        Duration and outcome of the top level phases, plus time spent in
+        each task type
+        """
+        with self.lock:
+            spans = list(self.spans)
+        roots = [span for span in spans if span.parent is None]
+        phases = [span for span in spans if span.parent in roots]
+        by_task = collections.OrderedDict()
+        for span in spans:
+            stats = by_task.setdefault(
+                span.category, dict(count=0, duration=0.0, errors=0))
+            stats['count'] += 1
+            stats['duration'] = round(stats['duration'] + span.duration, 3)
+            if span.outcome in (OUTCOME_ERROR, OUTCOME_TIMEOUT):
+                stats['errors'] += 1
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'duration': round(sum(span.duration for span in roots), 3),
+            'outcome': roots[0].outcome if roots else None,
+            'phases': [
+                dict(task=span.category, name=span.name,
+                     duration=round(span.duration, 3), outcome=span.outcome)
+                for span in phases],
+            'tasks': by_task}
+
+    def write(self, trace_path, summary_path):
+        with open(trace_path, 'w') as trace_file:
+            json.dump(self.to_chrome_trace(), trace_file)
+        with open(summary_path, 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
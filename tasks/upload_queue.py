@@ -0,0 +1,219 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from . import constants
+from .artifacts import ArtifactUpload
+
+
+POST_STATUS_QUEUED = 'queued'
+POST_STATUS_UPLOADED = 'uploaded'
+
+STATE_QUEUED = 'queued'
+STATE_UPLOADING = 'uploading'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+
+class UploadQueue(object):
+    """
+    Uploads job directories in the background.
+
+    Every queued upload is kept as a JSON file in state_dir until it
+    completes, so pending uploads survive a runner restart. At most
+    concurrency uploads run at once, a failed upload is retried after an
+    exponentially growing delay, up to retries times.
+
+    Once an upload is done (or has failed for good) and its status was
+    attached with set_status(), on_complete(entry) is called. Entries are
+    dicts with the uuid, directory, state and status of the upload.
+
+    post_status tells the runner when to post the final status of a job:
+    as soon as its upload is queued, or once it is uploaded.
+    """
+    def __init__(self, state_dir, storage, concurrency=2, retries=5,
+                 backoff=60, max_backoff=3600,
+                 post_status=POST_STATUS_UPLOADED, on_complete=None):
+        if post_status not in (POST_STATUS_QUEUED, POST_STATUS_UPLOADED):
+            raise ValueError('invalid post_status: {}'.format(post_status))
+        self.state_dir = state_dir
+        self.storage = storage
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.post_status = post_status
+        self.on_complete = on_complete
+        self.entries = {}
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.workers = []
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.load()
+
+    def entry_path(self, uuid):
+        return os.path.join(self.state_dir, '{uuid}.json'.format(uuid=uuid))
+
+    def load(self):
+        for name in os.listdir(self.state_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.state_dir, name)) as entry_f:
+                    entry = json.load(entry_f)
+            except (OSError, IOError, ValueError) as exc:
+                self.logger.warning('Invalid upload queue entry %s', name)
+                self.logger.debug(exc, exc_info=True)
+                continue
+            if entry['state'] == STATE_UPLOADING:
+                # Interrupted by a restart
+                entry['state'] = STATE_QUEUED
+            if entry['status'] is None:
+                # The job result was never attached before the restart,
+                # there is nobody to report the upload to
+                entry['status'] = {}
+            if entry['state'] in (STATE_DONE, STATE_FAILED):
+                # Completed, but not reported before the restart
+                os.remove(os.path.join(self.state_dir, name))
+                continue
+            if not os.path.isdir(entry['directory']):
+                self.logger.warning(
+                    'Dropping upload of missing job %s', entry['uuid'])
+                os.remove(os.path.join(self.state_dir, name))
+                continue
+            self.entries[entry['uuid']] = entry
+
+    def save(self, entry):
+        """Durably store the entry, replacing the previous state"""
+        path = self.entry_path(entry['uuid'])
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as entry_f:
+            json.dump(entry, entry_f)
+            entry_f.flush()
+            os.fsync(entry_f.fileno())
+        os.rename(tmp_path, path)
+
+    def start(self):
+        with self.cond:
+            self.stopping = False
+        for _i in range(self.concurrency):
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        """Wait for the running uploads and stop the workers"""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def __len__(self):
+        with self.cond:
+            return len(self.entries)
+
+    def __contains__(self, uuid):
+        with self.cond:
+            return uuid in self.entries
+
+    def put(self, uuid, directory):
+        entry = dict(uuid=uuid, directory=directory, state=STATE_QUEUED,
+                     attempts=0, next_attempt=time.time(), status=None)
+        with self.cond:
+            self.save(entry)
+            self.entries[uuid] = entry
+            self.cond.notify()
+        return entry
+
+    def set_status(self, uuid, status):
+        """Attach the commit status to be completed with the upload"""
+        with self.cond:
+            entry = self.entries[uuid]
+            entry['status'] = status
+            if entry['state'] in (STATE_DONE, STATE_FAILED):
+                self.remove(entry)
+            else:
+                self.save(entry)
+                entry = None
+        if entry is not None:
+            self.complete(entry)
+
+    def remove(self, entry):
+        del self.entries[entry['uuid']]
+        os.remove(self.entry_path(entry['uuid']))
+
+    def complete(self, entry):
+        if self.on_complete is None or not entry['status']:
+            return
+        try:
+            self.on_complete(entry)
+        except Exception as exc:
+            self.logger.error(
+                'Failed to complete upload of %s: %s', entry['uuid'], exc)
+            self.logger.debug(exc, exc_info=True)
+
+    def next_entry(self):
+        """Wait for an upload that's due, None once stopping"""
+        with self.cond:
+            while not self.stopping:
+                now = time.time()
+                queued = [e for e in self.entries.values()
+                          if e['state'] == STATE_QUEUED]
+                due = [e for e in queued if e['next_attempt'] <= now]
+                if due:
+                    entry = min(due, key=lambda e: e['next_attempt'])
+                    entry['state'] = STATE_UPLOADING
+                    self.save(entry)
+                    return entry
+                timeout = None
+                if queued:
+                    timeout = min(e['next_attempt'] for e in queued) - now
+                self.cond.wait(timeout)
+        return None
+
+    def work(self):
+        while True:
+            entry = self.next_entry()
+            if entry is None:
+                return
+
+            task = ArtifactUpload(entry['directory'], entry['uuid'],
+                                  self.storage,
+                                  timeout=constants.ARTIFACT_UPLOAD_TIMEOUT)
+            try:
+                task()
+            except Exception as exc:
+                uploaded = False
+                self.logger.warning(
+                    'Upload of %s failed: %s', entry['uuid'], exc)
+                self.logger.debug(exc, exc_info=True)
+            else:
+                uploaded = True
+                self.logger.info('Uploaded %s', entry['uuid'])
+
+            with self.cond:
+                entry['attempts'] += 1
+                if uploaded:
+                    entry['state'] = STATE_DONE
+                elif entry['attempts'] > self.retries:
+                    entry['state'] = STATE_FAILED
+                else:
+                    entry['state'] = STATE_QUEUED
+                    entry['next_attempt'] = time.time() + min(
+                        self.backoff * 2 ** (entry['attempts'] - 1),
+                        self.max_backoff)
+
+                if (entry['state'] in (STATE_DONE, STATE_FAILED) and
+                        entry['status'] is not None):
+                    self.remove(entry)
+                else:
+                    self.save(entry)
+                    entry = None
+                self.cond.notify_all()
+            if entry is not None:
+                self.complete(entry)
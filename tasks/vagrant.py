@@ -1,31 +1,106 @@
-import logging
+import collections
+import concurrent.futures
+import functools
 import os
+import re
+import tarfile
+import time
 
 from . import constants
+from .ansible import AnsiblePlaybook
+from .box_store import BoxStore
 from .common import PopenTask, PopenException, FallibleTask, TaskException
 
 
 def with_vagrant(func):
     def wrapper(self, *args, **kwargs):
+        slot = None
         try:
-            __setup_provision(self)
+            slot = __setup_pooled(self)
+            if slot is None:
+                __setup_provision(self)
         except TaskException as exc:
-            logging.critical('vagrant or provisioning failed')
+            self.logger.critical('vagrant or provisioning failed')
             raise exc
         else:
             func(self, *args, **kwargs)
         finally:
-            if not self.no_destroy:
+            if slot is not None:
+                self.vm_pool.release(self, slot)
+            elif not self.no_destroy and self.teardown_queue is not None:
+                # The disks of the VMs are backed by the held overlays
+                after = None
+                if self.overlay_held is not None:
+                    after = functools.partial(self.overlay_store.release,
+                                              self.overlay_held, self.uuid)
+                    self.overlay_held = None
+                self.teardown_queue.put(self.uuid, self.cwd, after)
+                self.teardown_queued = True
+            elif not self.no_destroy:
                 self.execute_subtask(
                     VagrantCleanup(raise_on_err=False))
+                if self.overlay_held is not None:
+                    self.overlay_store.release(self.overlay_held, self.uuid)
+                    self.overlay_held = None
 
     return wrapper
 
 
+def __setup_pooled(task):
+    """
+    Provision pre-booted VMs of the task's pool. Returns the pool slot,
+    None if there's none for the task.
+    """
+    if task.vm_pool is None or task.no_destroy:
+        return None
+    key = task.checkpoint_key()
+    if key is not None:
+        return __setup_checkpoint(task, key)
+    slot = task.vm_pool.acquire(task)
+    if slot is None:
+        # New VMs are booted, they need the memory of idle ones
+        task.vm_pool.make_room(task)
+        return None
+    try:
+        task.execute_subtask(VagrantProvision(timeout=None))
+    except TaskException as exc:
+        task.logger.debug(exc, exc_info=True)
+        task.logger.info("Failed to provision pooled VMs. Booting new ones")
+        task.vm_pool.release(task, slot, reuse=False)
+        return None
+    return slot
+
+
+def __setup_checkpoint(task, key):
+    """
+    Resume the VMs of the checkpoint of key, or provision new VMs in a
+    new checkpoint. Returns its slot, None if there's no checkpoint.
+    """
+    slot = task.vm_pool.resume(task, key)
+    if slot is not None:
+        return slot
+    task.vm_pool.make_room(task)
+    slot = task.vm_pool.new_checkpoint(task, key)
+    if slot is None:
+        return None
+    try:
+        __setup_provision(task)
+    except TaskException:
+        task.vm_pool.release(task, slot, reuse=False)
+        raise
+    task.vm_pool.save_checkpoint(task, slot)
+    return slot
+
+
 def __setup_provision(task):
     """
-    This tries to execute the provision twice due to
-    problems described in issue #20
+    Download the box of the task, then boot its VMs from the disks of the
+    overlay store if it has them for the task. Otherwise bring up the
+    machines and provision them: a machine failing to come up or to be
+    provisioned is recreated and provisioned again by itself, found from
+    the ansible retry file (see VagrantUpMachines and
+    VagrantProvisionMachines). The provisioned disks are saved to the
+    overlay store if the task can share them.
     """
     task.execute_subtask(
         VagrantBoxDownload(
@@ -33,15 +108,81 @@ def __setup_provision(task):
             box_version=task.template_version,
             link_image=task.link_image,
             timeout=None))
+    overlays = task.overlay_keys() if task.overlay_store is not None \
+        else None
+    if overlays is not None and __setup_from_overlays(task, overlays):
+        return
+    # Machines failing to come up or to be provisioned are recreated
+    up = VagrantUpMachines(timeout=None)
+    provision = VagrantProvisionMachines(up.machines, timeout=None)
     try:
+        task.execute_subtask(up)
+        task.execute_subtask(provision)
+    finally:
+        timings = list(up.timings.items()) + list(provision.timings.items())
+        task.logger.info('Machine timings: {timings}'.format(
+            timings=', '.join('{step} {duration:.1f}s'.format(
+                step=step, duration=duration) for step, duration in timings)))
+    if overlays is not None:
+        try:
+            if task.overlay_store.create(task, **overlays):
+                task.logger.info('Saved the provisioned disks')
+        except TaskException as exc:
+            task.logger.warning('Failed to save the provisioned disks: %s',
+                                exc)
+
+
+def __setup_from_overlays(task, overlays):
+    """
+    Boot the VMs from disks provisioned by a previous job, only the
+    configuration of the hosts is provisioned. False if there are none.
+    """
+    path = task.overlay_store.acquire(overlays['key'], task.uuid)
+    if path is None:
+        return False
+    task.overlay_held = overlays['key']
+    task.logger.info('Booting from disks provisioned for {url}'.format(
+        url=overlays['build_url']))
+    try:
+        # vagrant-libvirt creates the disks on the first boot, the second
+        # one mounts the synced folders again
         task.execute_subtask(VagrantUp(timeout=None))
-        task.execute_subtask(VagrantProvision(timeout=None))
-    except Exception as exc:
-        logging.debug(exc, exc_info=True)
-        logging.info("Failed to provision/up VM. Trying it again")
-        task.execute_subtask(VagrantCleanup(raise_on_err=False))
+        task.execute_subtask(VagrantHalt(timeout=None))
+        task.overlay_store.use(task, path)
         task.execute_subtask(VagrantUp(timeout=None))
+        task.skip_package_provisioning()
         task.execute_subtask(VagrantProvision(timeout=None))
+    except (TaskException, OSError, IOError) as exc:
+        task.logger.debug(exc, exc_info=True)
+        task.logger.info("Failed to boot from the provisioned disks")
+        task.execute_subtask(VagrantCleanup(raise_on_err=False))
+        task.skip_package_provisioning(False)
+        task.overlay_store.release(overlays['key'], task.uuid)
+        task.overlay_held = None
+        return False
+    return True
+
+
+def libvirt_prefix(task):
+    """
+    Prefix of the names of the libvirt objects of the vagrant environment
+    in the working directory of task
+    """
+    return os.path.basename(task.cwd.rstrip('/')) + '_'
+
+
+def libvirt_domains(task):
+    """
+    The libvirt domains of the vagrant environment in the working directory
+    of task, by machine name. vagrant-libvirt names them after the
+    environment directory.
+    """
+    list_domains = PopenTask(['virsh', 'list', '--all', '--name'],
+                             capture_output=True)
+    task.execute_subtask(list_domains)
+    prefix = libvirt_prefix(task)
+    return {name[len(prefix):]: name for name in list_domains.output
+            if name.startswith(prefix)}
 
 
 class VagrantTask(FallibleTask):
@@ -57,6 +198,195 @@ class VagrantUp(VagrantTask):
                       timeout=None))
 
 
+def vagrant_machines(task):
+    """Names of the machines of the Vagrantfile in the working directory"""
+    status = PopenTask(['vagrant', 'status', '--machine-readable'],
+                       capture_output=True)
+    task.execute_subtask(status)
+    machines = []
+    for line in status.output:
+        # timestamp,target,type,data
+        fields = line.split(',')
+        if len(fields) >= 4 and fields[2] == 'state' and \
+                fields[1] not in machines:
+            machines.append(fields[1])
+    if not machines:
+        raise TaskException(task, 'No machines in the Vagrantfile')
+    return machines
+
+
+def ansible_provisioner(task):
+    """The playbook and extra variables file the Vagrantfile provisions"""
+    with open(os.path.join(task.cwd, 'Vagrantfile')) as vagrant_f:
+        vagrantfile = vagrant_f.read()
+    playbook = re.search(r'ansible\.playbook\s*=\s*"([^"]+)"', vagrantfile)
+    vars_file = re.search(r'ansible\.extra_vars\s*=\s*"([^"]+)"',
+                          vagrantfile)
+    if playbook is None:
+        raise TaskException(task, 'No ansible provisioner in the Vagrantfile')
+    return playbook.group(1), vars_file.group(1) if vars_file else None
+
+
+class VagrantUpMachines(VagrantTask):
+    """
+    Bring up the machines of the Vagrantfile one by one, workers at once
+    (one per CPU by default). A machine failing to come up is destroyed and
+    brought up again, up to retries times, the other machines are left
+    alone. The bring-up duration of every machine is kept in self.timings.
+
+    machines: the machines to bring up, all of them by default. The
+              machines brought up are in that list once the task is done.
+    """
+    def __init__(self, machines=None, workers=None,
+                 retries=constants.VAGRANT_MACHINE_RETRIES, **kwargs):
+        super(VagrantUpMachines, self).__init__(**kwargs)
+        self.machines = machines if machines is not None else []
+        self.all_machines = machines is None
+        self.workers = workers
+        self.retries = retries
+        self.timings = collections.OrderedDict()
+
+    def up(self, machine):
+        start = time.time()
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    self.logger.info(
+                        'Failed to bring up {machine}, recreating it'.format(
+                            machine=machine))
+                    self.execute_subtask(PopenTask(
+                        ['vagrant', 'destroy', '-f', machine],
+                        raise_on_err=False))
+                try:
+                    self.execute_subtask(PopenTask(
+                        ['vagrant', 'up', '--no-provision', machine],
+                        timeout=None))
+                    return
+                except TaskException as exc:
+                    self.logger.debug(exc, exc_info=True)
+            raise TaskException(self, 'Failed to bring up {machine}'.format(
+                machine=machine))
+        finally:
+            self.timings['{machine} up'.format(machine=machine)] = \
+                time.time() - start
+
+    def _run(self):
+        if self.all_machines:
+            self.machines[:] = vagrant_machines(self)
+        workers = min(len(self.machines),
+                      self.workers or os.cpu_count() or 1)
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            # Every machine is brought up, even if another one failed
+            futures = [executor.submit(self.up, machine)
+                       for machine in self.machines]
+        for future in futures:
+            future.result()
+
+
+class VagrantProvisionMachines(VagrantTask):
+    """
+    Provision the machines of the Vagrantfile, and provision again only the
+    ones that failed, recreated, up to retries times
+
+    The ansible retry file of the playbook names the machines that failed.
+    They're provisioned one by one, workers at once. Facts of the others
+    come from the ansible fact cache (see templates/ansible.cfg), their
+    configuration of the topology (the tasks tagged topology) is updated
+    with the addresses of the new machines.
+
+    machines: all the machines of the Vagrantfile
+    """
+    def __init__(self, machines, workers=None,
+                 retries=constants.VAGRANT_MACHINE_RETRIES, **kwargs):
+        super(VagrantProvisionMachines, self).__init__(**kwargs)
+        self.machines = machines
+        self.workers = workers
+        self.retries = retries
+        self.timings = collections.OrderedDict()
+        self.failed_once = []
+
+    def failed_machines(self, playbook):
+        retry_file = os.path.join(
+            self.cwd, constants.ANSIBLE_RETRY_DIR,
+            os.path.splitext(os.path.basename(playbook))[0] + '.retry')
+        try:
+            with open(retry_file) as retry_f:
+                failed = [line.strip() for line in retry_f if line.strip()]
+            os.remove(retry_file)
+        except (OSError, IOError):
+            return []
+        return failed
+
+    def provision(self, machine, playbook, vars_file):
+        start = time.time()
+        try:
+            self.execute_subtask(AnsiblePlaybook(
+                playbook=playbook, vars_file=vars_file, limit=machine,
+                timeout=None))
+        finally:
+            self.timings['{machine} provision'.format(machine=machine)] = \
+                time.time() - start
+
+    def _run(self):
+        start = time.time()
+        try:
+            self.execute_subtask(VagrantProvision(timeout=None))
+            return
+        except TaskException as exc:
+            error = exc
+        finally:
+            self.timings['provision'] = time.time() - start
+
+        playbook, vars_file = ansible_provisioner(self)
+        failed = self.failed_machines(playbook)
+        if not failed or not set(failed) <= set(self.machines):
+            raise error
+        self.failed_once = list(failed)
+        for _attempt in range(self.retries):
+            self.logger.info('Provisioning failed on {machines}'.format(
+                machines=', '.join(failed)))
+            for machine in failed:
+                self.execute_subtask(PopenTask(
+                    ['vagrant', 'destroy', '-f', machine],
+                    raise_on_err=False))
+                try:
+                    os.remove(os.path.join(
+                        self.cwd, constants.ANSIBLE_FACT_CACHE_DIR, machine))
+                except OSError:
+                    pass
+            up = VagrantUpMachines(failed, workers=self.workers, timeout=None)
+            try:
+                self.execute_subtask(up)
+            finally:
+                self.timings.update(up.timings)
+            workers = min(len(failed), self.workers or os.cpu_count() or 1)
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                futures = [executor.submit(self.provision, machine,
+                                           playbook, vars_file)
+                           for machine in failed]
+            failed = [machine for machine, future in zip(failed, futures)
+                      if future.exception() is not None]
+            if not failed:
+                break
+        if failed:
+            raise TaskException(self, 'Failed to provision {machines}'.format(
+                machines=', '.join(failed)))
+
+        # The recreated machines have new addresses
+        others = [machine for machine in self.machines
+                  if machine not in self.failed_once]
+        if others:
+            self.execute_subtask(AnsiblePlaybook(
+                playbook=playbook, vars_file=vars_file,
+                limit=','.join(others), tags='topology', timeout=None))
+
+
+class VagrantHalt(VagrantTask):
+    def _run(self):
+        self.execute_subtask(
+            PopenTask(['vagrant', 'halt'], timeout=None))
+
+
 class VagrantProvision(VagrantTask):
     def _run(self):
         self.execute_subtask(
@@ -69,64 +399,123 @@ class VagrantCleanup(VagrantTask):
             self.execute_subtask(
                 PopenTask(['vagrant', 'destroy']))
         except PopenException:
-            self.execute_subtask(
-                PopenTask(['pkill', '-9', '-f', '".*/bin/vagrant.*"'],
-                          raise_on_err=False))
-            self.execute_subtask(
-                PopenTask(['systemctl', 'restart', 'libvirtd'],
-                          raise_on_err=False))
-            self.execute_subtask(
-                PopenTask(['vagrant', 'destroy'],
-                          raise_on_err=False))
-            self.execute_subtask(
-                PopenTask(
-                    [
-                        'pkill', '-9', '-f',
-                        '".*(\/bin\/qemu-system-x86_64).*'
-                        '(master|replica|client|controller)*"'
-                    ],
-                    raise_on_err=False
-                )
-            )
+            # Only the VMs of this environment, other jobs keep running
+            self.execute_subtask(DestroyDomains())
+
+
+class DestroyDomains(VagrantTask):
+    """
+    Destroy the libvirt domains, volumes and networks of the vagrant
+    environment in the working directory, without vagrant
+
+    vagrant-libvirt names them after the environment directory, the UUID
+    of the job for the VMs of a job, so nothing else on the host is
+    touched. Nothing is written to the environment either. Raises
+    TaskException unless the domains are gone.
+    """
+    def _run(self):
+        prefix = libvirt_prefix(self)
+        domains = libvirt_domains(self)
+        for domain in sorted(domains.values()):
+            self.execute_subtask(PopenTask(['virsh', 'destroy', domain],
+                                           raise_on_err=False))
+            self.execute_subtask(PopenTask(
+                ['virsh', 'undefine', domain, '--remove-all-storage',
+                 '--snapshots-metadata', '--nvram'], raise_on_err=False))
+
+        list_volumes = PopenTask(['virsh', 'vol-list', 'default'],
+                                 capture_output=True, raise_on_err=False)
+        self.execute_subtask(list_volumes)
+        # Name Path, after the header
+        for line in list_volumes.output[2:]:
+            fields = line.split()
+            if fields and fields[0].startswith(prefix):
+                self.execute_subtask(PopenTask(
+                    ['virsh', 'vol-delete', fields[0], '--pool', 'default'],
+                    raise_on_err=False))
+
+        list_networks = PopenTask(['virsh', 'net-list', '--all', '--name'],
+                                  capture_output=True, raise_on_err=False)
+        self.execute_subtask(list_networks)
+        for network in list_networks.output:
+            if network.startswith(prefix):
+                self.execute_subtask(PopenTask(
+                    ['virsh', 'net-destroy', network], raise_on_err=False))
+                self.execute_subtask(PopenTask(
+                    ['virsh', 'net-undefine', network], raise_on_err=False))
+
+        if domains:
+            left = libvirt_domains(self)
+            if left:
+                raise TaskException(self, 'VMs not destroyed: {left}'.format(
+                    left=', '.join(sorted(left.values()))))
 
 
 class VagrantBoxDownload(VagrantTask):
-    def __init__(self, box_name, box_version, link_image=True, **kwargs):
+    def __init__(self, box_name, box_version, link_image=True,
+                 box_store=None, prefetch=False, **kwargs):
         """
         link_image: if True, a symbolic link will be created in libvirt to
                     conserve storage (otherwise, libvirt copies it by default)
+        box_store: the BoxStore downloading the box, `vagrant box add` is
+                   the fallback
+        prefetch: if True, the box is downloaded ahead of the jobs needing
+                  it, rather than for a job
         """
         super(VagrantBoxDownload, self).__init__(**kwargs)
         self.box = VagrantBox(box_name, box_version)
         self.link_image = True
+        self.box_store = box_store if box_store is not None else BoxStore()
+        self.prefetch = prefetch
 
     def _run(self):
-        if not self.box.exists():
-            try:
-                self.execute_subtask(
-                    PopenTask([
-                        'vagrant', 'box', 'add', self.box.name,
-                        '--box-version', self.box.version,
-                        '--provider', self.box.provider],
-                        timeout=None))
-            except TaskException as exc:
-                logging.error('Box download failed')
-                raise exc
+        # Jobs needing the same box wait for the one downloading it
+        with self.box_store.lock(self.box):
+            present = self.box.exists()
+            if not self.prefetch:
+                self.box_store.record_use(self.box, present)
+            if not present:
+                self.download()
+                if self.prefetch:
+                    self.box_store.prefetched(self.box)
+            if self.link_image and not self.box.libvirt_exists():
+                self.link()
+            self.box_store.touch(self.box)
 
-        # link box to libvirt
-        if self.link_image and not self.box.libvirt_exists():
-            try:
-                self.execute_subtask(
-                    PopenTask([
-                        'ln', self.box.vagrant_path, self.box.libvirt_path]))
-                self.execute_subtask(
-                    PopenTask([
-                        'chown', 'qemu:qemu', self.box.libvirt_path]))
-                self.execute_subtask(
-                    PopenTask(['virsh', 'pool-refresh', 'default']))
-            except TaskException as exc:
-                logging.warning('Failed to create libvirt link to image')
-                raise exc
+    def download(self):
+        try:
+            self.box_store.fetch(self, self.box)
+            return
+        except (TaskException, OSError, IOError, ValueError,
+                tarfile.TarError) as exc:
+            # urllib errors are OSErrors
+            self.logger.warning('Box store download failed: %s', exc)
+        try:
+            self.execute_subtask(
+                PopenTask([
+                    'vagrant', 'box', 'add', self.box.name,
+                    '--box-version', self.box.version,
+                    '--provider', self.box.provider],
+                    timeout=None))
+        except TaskException as exc:
+            self.logger.error('Box download failed')
+            raise exc
+
+    def link(self):
+        """Link the box image to libvirt, under its final name at once"""
+        tmp_path = self.box.libvirt_path + '.tmp'
+        try:
+            self.execute_subtask(
+                PopenTask(['ln', '-f', self.box.vagrant_path, tmp_path]))
+            self.execute_subtask(
+                PopenTask(['chown', 'qemu:qemu', tmp_path]))
+            self.execute_subtask(
+                PopenTask(['mv', '-f', tmp_path, self.box.libvirt_path]))
+            self.execute_subtask(
+                PopenTask(['virsh', 'pool-refresh', 'default']))
+        except TaskException as exc:
+            self.logger.warning('Failed to create libvirt link to image')
+            raise exc
 
 
 class VagrantBox(object):
@@ -0,0 +1,601 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import psutil
+
+from .common import FallibleTask, PopenTask, TaskException
+from . import constants
+from .topologies import vagrantfile_machines
+from .vagrant import (VagrantBoxDownload, VagrantCleanup, VagrantUp,
+                      libvirt_domains)
+
+GiB = 1024 ** 3
+
+SLOT_FILE = 'pool.json'
+# Files of a slot that aren't artifacts of the job using it
+SLOT_FILES = ('Vagrantfile', 'ansible.cfg', '.vagrant', SLOT_FILE)
+# Files of a job directory that stay out of the slot
+JOB_FILES = ('Vagrantfile', 'hostname', constants.RUNNER_LOG,
+             constants.RUNNER_LOG + '.gz', constants.RESOURCES_FILE)
+
+STATE_WARMING = 'warming'
+STATE_READY = 'ready'
+STATE_LEASED = 'leased'
+
+
+def vagrantfile_key(template_name, vagrantfile):
+    """Pool key of the VMs of the content of a rendered Vagrantfile"""
+    digest = hashlib.sha256(vagrantfile.encode('utf-8')).hexdigest()
+    return '{name}-{digest}'.format(
+        name=template_name.replace('/', '-'), digest=digest[:12])
+
+
+class DomainSnapshot(FallibleTask):
+    """
+    Create, revert to or delete a snapshot of every VM of the vagrant
+    environment in the working directory
+    """
+    COMMANDS = dict(
+        create=['snapshot-create-as', '--atomic'],
+        revert=['snapshot-revert', '--running', '--force'],
+        delete=['snapshot-delete'])
+
+    def __init__(self, action, name, **kwargs):
+        super(DomainSnapshot, self).__init__(**kwargs)
+        self.action = action
+        self.name = name
+
+    def _run(self):
+        domains = sorted(libvirt_domains(self).values())
+        if not domains:
+            raise TaskException(self, 'No VMs in {path}'.format(
+                path=self.cwd))
+        command = self.COMMANDS[self.action]
+        for domain in domains:
+            self.execute_subtask(PopenTask(
+                ['virsh', command[0], domain, self.name] + command[1:],
+                timeout=None))
+            if self.action == 'revert':
+                # The guest clock is as old as the snapshot, Kerberos
+                # doesn't tolerate that. Needs the guest agent.
+                self.execute_subtask(PopenTask(
+                    ['virsh', 'domtime', domain, '--sync'],
+                    raise_on_err=False))
+
+    def __str__(self):
+        return '{cls} {action} {name}'.format(
+            cls=type(self).__name__, action=self.action, name=self.name)
+
+
+def checkpoint_key(template_name, vagrantfile, build_url, update_packages):
+    """Pool key of the VMs of a Vagrantfile with a build installed"""
+    digest = hashlib.sha256('{url} {update}'.format(
+        url=build_url, update=bool(update_packages)).encode('utf-8'))
+    return 'checkpoint-{key}-{digest}'.format(
+        key=vagrantfile_key(template_name, vagrantfile),
+        digest=digest.hexdigest()[:12])
+
+
+class StopDomains(FallibleTask):
+    """Power off the VMs of the vagrant environment in the working directory"""
+    def _run(self):
+        for domain in sorted(libvirt_domains(self).values()):
+            self.execute_subtask(PopenTask(['virsh', 'destroy', domain],
+                                           raise_on_err=False))
+
+
+class Slot(object):
+    """
+    A vagrant environment of the pool, with its VMs
+
+    snapshot: the snapshot the VMs are reverted to for the next job
+    kept: files of a checkpoint created by the provisioning, copied to
+          the jobs using it
+    """
+    def __init__(self, path, key, template, state=STATE_WARMING,
+                 last_used=None, snapshot=constants.VM_POOL_SNAPSHOT,
+                 kept=()):
+        self.path = path
+        self.key = key
+        self.template = template
+        self.state = state
+        self.last_used = last_used if last_used is not None else time.time()
+        self.snapshot = snapshot
+        self.kept = list(kept)
+        self.inputs = []
+        # Whether the VMs can be reverted to the snapshot
+        self.reusable = True
+        # Whether the memory of the running VMs is accounted to the pool
+        self.reserved = False
+
+    @property
+    def checkpoint(self):
+        return self.snapshot == constants.VM_POOL_CHECKPOINT
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    @property
+    def memory(self):
+        """Memory (MiB) of the VMs of the Vagrantfile"""
+        try:
+            with open(os.path.join(self.path, 'Vagrantfile')) as vagrant_f:
+                machines = vagrantfile_machines(vagrant_f.read())
+        except (OSError, IOError):
+            return 0
+        return sum(machine['memory'] for machine in machines.values())
+
+    @staticmethod
+    def load(path):
+        with open(os.path.join(path, SLOT_FILE)) as slot_f:
+            data = json.load(slot_f)
+        return Slot(path, data['key'], data['template'], data['state'],
+                    data['last_used'],
+                    data.get('snapshot', constants.VM_POOL_SNAPSHOT),
+                    data.get('kept', ()))
+
+    def save(self):
+        tmp_path = os.path.join(self.path, SLOT_FILE + '.tmp')
+        with open(tmp_path, 'w') as slot_f:
+            json.dump(dict(key=self.key, template=self.template,
+                           state=self.state, last_used=self.last_used,
+                           snapshot=self.snapshot, kept=self.kept),
+                      slot_f)
+        os.rename(tmp_path, os.path.join(self.path, SLOT_FILE))
+
+
+class WarmSlot(FallibleTask):
+    """Boot the VMs of a slot, without provisioning, and snapshot them"""
+    def __init__(self, slot, **kwargs):
+        super(WarmSlot, self).__init__(cwd=slot.path, timeout=None, **kwargs)
+        self.slot = slot
+
+    def _run(self):
+        self.execute_subtask(
+            VagrantBoxDownload(
+                box_name=self.slot.template['name'],
+                box_version=self.slot.template['version'],
+                timeout=None))
+        self.execute_subtask(VagrantUp(timeout=None))
+        self.execute_subtask(
+            DomainSnapshot('create', constants.VM_POOL_SNAPSHOT))
+
+
+class VMPool(object):
+    """
+    Pre-booted VMs, ready to be provisioned by jobs
+
+    A slot of the pool is a vagrant environment in root, booted from the
+    Vagrantfile of a job (the pool key is its template and a digest of its
+    content) and snapshotted right after boot. A job leasing a slot runs
+    vagrant in the slot instead of its own directory, its artifacts are
+    moved to the job directory once it's done and the VMs are reverted to
+    the snapshot, ready for the next job.
+
+    refill() boots slots for the Vagrantfiles jobs asked for within
+    demand_window (seconds), at most as many slots as jobs asked for each
+    and max_slots in total, as long as min_free_memory (bytes) stays
+    available. Slots unused for max_idle (seconds) are destroyed, and so
+    are idle slots when a job without a slot needs the memory.
+
+    Checkpoints are slots created by a job, snapshotted with their memory
+    once the job provisioned them (with a build installed). The next jobs
+    with the same checkpoint key resume the VMs from the snapshot instead
+    of provisioning them. Idle checkpoints are powered off, they only take
+    disk space. At most max_checkpoints are kept, destroyed when unused
+    for checkpoint_max_idle (seconds).
+
+    The memory of the running VMs no job uses, of the ready slots and of
+    the slots being warmed, is reported to the callback given to
+    account(): the scheduler doesn't give it to the jobs.
+    """
+    def __init__(self, root=None, max_slots=constants.VM_POOL_MAX_SLOTS,
+                 min_free_memory=constants.VM_POOL_MIN_FREE_MEMORY,
+                 max_idle=constants.VM_POOL_MAX_IDLE,
+                 demand_window=constants.VM_POOL_DEMAND_WINDOW,
+                 max_checkpoints=constants.VM_POOL_MAX_CHECKPOINTS,
+                 checkpoint_max_idle=constants.VM_POOL_CHECKPOINT_MAX_IDLE):
+        self.root = root if root is not None else constants.VM_POOL_DIR
+        self.max_slots = max_slots
+        self.min_free_memory = min_free_memory
+        self.max_idle = max_idle
+        self.demand_window = demand_window
+        self.max_checkpoints = max_checkpoints
+        self.checkpoint_max_idle = checkpoint_max_idle
+        self.lock = threading.Lock()
+        self.demand = {}
+        self.logger = logging.getLogger(__name__)
+        self.slots = {}
+        self.memory_changed = None
+        self.memory_lock = threading.Lock()
+        self.worker = None
+        os.makedirs(self.root, exist_ok=True)
+        self.load()
+
+    @staticmethod
+    def from_config(config):
+        """
+        Create the pool from the vm_pool section of the runner
+        configuration, memory is in GiB and times in hours
+        """
+        return VMPool(
+            max_slots=config.get('max_slots', constants.VM_POOL_MAX_SLOTS),
+            min_free_memory=int(config.get(
+                'min_free_memory',
+                constants.VM_POOL_MIN_FREE_MEMORY / GiB) * GiB),
+            max_idle=config.get(
+                'max_idle', constants.VM_POOL_MAX_IDLE / 3600) * 3600,
+            demand_window=config.get(
+                'demand_window',
+                constants.VM_POOL_DEMAND_WINDOW / 3600) * 3600,
+            max_checkpoints=config.get(
+                'max_checkpoints', constants.VM_POOL_MAX_CHECKPOINTS),
+            checkpoint_max_idle=config.get(
+                'checkpoint_max_idle',
+                constants.VM_POOL_CHECKPOINT_MAX_IDLE / 3600) * 3600)
+
+    def load(self):
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                slot = Slot.load(path)
+            except (OSError, IOError, ValueError, KeyError):
+                slot = Slot(path, None, None)
+            self.slots[path] = slot
+            if slot.state != STATE_READY:
+                # Interrupted by a restart
+                self.destroy(slot)
+            elif not slot.checkpoint:
+                slot.reserved = True
+
+    def account(self, memory_changed):
+        """
+        Call memory_changed(memory) with the memory (MiB) the idle VMs of
+        the pool take, and again with every change (negative once freed)
+        """
+        with self.lock:
+            self.memory_changed = memory_changed
+            memory = sum(slot.memory for slot in self.slots.values()
+                         if slot.reserved)
+        memory_changed(memory)
+
+    def reserve(self, slot, reserved=True):
+        """Account the memory of the VMs of slot to the pool, or not"""
+        with self.memory_lock:
+            if slot.reserved == reserved:
+                return
+            slot.reserved = reserved
+        if self.memory_changed is not None:
+            self.memory_changed(slot.memory if reserved else -slot.memory)
+
+    def available_memory(self):
+        return psutil.virtual_memory().available
+
+    def acquire(self, task):
+        """
+        Lease a ready slot for the VMs of task and switch the task to it,
+        None if there's none
+        """
+        with open(os.path.join(task.data_dir, 'Vagrantfile')) as vagrant_f:
+            vagrantfile = vagrant_f.read()
+        key = vagrantfile_key(task.template_name, vagrantfile)
+        template = dict(name=task.template_name,
+                        version=task.template_version)
+        now = time.time()
+        with self.lock:
+            times = self.demand.get(key, ([], None, None))[0]
+            self.demand[key] = (
+                [t for t in times if now - t < self.demand_window] + [now],
+                template, vagrantfile)
+            slot = self.lease(key)
+        if slot is None:
+            return None
+        self.switch(task, slot)
+        task.logger.info('Using VMs of pool slot {name}'.format(
+            name=slot.name))
+        return slot
+
+    def lease(self, key):
+        """The most recently used ready slot of key, leased"""
+        ready = [slot for slot in self.slots.values()
+                 if slot.key == key and slot.state == STATE_READY]
+        if not ready:
+            return None
+        slot = max(ready, key=lambda slot: slot.last_used)
+        slot.state = STATE_LEASED
+        slot.save()
+        # The resources of the job include its VMs
+        self.reserve(slot, False)
+        return slot
+
+    @staticmethod
+    def switch(task, slot):
+        """Run the vagrant commands of task in the slot"""
+        # The slot takes the files the job prepared for vagrant
+        for name in os.listdir(task.data_dir):
+            path = os.path.join(task.data_dir, name)
+            if name in JOB_FILES or not os.path.isfile(path):
+                continue
+            shutil.copy(path, os.path.join(slot.path, name))
+            slot.inputs.append(name)
+        task.cwd = slot.path
+        if task.sampler is not None:
+            task.sampler.match = slot.name
+
+    def resume(self, task, key):
+        """
+        Lease the checkpoint of key for task and resume its VMs, None if
+        there's none or its VMs fail the health check of task
+        """
+        with self.lock:
+            slot = self.lease(key)
+        if slot is None:
+            return None
+        self.switch(task, slot)
+        task.logger.info('Resuming VMs of checkpoint {name}'.format(
+            name=slot.name))
+        try:
+            task.execute_subtask(DomainSnapshot('revert', slot.snapshot))
+            task.check_checkpoint()
+        except TaskException as exc:
+            task.logger.debug(exc, exc_info=True)
+            task.logger.info('Checkpoint {name} is unhealthy'.format(
+                name=slot.name))
+            self.release(task, slot, reuse=False)
+            return None
+        return slot
+
+    def new_checkpoint(self, task, key):
+        """
+        A new leased slot for the VMs of task, it becomes a checkpoint of
+        key once they're provisioned (see save_checkpoint)
+        """
+        path = os.path.join(self.root, 'checkpoint-{id}'.format(
+            id=uuid.uuid4().hex[:8]))
+        slot = Slot(path, key, dict(name=task.template_name,
+                                    version=task.template_version),
+                    state=STATE_LEASED, snapshot=constants.VM_POOL_CHECKPOINT)
+        try:
+            os.makedirs(path)
+            slot.save()
+        except (OSError, IOError) as exc:
+            task.logger.warning('Failed to create checkpoint: %s', exc)
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        with self.lock:
+            self.slots[path] = slot
+        self.switch(task, slot)
+        shutil.copy(os.path.join(task.data_dir, 'Vagrantfile'), path)
+        return slot
+
+    def save_checkpoint(self, task, slot):
+        """
+        Snapshot the provisioned VMs of a new checkpoint, with the files
+        the provisioning created. The slot is destroyed once the job is
+        done if the snapshot fails.
+        """
+        try:
+            task.execute_subtask(DomainSnapshot('create', slot.snapshot))
+        except TaskException as exc:
+            task.logger.warning('Failed to create checkpoint: %s', exc)
+            slot.reusable = False
+            return
+        slot.kept = [name for name in os.listdir(slot.path)
+                     if name not in SLOT_FILES and name not in slot.inputs]
+        slot.save()
+        task.logger.info('Created checkpoint {name}'.format(name=slot.name))
+
+    def release(self, task, slot, reuse=True):
+        """
+        Move the artifacts of task from the slot to its job directory and
+        return the slot to the pool, or destroy it if reuse is False or it
+        can't be reverted. Checkpoints are powered off, they are reverted
+        when resumed.
+        """
+        task.cwd = task.data_dir
+        if task.sampler is not None:
+            task.sampler.match = task.uuid
+        for name in os.listdir(slot.path):
+            if name in SLOT_FILES:
+                continue
+            path = os.path.join(slot.path, name)
+            if name in slot.inputs:
+                os.remove(path)
+                continue
+            try:
+                if name in slot.kept:
+                    copy = shutil.copytree if os.path.isdir(path) \
+                        else shutil.copy
+                    copy(path, os.path.join(task.data_dir, name))
+                    continue
+                shutil.move(path, os.path.join(task.data_dir, name))
+            except (OSError, IOError, shutil.Error) as exc:
+                task.logger.warning('Failed to collect %s: %s', name, exc)
+                shutil.rmtree(path, ignore_errors=True)
+        slot.inputs = []
+
+        reuse = reuse and slot.reusable
+        if reuse and slot.checkpoint:
+            task.execute_subtask(StopDomains(cwd=slot.path))
+        elif reuse:
+            revert = DomainSnapshot('revert', slot.snapshot, cwd=slot.path)
+            try:
+                task.execute_subtask(revert)
+            except TaskException as exc:
+                task.logger.warning('Failed to revert pool slot: %s', exc)
+                reuse = False
+        if not reuse:
+            self.destroy(slot, task)
+            return
+        with self.lock:
+            slot.state = STATE_READY
+            slot.last_used = time.time()
+            slot.save()
+        if not slot.checkpoint:
+            self.reserve(slot)
+
+    def destroy(self, slot, task=None):
+        """Destroy the VMs of a slot and remove it"""
+        self.logger.info('Destroying pool slot %s', slot.name)
+        with self.lock:
+            self.slots.pop(slot.path, None)
+        self.reserve(slot, False)
+        if os.path.exists(os.path.join(slot.path, 'Vagrantfile')):
+            for subtask in (
+                    DomainSnapshot('delete', slot.snapshot,
+                                   cwd=slot.path, raise_on_err=False),
+                    VagrantCleanup(cwd=slot.path, raise_on_err=False)):
+                if task is not None:
+                    task.execute_subtask(subtask)
+                else:
+                    subtask()
+        shutil.rmtree(slot.path, ignore_errors=True)
+
+    def idle_slots(self, checkpoints=False):
+        """Ready slots (or checkpoints), least recently used first"""
+        with self.lock:
+            return sorted((slot for slot in self.slots.values()
+                           if slot.state == STATE_READY and
+                           slot.checkpoint == checkpoints),
+                          key=lambda slot: slot.last_used)
+
+    def claim(self, slot):
+        """
+        Take an idle slot out of the pool to destroy it, False if a job
+        leased it meanwhile (the pool is refilled in a thread)
+        """
+        with self.lock:
+            if slot.state != STATE_READY:
+                return False
+            slot.state = STATE_LEASED
+            return True
+
+    def make_room(self, task=None):
+        """Destroy idle slots until min_free_memory is available"""
+        for slot in self.idle_slots():
+            if self.available_memory() >= self.min_free_memory:
+                return
+            if self.claim(slot):
+                self.destroy(slot, task)
+
+    def shrink(self, memory):
+        """
+        Destroy idle slots, the least recently used first, until their VMs
+        freed memory (MiB) for a job. Returns the memory freed.
+        """
+        freed = 0
+        for slot in self.idle_slots():
+            if freed >= memory:
+                break
+            if self.claim(slot):
+                freed += slot.memory
+                self.destroy(slot)
+        return freed
+
+    def refill_in_background(self):
+        """Refill the pool in a thread, unless it's being refilled"""
+        with self.lock:
+            if self.worker is not None and self.worker.is_alive():
+                return
+            self.worker = threading.Thread(target=self.safe_refill,
+                                           daemon=True)
+            self.worker.start()
+
+    def safe_refill(self):
+        try:
+            self.refill()
+        except Exception as exc:
+            self.logger.warning('Failed to refill the VM pool: %s', exc)
+            self.logger.debug(exc, exc_info=True)
+
+    def targets(self):
+        """Number of slots to keep for each key, by demand"""
+        now = time.time()
+        with self.lock:
+            demand = {key: len([t for t in times
+                                if now - t < self.demand_window])
+                      for key, (times, _t, _v) in self.demand.items()}
+        targets = dict.fromkeys(demand, 0)
+        total = 0
+        # Round-robin over the keys, the most demanded first
+        while total < self.max_slots:
+            wanted = [key for key in sorted(demand, key=demand.get,
+                                            reverse=True)
+                      if targets[key] < demand[key]]
+            if not wanted:
+                break
+            for key in wanted[:self.max_slots - total]:
+                targets[key] += 1
+                total += 1
+        return targets
+
+    def refill(self):
+        """
+        Adapt the pool to the demand: destroy expired and unwanted slots
+        and checkpoints, then boot one missing slot. Called while the
+        runner is idle, see refill_in_background().
+        """
+        now = time.time()
+        with self.lock:
+            count = len([s for s in self.slots.values() if s.checkpoint])
+        for slot in self.idle_slots(checkpoints=True):
+            if (now - slot.last_used > self.checkpoint_max_idle or
+                    count > self.max_checkpoints) and self.claim(slot):
+                self.destroy(slot)
+                count -= 1
+
+        targets = self.targets()
+        for slot in self.idle_slots():
+            count = len([s for s in self.slots.values() if s.key == slot.key])
+            if (now - slot.last_used > self.max_idle or
+                    count > targets.get(slot.key, 0)) and self.claim(slot):
+                self.destroy(slot)
+        self.make_room()
+
+        for key, target in sorted(targets.items(), key=lambda item: -item[1]):
+            with self.lock:
+                count = len([s for s in self.slots.values() if s.key == key])
+                _times, template, vagrantfile = self.demand[key]
+            if count >= target:
+                continue
+            if self.available_memory() < self.min_free_memory:
+                self.logger.info('Not enough memory to refill the VM pool')
+                return
+            self.warm(key, template, vagrantfile)
+            return
+
+    def warm(self, key, template, vagrantfile):
+        path = os.path.join(self.root, 'slot-{id}'.format(
+            id=uuid.uuid4().hex[:8]))
+        slot = Slot(path, key, template)
+        try:
+            os.makedirs(path)
+            with open(os.path.join(path, 'Vagrantfile'), 'w') as vagrant_f:
+                vagrant_f.write(vagrantfile)
+            shutil.copy(constants.ANSIBLE_CFG_FILE, path)
+            slot.save()
+        except (OSError, IOError) as exc:
+            self.logger.warning('Failed to create pool slot: %s', exc)
+            shutil.rmtree(path, ignore_errors=True)
+            return
+        with self.lock:
+            self.slots[path] = slot
+        self.reserve(slot)
+        self.logger.info('Warming pool slot %s for %s', slot.name, key)
+        try:
+            WarmSlot(slot)()
+        except TaskException as exc:
+            self.logger.warning('Failed to warm pool slot: %s', exc)
+            self.destroy(slot)
+            return
+        with self.lock:
+            slot.state = STATE_READY
+            slot.last_used = time.time()
+            slot.save()
@@ -0,0 +1,111 @@
+import collections
+import errno
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from .common import FallibleTask, PopenTask
+from . import constants
+
+
+class CreateRepo(FallibleTask):
+    """
+    Generate the metadata of a yum repository with createrepo
+
+    The metadata of the previous repository created with the same name is
+    kept in cache_dir. createrepo updates it (--update) instead of reading
+    every package again, and keeps the checksums of the packages it has
+    seen in cache_dir too. Checksums older than max_age (seconds) are
+    removed from the cache.
+
+    workers: number of checksum workers, one per CPU by default
+    database: if False, the sqlite databases are not generated, dnf only
+              reads the XML metadata
+
+    The duration of every phase is logged and kept in self.timings.
+    """
+    def __init__(self, repo_path, name,
+                 cache_dir=constants.CREATEREPO_CACHE_DIR, workers=None,
+                 database=True,
+                 max_age=constants.CREATEREPO_CACHE_MAX_AGE, **kwargs):
+        super(CreateRepo, self).__init__(**kwargs)
+        self.repo_path = repo_path
+        self.cache_dir = cache_dir
+        self.checksums_dir = os.path.join(cache_dir, 'checksums')
+        self.previous_repo = os.path.join(
+            cache_dir, 'repos', re.sub('[^A-Za-z0-9_.-]', '_', name))
+        self.workers = workers if workers else os.cpu_count() or 1
+        self.database = database
+        self.max_age = max_age
+        self.timings = collections.OrderedDict()
+
+    def phase(self, name, function):
+        start = time.time()
+        try:
+            function()
+        finally:
+            self.timings[name] = time.time() - start
+            self.logger.info('createrepo {phase}: {duration:.1f}s'.format(
+                phase=name, duration=self.timings[name]))
+
+    def prune_checksums(self):
+        os.makedirs(self.checksums_dir, exist_ok=True)
+        expired = time.time() - self.max_age
+        for name in os.listdir(self.checksums_dir):
+            path = os.path.join(self.checksums_dir, name)
+            try:
+                if os.stat(path).st_mtime < expired:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def createrepo(self):
+        cmd = ['createrepo', '--workers', str(self.workers),
+               '--cachedir', self.checksums_dir]
+        if not self.database:
+            cmd.append('--no-database')
+        if os.path.isdir(os.path.join(self.previous_repo, 'repodata')):
+            cmd.extend(['--update', '--update-md-path', self.previous_repo])
+        cmd.append(self.repo_path)
+        self.execute_subtask(PopenTask(cmd, timeout=None))
+
+    def save_metadata(self):
+        """
+        Replace the cached metadata by the metadata just created. The
+        metadata is staged apart from the ones of concurrent builds of
+        the same repository, the last one saved wins.
+        """
+        parent, name = os.path.split(self.previous_repo)
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=parent, prefix=name + '.',
+                                    suffix='.tmp')
+        old_path = tempfile.mkdtemp(dir=parent, prefix=name + '.',
+                                    suffix='.tmp')
+        try:
+            shutil.copytree(os.path.join(self.repo_path, 'repodata'),
+                            os.path.join(tmp_path, 'repodata'))
+            try:
+                os.rename(self.previous_repo,
+                          os.path.join(old_path, name))
+            except FileNotFoundError:
+                pass
+            try:
+                os.rename(tmp_path, self.previous_repo)
+            except OSError as exc:
+                # Saved by a concurrent build meanwhile
+                if exc.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            shutil.rmtree(old_path, ignore_errors=True)
+
+    def _run(self):
+        self.phase('prune cache', self.prune_checksums)
+        self.phase('metadata', self.createrepo)
+        try:
+            self.phase('save cache', self.save_metadata)
+        except (OSError, IOError, shutil.Error) as exc:
+            # Only the next repository is slower to create
+            self.logger.warning('Failed to cache the repo metadata: %s', exc)